@@ -0,0 +1,224 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+from exchange_rates import ExchangeRateMatrix, rewards_by_epoch
+from track_historical_staked_sui import (
+    STAKED_SUI_TYPE,
+    SUI_COIN_TYPE,
+    StakedSuiRef,
+    build_object_history,
+    calculate_rewards_for_address,
+    filter_transactions_for_object_type,
+    get_existing_objects_at_epoch,
+)
+
+# Benchmarks the pure-CPU stages of the object-history pipeline on synthetic wallets, e.g.
+#   python3 benchmark.py --sizes 1000 10000 --save-baseline bench_baseline.json
+#   python3 benchmark.py --sizes 1000 10000 --baseline bench_baseline.json
+
+TX_PER_EPOCH = 50
+VALIDATORS = 20
+
+
+def synthesize_wallet(address, n_transactions, mutations_per_object=20, seed=0) -> List[dict]:
+    """
+    Transactions in suix_queryTransactionBlocks format for a wallet that keeps creating Coin<SUI> and StakedSui
+    objects, mutates each about mutations_per_object times and then deletes it. Every transaction also carries
+    an object owned by someone else, which the filters have to skip.
+    """
+    rnd = random.Random(seed)
+    transactions = []
+    live: Dict[str, Tuple[str, int]] = {}
+    remaining: Dict[str, int] = {}
+    next_object = 0
+    for idx in range(n_transactions):
+        version = idx + 2
+        epoch = str(idx // TX_PER_EPOCH)
+        object_changes = []
+        deleted = []
+
+        if not live or rnd.random() < 1.0 / mutations_per_object:
+            object_id = f"0x{next_object:064x}"
+            next_object += 1
+            object_type = STAKED_SUI_TYPE if rnd.random() < 0.3 else SUI_COIN_TYPE
+            live[object_id] = (object_type, version)
+            remaining[object_id] = max(1, int(rnd.expovariate(1.0 / mutations_per_object)))
+            object_changes.append(_object_change(object_id, object_type, "created", version, address))
+        else:
+            object_id = rnd.choice(list(live.keys()))
+            object_type, _ = live[object_id]
+            remaining[object_id] -= 1
+            if remaining[object_id] <= 0:
+                del live[object_id]
+                del remaining[object_id]
+                deleted.append({"digest": f"deleted{idx}", "objectId": object_id, "version": version})
+            else:
+                live[object_id] = (object_type, version)
+                object_changes.append(_object_change(object_id, object_type, "mutated", version, address))
+
+        object_changes.append(_object_change(f"0xgas{idx:060x}", SUI_COIN_TYPE, "mutated", version, "0xsomeoneelse"))
+        transactions.append({
+            "digest": f"tx{idx}",
+            "checkpoint": str(idx),
+            "timestampMs": str(idx * 1000),
+            "effects": {"executedEpoch": epoch, "deleted": deleted or None},
+            "objectChanges": object_changes,
+        })
+    return transactions
+
+
+def _object_change(object_id, object_type, change_type, version, owner) -> dict:
+    return {
+        "digest": f"{object_id[-8:]}{version}",
+        "objectId": object_id,
+        "objectType": object_type,
+        "type": change_type,
+        "version": str(version),
+        "owner": {"AddressOwner": owner},
+    }
+
+
+def synthesize_events(epochs) -> Dict[Tuple[str, str], dict]:
+    events = {}
+    for epoch in range(epochs + 1):
+        for validator in range(VALIDATORS):
+            events[(str(epoch), f"0xvalidator{validator}")] = {"parsedJson": {"pool_token_exchange_rate": {
+                "pool_token_amount": str(10**9 - epoch * 10**5), "sui_amount": str(10**9)}}}
+    return events
+
+
+class StaticSystemStateClient:
+    def __init__(self):
+        self.state = {"activeValidators": [
+            {"stakingPoolId": f"0xpool{validator}", "suiAddress": f"0xvalidator{validator}"} for validator in range(VALIDATORS)]}
+
+    def get_sui_system_state(self):
+        return self.state
+
+
+def measure(fn: Callable[[], Any], n_transactions, repeat=3) -> Tuple[Dict[str, float], Any]:
+    """Best wall time of `repeat` runs, then one traced run for peak memory and the memory blocks still allocated at its end."""
+    wall = float("inf")
+    result = None
+    for _ in range(repeat):
+        result = None
+        gc.collect()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = fn()
+        wall = min(wall, time.perf_counter() - start)
+
+    result = None
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = fn()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retained = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+
+    return {
+        "wall_s": wall,
+        "us_per_tx": wall / n_transactions * 1e6,
+        "peak_mb": peak / 2**20,
+        "retained_blocks_per_tx": retained / n_transactions,
+    }, result
+
+
+def run_benchmarks(sizes, mutations_per_object=20, repeat=3) -> Dict[str, Dict[str, float]]:
+    address = "0xbench"
+    results = {}
+    for size in sizes:
+        transactions = synthesize_wallet(address, size, mutations_per_object)
+        max_epoch = (size - 1) // TX_PER_EPOCH
+
+        stats, filtered = measure(lambda: filter_transactions_for_object_type(address, transactions, SUI_COIN_TYPE), size, repeat)
+        results[f"filter_transactions_for_object_type/{size}"] = stats
+
+        stats, (_, objs_by_obj_id) = measure(lambda: build_object_history(address, filtered), size, repeat)
+        results[f"build_object_history/{size}"] = stats
+
+        epochs = range(0, max_epoch + 1)
+        stats, _ = measure(lambda: [get_existing_objects_at_epoch(objs_by_obj_id, epoch) for epoch in epochs], size, repeat)
+        results[f"get_existing_objects_at_epoch/{size}"] = stats
+
+        staked_filtered = filter_transactions_for_object_type(address, transactions, STAKED_SUI_TYPE)
+        _, staked_by_obj_id = build_object_history(address, staked_filtered)
+        staked_sui_objs = [
+            StakedSuiRef(object_id=ref.object_id, version=ref.version, owner=address, pool_id=f"0xpool{idx % VALIDATORS}",
+                         principal=10**12, stake_activation_epoch=0, at_epoch=max_epoch, deleted=False)
+            for idx, ref in enumerate(get_existing_objects_at_epoch(staked_by_obj_id, max_epoch))
+        ]
+        events = synthesize_events(max_epoch)
+        client = StaticSystemStateClient()
+        stats, _ = measure(lambda: [calculate_rewards_for_address(client, events, 0, epoch, staked_sui_objs) for epoch in epochs], size, repeat)
+        results[f"calculate_rewards_for_address/{size}"] = stats
+
+        rates = ExchangeRateMatrix.from_events(events)
+        stakes_by_epoch = [(epoch, staked_sui_objs) for epoch in epochs]
+        stats, _ = measure(lambda: rewards_by_epoch(client, rates, stakes_by_epoch, 0), size, repeat)
+        results[f"rewards_by_epoch/{size}"] = stats
+    return results
+
+
+def compare(results, baseline, max_regression, min_wall_s=0.05) -> List[str]:
+    """
+    Benchmarks whose wall time or peak memory grew by more than max_regression (a fraction) over the baseline.
+    Wall times below min_wall_s are too noisy to compare and are skipped.
+    """
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        for metric in ("wall_s", "peak_mb"):
+            old, new = baseline[name][metric], stats[metric]
+            if metric == "wall_s" and new < min_wall_s:
+                continue
+            if old > 0 and (new - old) / old > max_regression:
+                regressions.append(f"{name} {metric}: {old:.4f} -> {new:.4f} (+{(new - old) / old:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", help="Transactions per synthetic wallet", default=[1000, 10000, 100000])
+    parser.add_argument("--mutations-per-object", type=int, default=20)
+    parser.add_argument("--repeat", type=int, help="Timed runs per benchmark; the fastest is reported", default=3)
+    parser.add_argument("--output", type=str, help="Write results to this JSON file", default=None)
+    parser.add_argument("--save-baseline", type=str, help="Write results as the new baseline", default=None)
+    parser.add_argument("--baseline", type=str, help="Compare against this baseline and fail on regressions", default=None)
+    parser.add_argument("--max-regression", type=float, help="Allowed slowdown or memory growth over the baseline", default=0.2)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.mutations_per_object, args.repeat)
+    print(f"{'benchmark':<45} {'wall s':>10} {'us/tx':>10} {'peak MB':>10} {'retained/tx':>12}")
+    for name, stats in results.items():
+        print(f"{name:<45} {stats['wall_s']:>10.4f} {stats['us_per_tx']:>10.2f} {stats['peak_mb']:>10.2f} {stats['retained_blocks_per_tx']:>12.2f}")
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import threading
+import time
+from typing import Optional
+
+from rate_limiter import RpcError
+
+
+class DeadlineExceeded(RpcError):
+    """A Deadline ran out or was cancelled before a call could finish. Like any RpcError, cursor says where to resume."""
+    def __init__(self, message, cursor=None):
+        super().__init__(message, cursor=cursor)
+
+
+class Deadline:
+    """
+    Cooperative time budget, checked between steps instead of interrupting them, so it works on any thread and
+    under asyncio. Long scans stop at a page boundary once expired() and keep what they have; individual requests
+    may still use the grace period after it to finish. A child deadline also ends when its parent does, so
+    cancelling one run-wide deadline stops every address in flight.
+    """
+    def __init__(self, seconds: Optional[float] = None, grace: float = 0.0, parent: Optional["Deadline"] = None):
+        self.expires_at = time.monotonic() + seconds if seconds is not None else None
+        self.grace = grace
+        self.parent = parent
+        # set by a scan that stopped before the end because this deadline expired
+        self.incomplete = False
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    def remaining(self) -> Optional[float]:
+        """Seconds of budget left, None if unbounded."""
+        left = None if self.expires_at is None else self.expires_at - time.monotonic()
+        if self.parent is not None:
+            parent_left = self.parent.remaining()
+            if parent_left is not None:
+                left = parent_left if left is None else min(left, parent_left)
+        return left
+
+    def expired(self) -> bool:
+        left = self.remaining()
+        return self.cancelled or (left is not None and left <= 0)
+
+    def time_left(self) -> Optional[float]:
+        """Seconds until calls are cut off: the budget plus the grace period."""
+        left = None if self.expires_at is None else self.expires_at + self.grace - time.monotonic()
+        if self.parent is not None:
+            parent_left = self.parent.time_left()
+            if parent_left is not None:
+                left = parent_left if left is None else min(left, parent_left)
+        return left
+
+    def check(self):
+        if self.cancelled:
+            raise DeadlineExceeded("Cancelled")
+        left = self.time_left()
+        if left is not None and left <= 0:
+            raise DeadlineExceeded("Deadline exceeded")
+
+    def request_timeout(self, timeout: float) -> float:
+        """timeout for one request, shortened to the time left."""
+        self.check()
+        left = self.time_left()
+        return timeout if left is None else min(timeout, left)
@@ -1,46 +1,75 @@
+import argparse
 import csv
+import sys
+from typing import Iterable, Iterator, List
 
-# Specify the CSV file path
-csv_file_path = 'a.csv'
+import numpy as np
 
-# Initialize a dictionary to hold the sum for each epoch
-epoch_sums = {}
-
-# Open the CSV file and create a CSV reader object
+# Turns the "Estimated Reward" rows of a sui_tracker_v2.py output (run with --use-previous-epoch) into
+# per-epoch and cumulative reward rows. sui_tracker_v2.py --cumulative writes the same rows directly.
+# Rows are streamed in blocks, so memory stays bounded however large the input is.
 
 def to_float(s):
     try:
         return float(s)
     except ValueError:  # If conversion fails, return 0.0
         return 0.0
-    
-new_rows = []
-
-with open(csv_file_path, 'r') as file:
-    reader = csv.reader(file)
-    header = next(reader) # skip header
-    
-    # Iterate over each row in the CSV
-    for row in reader:
-        # The epoch columns start from index 3 onwards
-        if row[2] == 'Estimated Reward':
-            new_rows.append(row[:2] + ['Estimated Reward for Epoch'] + row[3:])
-            new_rows.append(row[:2] + ['Cumulative to Epoch'])
-            estimated_rewards = row[3:]
-            cumulative_rewards = [0 for i in range(len(estimated_rewards))]
-
-            for i in range(len(estimated_rewards)):
-                cumulative_rewards[i] = to_float(estimated_rewards[i]) + to_float(cumulative_rewards[max(0, i-1)])
-                
-            new_rows[-1].extend(cumulative_rewards)    
-            
-        # for i, value in enumerate(row[3:], start=3):
-            # Convert the value to integer and add it to the corresponding epoch sum
-            # epoch_sums[i] = epoch_sums.get(i, 0) + int(value)
-
-with open('by_epoch_output.csv', 'w') as f:
-    writer = csv.writer(f)
-    writer.writerows(new_rows)
-# Print the total sum for each epoch
-# for epoch, total_sum in epoch_sums.items():
-    # print(f'Total Sum for epoch {epoch - 3}: {total_sum}')
+
+def to_floats(values: List[str]) -> np.ndarray:
+    try:
+        return np.array([float(value) for value in values])
+    except ValueError:
+        return np.array([to_float(value) for value in values])
+
+def cumulative_sums(rewards) -> List[float]:
+    """Running total of the per-epoch rewards. cumsum adds left to right, so the totals match a plain loop."""
+    return np.cumsum(np.asarray(rewards, dtype=float)).tolist()
+
+def cumulative_rows(rows: Iterable[List[str]], block_rows=1024) -> Iterator[List]:
+    """
+    For every "Estimated Reward" row (address, name, type, then one column per epoch) yield an
+    "Estimated Reward for Epoch" row with the original values and a "Cumulative to Epoch" row.
+    Up to block_rows rows of the same width are summed as one [row, epoch] array.
+    """
+    block = []
+
+    def flush():
+        if not block:
+            return
+        widths = {len(row) for row in block}
+        if len(widths) == 1:
+            totals = np.cumsum(np.vstack([to_floats(row[3:]) for row in block]), axis=1).tolist()
+        else:
+            totals = [cumulative_sums(to_floats(row[3:])) for row in block]
+        for row, cumulative in zip(block, totals):
+            yield row[:2] + ['Estimated Reward for Epoch'] + row[3:]
+            yield row[:2] + ['Cumulative to Epoch'] + cumulative
+        block.clear()
+
+    for row in rows:
+        if len(row) > 2 and row[2] == 'Estimated Reward':
+            block.append(row)
+            if len(block) >= block_rows:
+                yield from flush()
+    yield from flush()
+
+def write_cumulative(input_filename, output_filename, block_rows=1024):
+    # a wide CSV can have very long rows
+    csv.field_size_limit(sys.maxsize)
+    with open(input_filename, 'r') as file, open(output_filename, 'w') as f:
+        reader = csv.reader(file)
+        next(reader, None) # skip header
+        writer = csv.writer(f)
+        writer.writerows(cumulative_rows(reader, block_rows))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-filename", default="a.csv")
+    parser.add_argument("--output-filename", default="by_epoch_output.csv")
+    parser.add_argument("--block-rows", type=int, help="Rows summed per vectorized block", default=1024)
+    args = parser.parse_args()
+    write_cumulative(args.input_filename, args.output_filename, args.block_rows)
+
+
+if __name__ == "__main__":
+    main()
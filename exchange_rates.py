@@ -0,0 +1,93 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from track_historical_staked_sui import SuiClient, StakedSuiRef, get_validator_ids_for_inactive_pools
+
+
+class ExchangeRateMatrix:
+    """
+    Pool token exchange rates from ValidatorEpochInfoEventV2 as a dense [validator, epoch] array.
+    Missing events read as a rate of 1, which is what calculate_rewards assumes for them.
+    """
+    def __init__(self, validators: List[str], rates: np.ndarray, pool_validators: Optional[Dict[str, str]] = None):
+        self.validators = validators
+        self.validator_index = {validator: idx for idx, validator in enumerate(validators)}
+        # the extra last row stands in for validators without any events
+        self.rates = np.vstack([rates, np.ones((1, rates.shape[1]))])
+        self.pool_validators: Dict[str, str] = dict(pool_validators) if pool_validators else {}
+
+    @classmethod
+    def from_events(cls, epoch_validator_event_dict, pool_validators: Optional[Dict[str, str]] = None) -> "ExchangeRateMatrix":
+        """Build from the {(str(epoch), validator_address): event} dict the trackers already keep."""
+        validators = sorted({validator for _, validator in epoch_validator_event_dict})
+        index = {validator: idx for idx, validator in enumerate(validators)}
+        max_epoch = max((int(epoch) for epoch, _ in epoch_validator_event_dict), default=-1)
+        rates = np.ones((len(validators), max(1, max_epoch + 1)))
+        for (epoch, validator), event in epoch_validator_event_dict.items():
+            exchange_rate = event['parsedJson']['pool_token_exchange_rate']
+            # divide as Python ints so amounts above 2**53 round the same way calculate_rewards does
+            rates[index[validator], int(epoch)] = int(exchange_rate['pool_token_amount']) / int(exchange_rate['sui_amount'])
+        return cls(validators, rates, pool_validators)
+
+    def resolve_pools(self, sui_client: SuiClient, pool_ids) -> Dict[str, str]:
+        """pool_id -> validator address. Pools missing from the persisted map are looked up, every inactive one in one batch."""
+        missing = [pool_id for pool_id in set(pool_ids) if pool_id not in self.pool_validators]
+        if missing:
+            sui_system_state = sui_client.get_sui_system_state()
+            active = {validator['stakingPoolId']: validator['suiAddress'] for validator in sui_system_state['activeValidators']}
+            inactive = [pool_id for pool_id in missing if pool_id not in active]
+            if inactive:
+                active.update(get_validator_ids_for_inactive_pools(sui_client, inactive, sui_system_state))
+            for pool_id in missing:
+                self.pool_validators[pool_id] = active[pool_id]
+        return {pool_id: self.pool_validators[pool_id] for pool_id in pool_ids}
+
+    def lookup(self, validator_rows: np.ndarray, epochs: np.ndarray) -> np.ndarray:
+        in_range = (epochs >= 0) & (epochs < self.rates.shape[1])
+        rates = self.rates[validator_rows, np.clip(epochs, 0, self.rates.shape[1] - 1)]
+        return np.where(in_range, rates, 1.0)
+
+    def estimate_rewards(self, principal: np.ndarray, validator_rows: np.ndarray, activation_epochs: np.ndarray, target_epochs: np.ndarray) -> np.ndarray:
+        """Same formula as calculate_rewards, element-wise over arrays of any (matching) shape."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            estimated = (self.lookup(validator_rows, activation_epochs) / self.lookup(validator_rows, target_epochs) - 1.0) * principal
+        return np.maximum(0, estimated)
+
+
+def rewards_by_epoch(sui_client: SuiClient, rates: ExchangeRateMatrix, stakes_by_epoch: List[Tuple[int, List[StakedSuiRef]]], start_epoch, use_previous_epoch=False) -> Dict[int, Tuple[int, float]]:
+    """
+    (staked principal, estimated rewards) at every epoch, like calling calculate_rewards_for_address per epoch,
+    but computed as one operation over an [epoch, stake] grid padded with zero-principal stakes.
+    """
+    if not stakes_by_epoch:
+        return {}
+    pool_validators = rates.resolve_pools(sui_client, {stake.pool_id for _, stakes in stakes_by_epoch for stake in stakes})
+    missing_row = len(rates.validators)
+
+    width = max(1, max(len(stakes) for _, stakes in stakes_by_epoch))
+    shape = (len(stakes_by_epoch), width)
+    principal = np.zeros(shape, dtype=np.int64)
+    validator_rows = np.full(shape, missing_row, dtype=np.int64)
+    stake_activation = np.zeros(shape, dtype=np.int64)
+    target = np.zeros(shape, dtype=np.int64)
+    for row, (epoch, stakes) in enumerate(stakes_by_epoch):
+        target[row, :] = epoch
+        for col, stake in enumerate(stakes):
+            principal[row, col] = stake.principal
+            validator_rows[row, col] = rates.validator_index.get(pool_validators[stake.pool_id], missing_row)
+            stake_activation[row, col] = stake.stake_activation_epoch
+
+    if use_previous_epoch:
+        activation = np.maximum(np.maximum(stake_activation, target - 1), 0)
+    else:
+        activation = np.maximum(stake_activation, start_epoch)
+    estimated = rates.estimate_rewards(principal.astype(np.float64), validator_rows, activation, target)
+    # cumsum adds left to right like the per-stake loop did, and the zero padding leaves the totals unchanged
+    totals = np.cumsum(estimated, axis=1)[:, -1]
+    staked = principal.sum(axis=1)
+
+    return {
+        epoch: (int(staked[row]), float(totals[row]))
+        for row, (epoch, stakes) in enumerate(stakes_by_epoch)
+    }
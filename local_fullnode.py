@@ -0,0 +1,328 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Dict, List, Optional, Tuple
+
+# Stand-in for a Sui fullnode that answers the JSON-RPC methods SuiClient uses from recorded fixtures.
+# Fixtures are JSON lines of {"method": ..., "params": [...], "result": ...}, which is what
+# SuiClient(record_path=...) writes, so a real session can be captured once and replayed offline.
+
+
+def _key(value) -> str:
+    return json.dumps(value, sort_keys=True)
+
+
+class FixtureStore:
+    def __init__(self):
+        # filter -> transactions in chain order, deduplicated by digest
+        self.transactions: Dict[str, List[dict]] = {}
+        # event query -> events in order, deduplicated by id
+        self.events: Dict[str, List[dict]] = {}
+        self.past_objects: Dict[Tuple[str, str], dict] = {}
+        self.objects: Dict[str, dict] = {}
+        self.dynamic_fields: Dict[str, List[dict]] = {}
+        self.balances: Dict[Tuple[str, str], dict] = {}
+        self.stakes: Dict[str, list] = {}
+        self.system_state: Optional[dict] = None
+        # checkpoints in order, deduplicated by sequence number, and every transaction seen by digest
+        self.checkpoints: List[dict] = []
+        self.transaction_blocks: Dict[str, dict] = {}
+        self._seen: Dict[int, set] = {}
+
+    @classmethod
+    def load(cls, *paths) -> "FixtureStore":
+        store = cls()
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        store.add(record["method"], record["params"], record["result"])
+        if not store.checkpoints:
+            store.synthesize_checkpoints()
+        return store
+
+    def _extend_unique(self, items: List[dict], new_items: List[dict], key):
+        seen = self._seen.setdefault(id(items), set())
+        for item in new_items:
+            item_key = _key(key(item))
+            if item_key not in seen:
+                seen.add(item_key)
+                items.append(item)
+
+    def add(self, method, params, result):
+        if method == "suix_queryTransactionBlocks":
+            data = result["data"]
+            if len(params) > 3 and params[3]:
+                data = list(reversed(data))
+            self._extend_unique(self.transactions.setdefault(_key(params[0]["filter"]), []), data, lambda tx: tx["digest"])
+            for transaction in data:
+                self.transaction_blocks.setdefault(transaction["digest"], transaction)
+        elif method == "sui_multiGetTransactionBlocks":
+            for transaction in result:
+                self.transaction_blocks[transaction["digest"]] = transaction
+        elif method == "sui_getCheckpoints":
+            data = result["data"]
+            if len(params) > 2 and params[2]:
+                data = list(reversed(data))
+            self._extend_unique(self.checkpoints, data, lambda checkpoint: checkpoint["sequenceNumber"])
+            self.checkpoints.sort(key=lambda checkpoint: int(checkpoint["sequenceNumber"]))
+        elif method == "suix_queryEvents":
+            self._extend_unique(self.events.setdefault(_key(params[0]), []), result["data"], lambda event: event["id"])
+        elif method == "sui_tryMultiGetPastObjects":
+            for request, response in zip(params[0], result):
+                self.past_objects[(request["objectId"], str(request["version"]))] = response
+        elif method == "sui_getObject":
+            self.objects[params[0]] = result
+        elif method == "suix_getDynamicFields":
+            self._extend_unique(self.dynamic_fields.setdefault(params[0], []), result["data"], lambda field: field["objectId"])
+        elif method == "suix_getLatestSuiSystemState":
+            self.system_state = result
+        elif method == "suix_getBalance":
+            coin_type = params[1] if len(params) > 1 and params[1] else "0x2::sui::SUI"
+            self.balances[(params[0], coin_type)] = result
+        elif method == "suix_getStakes":
+            self.stakes[params[0]] = result
+
+    def synthesize_checkpoints(self):
+        """
+        Checkpoints holding every known transaction that says which checkpoint it is in, so fixtures recorded
+        with per-address queries can also serve a checkpoint scan. Transactions keep their recorded order within one.
+        """
+        by_sequence_number: Dict[int, List[dict]] = {}
+        for transaction in self.transaction_blocks.values():
+            if transaction.get("checkpoint") is not None:
+                by_sequence_number.setdefault(int(transaction["checkpoint"]), []).append(transaction)
+        self.checkpoints = [{
+            "sequenceNumber": str(sequence_number),
+            "epoch": transactions[0].get("effects", {}).get("executedEpoch"),
+            "timestampMs": transactions[0].get("timestampMs"),
+            "transactions": [transaction["digest"] for transaction in transactions],
+        } for sequence_number, transactions in sorted(by_sequence_number.items())]
+        self._seen[id(self.checkpoints)] = {_key(checkpoint["sequenceNumber"]) for checkpoint in self.checkpoints}
+
+    def dump(self, path):
+        """Write the store back out as fixture lines (one synthetic page per query)."""
+        with open(path, "w") as f:
+            def write(method, params, result):
+                f.write(json.dumps({"method": method, "params": params, "result": result}) + "\n")
+            for filter_key, transactions in self.transactions.items():
+                write("suix_queryTransactionBlocks", [{"filter": json.loads(filter_key)}, None, len(transactions), False],
+                      {"data": transactions, "nextCursor": None, "hasNextPage": False})
+            for query_key, events in self.events.items():
+                write("suix_queryEvents", [json.loads(query_key), None, len(events), False],
+                      {"data": events, "nextCursor": None, "hasNextPage": False})
+            for (object_id, version), response in self.past_objects.items():
+                write("sui_tryMultiGetPastObjects", [[{"objectId": object_id, "version": version}], {}], [response])
+            for object_id, response in self.objects.items():
+                write("sui_getObject", [object_id, {}], response)
+            for parent, fields in self.dynamic_fields.items():
+                write("suix_getDynamicFields", [parent], {"data": fields, "nextCursor": None, "hasNextPage": False})
+            if self.system_state is not None:
+                write("suix_getLatestSuiSystemState", [], self.system_state)
+            for (owner, coin_type), response in self.balances.items():
+                write("suix_getBalance", [owner, coin_type], response)
+            for owner, response in self.stakes.items():
+                write("suix_getStakes", [owner], response)
+            if self.checkpoints:
+                write("sui_getCheckpoints", [None, len(self.checkpoints), False], {"data": self.checkpoints, "nextCursor": None, "hasNextPage": False})
+            if self.transaction_blocks:
+                write("sui_multiGetTransactionBlocks", [list(self.transaction_blocks), {}], list(self.transaction_blocks.values()))
+
+
+class RpcMethodError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def _page(items: List[Any], cursor, limit, cursor_of, positions: Dict[str, int]) -> dict:
+    start = 0
+    if cursor is not None:
+        if _key(cursor) not in positions:
+            raise RpcMethodError(-32602, f"Unknown cursor {cursor}")
+        start = positions[_key(cursor)] + 1
+    data = items[start:start + limit]
+    has_next_page = start + limit < len(items)
+    next_cursor = cursor_of(data[-1]) if data else cursor
+    return {"data": data, "nextCursor": next_cursor, "hasNextPage": has_next_page}
+
+
+class LocalFullnode:
+    """
+    Answers JSON-RPC calls from a FixtureStore. latency (seconds, plus up to latency_jitter) is added to every
+    HTTP request, error_rate is the fraction of requests that get a 429 or 503 instead of an answer, and page_size
+    caps the page length of every paginated method regardless of the limit the client asks for.
+    """
+    def __init__(self, store: FixtureStore, latency=0.0, latency_jitter=0.0, error_rate=0.0, page_size=None, seed=None):
+        self.store = store
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._positions: Dict[Tuple[str, bool], Tuple[int, Dict[str, int]]] = {}
+
+    def _limit(self, limit) -> int:
+        limit = int(limit) if limit else 50
+        return min(limit, self.page_size) if self.page_size else limit
+
+    def _paginate(self, name, items, cursor, limit, cursor_of, descending_order=False) -> dict:
+        if descending_order:
+            items = list(reversed(items))
+        # cursor -> position, rebuilt only when the list has grown
+        cache_key = (name, bool(descending_order))
+        cached = self._positions.get(cache_key)
+        if cached is None or cached[0] != len(items):
+            cached = (len(items), {_key(cursor_of(item)): idx for idx, item in enumerate(items)})
+            self._positions[cache_key] = cached
+        return _page(items, cursor, self._limit(limit), cursor_of, cached[1])
+
+    def call(self, method, params) -> Any:
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        handler = getattr(self, "rpc_" + method, None)
+        if handler is None:
+            raise RpcMethodError(-32601, f"Method not found: {method}")
+        return handler(*params)
+
+    def rpc_suix_queryTransactionBlocks(self, query, cursor=None, limit=None, descending_order=False):
+        filter_key = _key(query["filter"])
+        transactions = self.store.transactions.get(filter_key, [])
+        return self._paginate("tx" + filter_key, transactions, cursor, limit, lambda tx: tx["digest"], descending_order)
+
+    def rpc_suix_queryEvents(self, query, cursor=None, limit=None, descending_order=False):
+        query_key = _key(query)
+        events = self.store.events.get(query_key, [])
+        return self._paginate("events" + query_key, events, cursor, limit, lambda event: event["id"], descending_order)
+
+    def rpc_sui_getCheckpoints(self, cursor=None, limit=None, descending_order=False):
+        return self._paginate("checkpoints", self.store.checkpoints, cursor, limit, lambda checkpoint: checkpoint["sequenceNumber"], descending_order)
+
+    def rpc_sui_getLatestCheckpointSequenceNumber(self):
+        if not self.store.checkpoints:
+            raise RpcMethodError(-32603, "No checkpoints recorded")
+        return self.store.checkpoints[-1]["sequenceNumber"]
+
+    def rpc_sui_multiGetTransactionBlocks(self, digests, options=None):
+        if len(digests) > 50:
+            raise RpcMethodError(-32602, f"Too many digests: {len(digests)} > 50")
+        missing = [digest for digest in digests if digest not in self.store.transaction_blocks]
+        if missing:
+            raise RpcMethodError(-32602, f"Could not find the referenced transaction {missing[0]}")
+        return [self.store.transaction_blocks[digest] for digest in digests]
+
+    def rpc_sui_tryMultiGetPastObjects(self, requests, options=None):
+        return [
+            self.store.past_objects.get(
+                (request["objectId"], str(request["version"])),
+                {"status": "VersionNotFound", "details": [request["objectId"], str(request["version"])]})
+            for request in requests
+        ]
+
+    def rpc_sui_getObject(self, object_id, options=None):
+        return self.store.objects.get(object_id, {"error": {"code": "notExists", "object_id": object_id}})
+
+    def rpc_suix_getDynamicFields(self, parent_object_id, cursor=None, limit=None):
+        fields = self.store.dynamic_fields.get(parent_object_id, [])
+        return self._paginate("fields" + parent_object_id, fields, cursor, limit, lambda field: field["objectId"])
+
+    def rpc_suix_getLatestSuiSystemState(self):
+        if self.store.system_state is None:
+            raise RpcMethodError(-32603, "No system state recorded")
+        return self.store.system_state
+
+    def rpc_suix_getBalance(self, owner, coin_type=None):
+        coin_type = coin_type or "0x2::sui::SUI"
+        return self.store.balances.get((owner, coin_type), {
+            "coinType": coin_type, "coinObjectCount": 0, "totalBalance": "0", "lockedBalance": {}})
+
+    def rpc_suix_getStakes(self, owner):
+        return self.store.stakes.get(owner, [])
+
+    def handle(self, body) -> Any:
+        if isinstance(body, list):
+            return [self._handle_one(call) for call in body]
+        return self._handle_one(body)
+
+    def _handle_one(self, call) -> dict:
+        try:
+            result = self.call(call["method"], call.get("params", []))
+        except RpcMethodError as e:
+            return {"jsonrpc": "2.0", "id": call.get("id"), "error": {"code": e.code, "message": str(e)}}
+        except (TypeError, KeyError, ValueError) as e:
+            return {"jsonrpc": "2.0", "id": call.get("id"), "error": {"code": -32602, "message": f"Invalid params: {e}"}}
+        return {"jsonrpc": "2.0", "id": call.get("id"), "result": result}
+
+    def make_handler(self):
+        fullnode = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with fullnode._lock:
+                    fullnode.requests += 1
+                    fail = fullnode.random.random() < fullnode.error_rate
+                    delay = fullnode.latency + fullnode.random.random() * fullnode.latency_jitter
+                if delay:
+                    time.sleep(delay)
+                if fail:
+                    status = fullnode.random.choice([429, 503])
+                    self._send(status, b"injected error", {"Retry-After": "0"} if status == 429 else {})
+                    return
+                try:
+                    response = fullnode.handle(json.loads(body))
+                except ValueError:
+                    response = {"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": "Parse error"}}
+                self._send(200, json.dumps(response).encode(), {"Content-Type": "application/json"})
+
+            def _send(self, status, payload, headers):
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=0) -> ThreadingHTTPServer:
+        """Start serving on a background thread; the url is f"http://{host}:{server.server_port}"."""
+        server = ThreadingHTTPServer((host, port), self.make_handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fixtures", nargs="+", required=True, help="Fixture files recorded with --record-rpc")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, help="Seconds added to every request", default=0.0)
+    parser.add_argument("--latency-jitter", type=float, help="Up to this many extra seconds per request", default=0.0)
+    parser.add_argument("--error-rate", type=float, help="Fraction of requests answered with a 429 or 503", default=0.0)
+    parser.add_argument("--page-size", type=int, help="Cap on the page length of paginated methods", default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    store = FixtureStore.load(*args.fixtures)
+    fullnode = LocalFullnode(store, args.latency, args.latency_jitter, args.error_rate, args.page_size, args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), fullnode.make_handler())
+    print(f"Serving {len(store.transactions)} transaction queries and {len(store.past_objects)} past objects on http://{args.host}:{server.server_port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import argparse
+import bisect
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Dict, List, Optional
+
+# upper bounds, in milliseconds, of the RPC latency histogram buckets; the last bucket is everything slower
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+
+def _histogram_quantile(counts: List[int], quantile) -> Optional[float]:
+    """Upper bound of the bucket holding the quantile, None past the last bound."""
+    total = sum(counts)
+    if not total:
+        return None
+    target = quantile * total
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS, counts):
+        seen += count
+        if seen >= target:
+            return bound
+    return None
+
+
+class Metrics:
+    """
+    Counters and timings for one process, cheap enough to leave in hot paths: every method returns straight
+    away unless enabled. Thread safe. Worker processes send drain() to the parent, which merge()s it.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.monotonic()
+            self.rpc: Dict[str, Dict[str, Any]] = {}
+            self.stages: Dict[str, Dict[str, float]] = {}
+            self.sqlite: Dict[str, Dict[str, float]] = {}
+            self.counters: Dict[str, int] = {}
+            self.pages_per_address: Dict[str, int] = {}
+
+    def record_rpc(self, method, seconds, bytes_received=0, error=False):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.rpc.get(method)
+            if entry is None:
+                entry = self.rpc[method] = {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0,
+                                            "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+            entry["calls"] += 1
+            entry["errors"] += int(error)
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["bytes"] += bytes_received
+            entry["histogram"][bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def count_page(self, address):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.pages_per_address[address] = self.pages_per_address.get(address, 0) + 1
+
+    def _add_timing(self, table, name, wall, cpu):
+        with self._lock:
+            entry = table.get(name)
+            if entry is None:
+                entry = table[name] = {"calls": 0, "seconds": 0.0, "cpu_seconds": 0.0}
+            entry["calls"] += 1
+            entry["seconds"] += wall
+            entry["cpu_seconds"] += cpu
+
+    @contextmanager
+    def stage(self, name, table="stages"):
+        """Wall and CPU time of the block. CPU time is the calling thread's, so stages on other threads don't count."""
+        if not self.enabled:
+            yield
+            return
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self._add_timing(getattr(self, table), name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return json.loads(json.dumps({
+                "rpc": self.rpc, "stages": self.stages, "sqlite": self.sqlite,
+                "counters": self.counters, "pages_per_address": self.pages_per_address,
+            }))
+
+    def drain(self) -> Dict[str, Any]:
+        """snapshot() and reset() in one step, so a worker can hand over what it collected since the last call."""
+        with self._lock:
+            snapshot = self.snapshot()
+            self.reset()
+            return snapshot
+
+    def merge(self, snapshot: Dict[str, Any]):
+        with self._lock:
+            for method, other in snapshot["rpc"].items():
+                entry = self.rpc.setdefault(method, {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0,
+                                                     "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1)})
+                for key in ("calls", "errors", "seconds", "bytes"):
+                    entry[key] += other[key]
+                entry["max_seconds"] = max(entry["max_seconds"], other["max_seconds"])
+                entry["histogram"] = [a + b for a, b in zip(entry["histogram"], other["histogram"])]
+            for table in ("stages", "sqlite"):
+                for name, other in snapshot[table].items():
+                    entry = getattr(self, table).setdefault(name, {"calls": 0, "seconds": 0.0, "cpu_seconds": 0.0})
+                    for key in entry:
+                        entry[key] += other[key]
+            for table in ("counters", "pages_per_address"):
+                for name, value in snapshot[table].items():
+                    getattr(self, table)[name] = getattr(self, table).get(name, 0) + value
+
+    def report(self, extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """The JSON report: raw numbers plus per-method latency quantiles and overall throughput."""
+        snapshot = self.snapshot()
+        wall = time.monotonic() - self.started
+        for entry in snapshot["rpc"].values():
+            entry["mean_ms"] = 1000 * entry["seconds"] / entry["calls"] if entry["calls"] else 0.0
+            for quantile in (0.5, 0.9, 0.99):
+                entry[f"p{int(quantile * 100)}_ms"] = _histogram_quantile(entry["histogram"], quantile)
+            entry["histogram"] = {f"<={bound}ms": count for bound, count in zip(LATENCY_BUCKETS_MS, entry["histogram"])} | \
+                                 {f">{LATENCY_BUCKETS_MS[-1]}ms": entry["histogram"][-1]}
+        pages = list(snapshot["pages_per_address"].values())
+        report = {
+            "wall_seconds": wall,
+            "rpc_bytes": sum(entry["bytes"] for entry in snapshot["rpc"].values()),
+            "objects_per_second": snapshot["counters"].get("objects", 0) / wall if wall else 0.0,
+            "rows_written_per_second": snapshot["counters"].get("rows_written", 0) / wall if wall else 0.0,
+            "max_pages_per_address": max(pages, default=0),
+            **snapshot,
+        }
+        if extra:
+            report.update(extra)
+        return report
+
+
+METRICS = Metrics()
+
+
+def timed_sqlite(name):
+    """Decorator adding the time spent in a SqliteManager method to the report's "sqlite" section."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return fn(*args, **kwargs)
+            with METRICS.stage(name, table="sqlite"):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--profile", action="store_true", help="Collect per-stage timings and RPC latencies and log a summary at the end", default=False)
+    parser.add_argument("--metrics-out", type=str, help="Write the collected metrics to this file as JSON (implies --profile)", default=None)
+    parser.add_argument("--log-level", type=str, help="DEBUG shows per-stake reward details", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+
+
+def setup(args):
+    """Configure logging and switch metrics on as the parsed add_arguments() flags ask."""
+    logging.basicConfig(level=getattr(logging, args.log_level), format="%(message)s", stream=sys.stdout)
+    METRICS.reset()
+    METRICS.enabled = bool(args.profile or args.metrics_out)
+
+
+def finish(args, extra: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """Log a summary and write --metrics-out; returns the report, or None when metrics are off."""
+    if not METRICS.enabled:
+        return None
+    report = METRICS.report(extra)
+    log = logging.getLogger(__name__)
+    log.info(f"Finished in {report['wall_seconds']:.1f}s, {report['rpc_bytes'] / 2**20:.1f} MiB received, {report['objects_per_second']:.1f} objects/s")
+    for method, entry in sorted(report["rpc"].items(), key=lambda item: -item[1]["seconds"]):
+        log.info(f"  {method}: {entry['calls']} calls ({entry['errors']} failed), mean {entry['mean_ms']:.1f}ms, p90 <={entry['p90_ms']}ms, p99 <={entry['p99_ms']}ms")
+    for table in ("stages", "sqlite"):
+        for name, entry in sorted(report[table].items(), key=lambda item: -item[1]["seconds"]):
+            log.info(f"  {name}: {entry['calls']} calls, {entry['seconds']:.2f}s wall, {entry['cpu_seconds']:.2f}s cpu")
+    if args.metrics_out:
+        with open(args.metrics_out, "w") as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+    return report
@@ -0,0 +1,88 @@
+# SQL for the reads on hot paths, kept free of heavy imports so sui_cli.py lookup can use them directly.
+# sqlite_manager.check_query_plans makes sure each one still uses its index.
+
+LIQUID_AT_EPOCH_QUERY = """
+    WITH LatestVersion AS (
+        SELECT
+            object_id,
+            MAX(version) AS max_version
+        FROM
+            sui_coins_v2
+        WHERE
+            owner = ?
+            AND at_epoch <= ?
+        GROUP BY
+            object_id
+    )
+
+    SELECT
+        scv2.*
+    FROM
+        sui_coins_v2 scv2
+    JOIN
+        LatestVersion lv ON scv2.object_id = lv.object_id AND scv2.version = lv.max_version
+    WHERE
+        NOT scv2.deleted
+    ORDER BY
+        ABS(scv2.at_epoch - ?);
+    """
+
+STAKED_AT_EPOCH_QUERY = """
+    WITH LatestVersion AS (
+        SELECT
+            object_id,
+            MAX(version) AS max_version
+        FROM
+            staked_sui_v2
+        WHERE
+            owner = ?
+            AND at_epoch <= ?
+        GROUP BY
+            object_id
+    )
+
+    SELECT
+        ssv2.*
+    FROM
+        staked_sui_v2 ssv2
+    JOIN
+        LatestVersion lv ON ssv2.object_id = lv.object_id AND ssv2.version = lv.max_version
+    WHERE
+        NOT ssv2.deleted
+    ORDER BY
+        ABS(ssv2.at_epoch - ?);
+    """
+
+LIQUID_HISTORY_QUERY = """
+    SELECT object_id, version, at_epoch, balance, deleted
+    FROM sui_coins_v2
+    WHERE owner = ?
+    ORDER BY at_epoch, version
+    """
+
+STAKED_HISTORY_QUERY = """
+    SELECT object_id, version, at_epoch, owner, pool_id, principal, stake_activation_epoch, deleted
+    FROM staked_sui_v2
+    WHERE owner = ?
+    ORDER BY at_epoch, version
+    """
+
+LIQUID_BALANCE_HISTORY_QUERY = """
+    SELECT epoch, balance
+    FROM liquid_balances
+    WHERE owner = ?
+    ORDER BY epoch
+    """
+
+VALIDATOR_EPOCH_EVENTS_QUERY = """
+    SELECT epoch, validator_address, pool_token_amount, sui_amount
+    FROM validator_epoch_events
+    WHERE epoch BETWEEN ? AND ?
+    """
+
+EPOCH_REPORT_QUERY = """
+    SELECT epoch, liquid, staked, reward
+    FROM epoch_report
+    WHERE address = ?
+    ORDER BY epoch
+    """
@@ -0,0 +1,114 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+class RpcError(Exception):
+    """An RPC that failed after retries, or failed in a way retrying will not fix."""
+    def __init__(self, message, retryable=False, status_code=None, retry_after=None, cursor=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.status_code = status_code
+        self.retry_after = retry_after
+        # last cursor that was fetched successfully, set when a paginated query gives up part way through
+        self.cursor = cursor
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, which is either a number of seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0, retry_after=None) -> float:
+    """Exponential backoff with full jitter, never shorter than the server's Retry-After."""
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket shared by every request to one endpoint. Both the refill rate and the number of requests
+    allowed in flight grow additively while requests succeed quickly, and are cut multiplicatively on a 429,
+    a connection failure or latency above latency_target (AIMD). Thread safe.
+    """
+    def __init__(self, rate=20.0, min_rate=1.0, max_rate=200.0, concurrency=8, max_concurrency=64,
+                 latency_target=5.0, increase=1.0, decrease=0.5):
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.rate = min(float(rate), self.max_rate)
+        self.concurrency = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.increase = increase
+        self.decrease = decrease
+
+        self.tokens = self.rate
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0.0
+        self.throttled = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.in_flight >= int(self.concurrency):
+                    wait = None
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                self._cond.wait(wait)
+
+    def release(self, latency, throttled=False, retry_after=None):
+        with self._cond:
+            now = time.monotonic()
+            self.in_flight = max(0, self.in_flight - 1)
+            if throttled or latency > self.latency_target:
+                if throttled:
+                    self.throttled += 1
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+                # cut at most once per round trip so one burst of failures does not collapse the rate
+                if now - self.last_decrease > max(latency, 1.0 / self.rate):
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self.concurrency = max(1.0, self.concurrency * self.decrease)
+                    self.tokens = min(self.tokens, self.rate)
+                    self.last_decrease = now
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+                self.concurrency = min(self.max_concurrency, self.concurrency + self.increase / self.concurrency)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "rate": self.rate,
+                "concurrency": int(self.concurrency),
+                "in_flight": self.in_flight,
+                "throttled": self.throttled,
+            }
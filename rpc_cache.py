@@ -0,0 +1,203 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Responses that can change are kept for at most this many seconds; anything not listed here or in
+# cache_ttl's immutable cases is never cached.
+DEFAULT_TTLS = {
+    "suix_getLatestSuiSystemState": 300,
+    "suix_getDynamicFields": 3600,
+    "sui_getObject": 3600,
+}
+
+# one object version of a sui_tryMultiGetPastObjects call, cached on its own so chunks can be regrouped freely
+PAST_OBJECT = "sui_tryGetPastObject"
+
+
+def cache_key(method, params) -> str:
+    return hashlib.sha256(json.dumps([method, params], sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def cache_ttl(method, params, result, ttls=DEFAULT_TTLS) -> Tuple[bool, Optional[float]]:
+    """
+    (cacheable, ttl in seconds or None for forever) for a successful call.
+    A page of an ascending query is final once there is a page after it; the last page can still grow.
+    """
+    if method == PAST_OBJECT:
+        return result.get("status") in ("VersionFound", "ObjectDeleted"), None
+    if method in ("suix_queryTransactionBlocks", "suix_queryEvents"):
+        descending_order = len(params) > 3 and params[3]
+        return bool(result.get("hasNextPage")) and not descending_order, None
+    if method == "sui_getCheckpoints":
+        descending_order = len(params) > 2 and params[2]
+        return bool(result.get("hasNextPage")) and not descending_order, None
+    if method == "sui_multiGetTransactionBlocks":
+        # executed transactions never change; a digest the node doesn't know yet comes back as an error entry
+        return all(isinstance(transaction, dict) and "error" not in transaction for transaction in result), None
+    if method in ttls:
+        return True, ttls[method]
+    return False, None
+
+
+class RpcCache:
+    """
+    Two-tier cache of RPC results: a byte-bounded LRU in memory in front of a sqlite file on disk. Both tiers
+    evict least recently used entries once over their size limit. Thread safe.
+    """
+    def __init__(self, path=None, max_memory_bytes=64 * 2**20, max_disk_bytes=1024 * 2**20, ttls=DEFAULT_TTLS):
+        self.path = path
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.ttls = ttls
+        self.memory: "OrderedDict[str, Tuple[bytes, Optional[float]]]" = OrderedDict()
+        self.memory_bytes = 0
+        self.metrics = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "bytes_served": 0}
+        self._lock = threading.RLock()
+
+        self.conn = None
+        self.disk_bytes = 0
+        if path:
+            # several processes can share one file (sui_tracker_v2.py --workers), so wait out their writes
+            self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS rpc_cache (
+                        key TEXT NOT NULL PRIMARY KEY,
+                        method TEXT NOT NULL,
+                        value BLOB NOT NULL,
+                        size INTEGER NOT NULL,
+                        expires_at REAL,
+                        last_used REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_rpc_cache_last_used ON rpc_cache (last_used)")
+            self.conn.commit()
+            self.disk_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM rpc_cache").fetchone()[0]
+
+    def handles(self, method) -> bool:
+        """Whether results of method can ever be cached, so lookups for other methods can be skipped."""
+        return method in (PAST_OBJECT, "suix_queryTransactionBlocks", "suix_queryEvents", "sui_getCheckpoints",
+                          "sui_multiGetTransactionBlocks") or method in self.ttls
+
+    def get(self, method, params) -> Optional[Any]:
+        return self.get_many([(method, params)])[0]
+
+    def get_many(self, calls: List[Tuple[str, Any]]) -> List[Optional[Any]]:
+        """Cached results for (method, params) calls, None for every miss."""
+        now = time.time()
+        keys = [cache_key(method, params) for method, params in calls]
+        values: Dict[str, bytes] = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                entry = self.memory.get(key)
+                if entry is not None and (entry[1] is None or entry[1] > now):
+                    self.memory.move_to_end(key)
+                    values[key] = entry[0]
+                    self.metrics["memory_hits"] += 1
+                elif key not in values:
+                    missing.append(key)
+            missing = list(dict.fromkeys(missing))
+            if missing and self.conn is not None:
+                found = self._disk_get(missing, now)
+                for key, (value, expires_at) in found.items():
+                    values[key] = value
+                    self._memory_put(key, value, expires_at)
+                self.metrics["disk_hits"] += len(found)
+                missing = [key for key in missing if key not in found]
+            self.metrics["misses"] += len(missing)
+            self.metrics["bytes_served"] += sum(len(values[key]) for key in keys if key in values)
+        return [json.loads(values[key]) if key in values else None for key in keys]
+
+    def put(self, method, params, result):
+        self.put_many([(method, params, result)])
+
+    def put_many(self, items: Iterable[Tuple[str, Any, Any]]):
+        """Store the results that cache_ttl allows; everything else is ignored."""
+        now = time.time()
+        rows = []
+        with self._lock:
+            for method, params, result in items:
+                cacheable, ttl = cache_ttl(method, params, result, self.ttls)
+                if not cacheable:
+                    continue
+                key = cache_key(method, params)
+                value = json.dumps(result, separators=(",", ":")).encode()
+                expires_at = now + ttl if ttl is not None else None
+                self._memory_put(key, value, expires_at)
+                rows.append((key, method, value, expires_at))
+            self.metrics["stores"] += len(rows)
+            if rows and self.conn is not None:
+                self._disk_put(rows, now)
+
+    def _memory_put(self, key, value: bytes, expires_at):
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key)[0])
+        if len(value) > self.max_memory_bytes:
+            return
+        self.memory[key] = (value, expires_at)
+        self.memory_bytes += len(value)
+        while self.memory_bytes > self.max_memory_bytes:
+            _, (evicted, _) = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+            self.metrics["evictions"] += 1
+
+    def _disk_get(self, keys: List[str], now) -> Dict[str, Tuple[bytes, Optional[float]]]:
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT key, value, expires_at FROM rpc_cache WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            for key, value, expires_at in rows:
+                if expires_at is None or expires_at > now:
+                    found[key] = (zlib.decompress(value), expires_at)
+        if found:
+            self.conn.executemany("UPDATE rpc_cache SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self.conn.commit()
+        return found
+
+    def _disk_put(self, rows, now):
+        cursor = self.conn.cursor()
+        for key, method, value, expires_at in rows:
+            compressed = zlib.compress(value, 1)
+            old = cursor.execute("SELECT size FROM rpc_cache WHERE key = ?", (key,)).fetchone()
+            if old:
+                self.disk_bytes -= old[0]
+            cursor.execute("INSERT OR REPLACE INTO rpc_cache (key, method, value, size, expires_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                           (key, method, compressed, len(compressed), expires_at, now))
+            self.disk_bytes += len(compressed)
+        if self.disk_bytes > self.max_disk_bytes:
+            # expired entries go first, then the least recently used until back under 90% of the limit
+            cursor.execute("DELETE FROM rpc_cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+            self.metrics["evictions"] += cursor.rowcount
+            self.disk_bytes = cursor.execute("SELECT COALESCE(SUM(size), 0) FROM rpc_cache").fetchone()[0]
+            target = self.max_disk_bytes * 0.9
+            for key, size in cursor.execute("SELECT key, size FROM rpc_cache ORDER BY last_used").fetchall():
+                if self.disk_bytes <= target:
+                    break
+                cursor.execute("DELETE FROM rpc_cache WHERE key = ?", (key,))
+                self.disk_bytes -= size
+                self.metrics["evictions"] += 1
+        self.conn.commit()
+        cursor.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.metrics["memory_hits"] + self.metrics["disk_hits"] + self.metrics["misses"]
+            return {
+                **self.metrics,
+                "hit_ratio": (lookups - self.metrics["misses"]) / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_bytes": self.disk_bytes,
+            }
+
+    def close(self):
+        with self._lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -1,6 +1,8 @@
-import subprocess
 import argparse
 
+import metrics
+import sui_cli
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -8,25 +10,18 @@ def main():
     parser.add_argument("--input-filename", type=str, help="Input filename", default="input_addresses.csv")
     parser.add_argument("--end-epoch", type=int, help="End epoch", default=365)
     parser.add_argument("--output-filename", default="output.csv")
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
 
-    script1 = 'v3.py'
-    args1 = ['--input-filename', args.input_filename, '--rpc-url', args.rpc_url]
-    command1 = ['python3', script1] + args1
-    script2 = 'sui_tracker_v2.py'
-    args2 = ['--end-epoch', str(args.end_epoch), '--input-filename', args.input_filename, '--rpc-url', args.rpc_url]
-    command2 = ['python3', script2] + args2
-
-    # Run the first script
-    print(f"Running {script1}...")
-    subprocess.run(command1, check=True)
-
-    # After the first script finishes, run the second script
-    print(f"Running {script2}...")
-    subprocess.run(command2, check=True)
-
-    print("Both scripts have finished executing.")
+    # ingest and report in this process, sharing the client and db; see `python3 sui_cli.py run --help` for every option
+    argv = ['run', '--input-filename', args.input_filename, '--rpc-url', args.rpc_url, '--end-epoch', str(args.end_epoch),
+            '--output-filename', args.output_filename, '--log-level', args.log_level]
+    if args.profile:
+        argv.append('--profile')
+    if args.metrics_out:
+        argv += ['--metrics-out', args.metrics_out]
+    sui_cli.main(argv)
 
 
 if __name__ == "__main__":
@@ -1,42 +1,37 @@
+import json
+import logging
+import pathlib
+import queue
 import sqlite3
+import threading
+import time
+from functools import lru_cache
 from sqlite3 import Connection
-from typing import List, Union
+from typing import List, Union, Dict, Optional, Set, Tuple
 
-from track_historical_staked_sui import StakedSuiRef, SuiCoinRef, DeletedObjectRef
+from metrics import METRICS, timed_sqlite
+from queries import LIQUID_AT_EPOCH_QUERY, STAKED_AT_EPOCH_QUERY, LIQUID_HISTORY_QUERY, STAKED_HISTORY_QUERY, LIQUID_BALANCE_HISTORY_QUERY, \
+    VALIDATOR_EPOCH_EVENTS_QUERY, EPOCH_REPORT_QUERY
+from track_historical_staked_sui import StakedSuiRef, SuiCoinRef, DeletedObjectRef, SuiClient, VALIDATOR_EPOCH_INFO_EVENT_TYPE, get_new_pool_validators
 
-class SqliteManager:
-    def __init__(self, version="v1", purge=True):
-        if version == "v1":
-            self.init_v1(purge)
-        else:
-            self.init_v2(purge)
-
-    def init_v2(self, purge=True):
-        self.conn = sqlite3.connect("sui_data.db", check_same_thread=False)
-        cursor = self.conn.cursor()
-
-        if purge:
-            cursor.execute("DROP TABLE IF EXISTS staked_sui_v2")
-            cursor.execute("DROP TABLE IF EXISTS sui_coins_v2")
-        self.conn.commit()            
-
-        cursor.execute("""
+# Ordered schema migrations for the v2 tables. Each entry is applied once, in order, and recorded in
+# schema_version; add new entries to the end rather than editing old ones.
+MIGRATIONS_V2 = [
+    (1, [
+        """
         CREATE TABLE IF NOT EXISTS staked_sui_v2 (
-                object_id TEXT NOT NULL,               
+                object_id TEXT NOT NULL,
                 version INTEGER NOT NULL,
                 at_epoch INTEGER NOT NULL,
                 owner TEXT NOT NULL,
                 pool_id TEXT,
                 principal INTEGER,
-                stake_activation_epoch INTEGER,     
-                deleted BOOLEAN NOT NULL,           
+                stake_activation_epoch INTEGER,
+                deleted BOOLEAN NOT NULL,
                 PRIMARY KEY (object_id, version)
-
         )
-        """)
-        self.conn.commit()
-
-        cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS sui_coins_v2 (
                 object_id TEXT NOT NULL,
                 version INTEGER NOT NULL,
@@ -46,12 +41,370 @@ class SqliteManager:
                 deleted BOOLEAN NOT NULL,
                 PRIMARY KEY (object_id, version)
         )
-        """)
+        """,
+    ]),
+    (2, [
+        "CREATE INDEX IF NOT EXISTS idx_staked_sui_v2_owner_epoch ON staked_sui_v2 (owner, at_epoch, object_id, version)",
+        "CREATE INDEX IF NOT EXISTS idx_sui_coins_v2_owner_epoch ON sui_coins_v2 (owner, at_epoch, object_id, version)",
+    ]),
+    (3, [
+        """
+        CREATE TABLE IF NOT EXISTS ingest_cursors (
+                address TEXT NOT NULL,
+                filter_type TEXT NOT NULL,
+                next_cursor TEXT,
+                PRIMARY KEY (address, filter_type)
+        )
+        """,
+    ]),
+    (4, [
+        # ValidatorEpochInfoEventV2 does not carry the pool id; it is filled in from the system state when known
+        """
+        CREATE TABLE IF NOT EXISTS validator_epoch_events (
+                epoch INTEGER NOT NULL,
+                validator_address TEXT NOT NULL,
+                pool_id TEXT,
+                pool_token_amount TEXT NOT NULL,
+                sui_amount TEXT NOT NULL,
+                tx_digest TEXT NOT NULL,
+                event_seq TEXT NOT NULL,
+                parsed_json TEXT NOT NULL,
+                PRIMARY KEY (epoch, validator_address)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_validator_epoch_events_pool_epoch ON validator_epoch_events (pool_id, epoch)",
+        """
+        CREATE TABLE IF NOT EXISTS event_cursors (
+                event_type TEXT NOT NULL PRIMARY KEY,
+                next_cursor TEXT NOT NULL
+        )
+        """,
+    ]),
+    (5, [
+        # pools map 1:1 to validators and the mapping never changes, so rows are only ever added
+        """
+        CREATE TABLE IF NOT EXISTS pool_validators (
+                pool_id TEXT NOT NULL PRIMARY KEY,
+                validator_address TEXT NOT NULL
+        )
+        """,
+    ]),
+    (6, [
+        # liquid SUI from balance changes: net change in each epoch and the running balance at its end
+        """
+        CREATE TABLE IF NOT EXISTS liquid_balances (
+                owner TEXT NOT NULL,
+                epoch INTEGER NOT NULL,
+                delta INTEGER NOT NULL,
+                balance INTEGER NOT NULL,
+                PRIMARY KEY (owner, epoch)
+        )
+        """,
+    ]),
+    (7, [
+        # values of closed epochs never change, so watch.py computes each (address, epoch) once and keeps it here
+        """
+        CREATE TABLE IF NOT EXISTS epoch_report (
+                address TEXT NOT NULL,
+                epoch INTEGER NOT NULL,
+                liquid REAL NOT NULL,
+                staked REAL NOT NULL,
+                reward REAL NOT NULL,
+                PRIMARY KEY (address, epoch)
+        )
+        """,
+    ]),
+    (8, [
+        # last checkpoint whose transactions a checkpoint scan (v3.py --ingest-mode checkpoints) has stored
+        """
+        CREATE TABLE IF NOT EXISTS checkpoint_watermarks (
+                scan TEXT NOT NULL PRIMARY KEY,
+                checkpoint INTEGER NOT NULL
+        )
+        """,
+    ]),
+]
+
+# query -> (sample params, index it must use, table names and aliases that must never be scanned)
+HOT_QUERIES = {
+    "liquid_at_epoch": (LIQUID_AT_EPOCH_QUERY, ("0x0", 0, 0), "idx_sui_coins_v2_owner_epoch", ("sui_coins_v2", "scv2")),
+    "staked_at_epoch": (STAKED_AT_EPOCH_QUERY, ("0x0", 0, 0), "idx_staked_sui_v2_owner_epoch", ("staked_sui_v2", "ssv2")),
+    "liquid_history": (LIQUID_HISTORY_QUERY, ("0x0",), "idx_sui_coins_v2_owner_epoch", ("sui_coins_v2",)),
+    "staked_history": (STAKED_HISTORY_QUERY, ("0x0",), "idx_staked_sui_v2_owner_epoch", ("staked_sui_v2",)),
+    "liquid_balance_history": (LIQUID_BALANCE_HISTORY_QUERY, ("0x0",), "sqlite_autoindex_liquid_balances_1", ("liquid_balances",)),
+    "validator_epoch_events": (VALIDATOR_EPOCH_EVENTS_QUERY, (0, 0), "sqlite_autoindex_validator_epoch_events_1", ("validator_epoch_events",)),
+    "epoch_report": (EPOCH_REPORT_QUERY, ("0x0",), "sqlite_autoindex_epoch_report_1", ("epoch_report",)),
+}
+
+# WAL lets reports read while ingestion writes, and with it synchronous=NORMAL only syncs at checkpoints: a crash
+# can lose the last few commits but never corrupts the db, and rows always commit together with their cursors
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+)
+
+log = logging.getLogger(__name__)
+
+def connect(db_path, pragmas=CONNECTION_PRAGMAS) -> Connection:
+    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    for pragma in pragmas:
+        conn.execute(pragma)
+    return conn
+
+@lru_cache(maxsize=None)
+def reader_connection(db_path) -> Connection:
+    """One read-only connection to db_path for the whole process, which reads alongside a writer in WAL mode."""
+    # as_uri() escapes characters such as "?" and "#" that would otherwise end the path part of the URI
+    return sqlite3.connect(pathlib.Path(db_path).resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False, timeout=30)
+
+def get_schema_version(conn: Connection) -> int:
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    version = cursor.fetchone()[0]
+    cursor.close()
+    return version or 0
+
+def migrate(conn: Connection, migrations=MIGRATIONS_V2) -> int:
+    """Apply every migration newer than the recorded schema version, each in its own transaction."""
+    current = get_schema_version(conn)
+    conn.commit()
+    for version, statements in migrations:
+        if version <= current:
+            continue
+        cursor = conn.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        current = version
+    return current
+
+def scanned_table(detail) -> Optional[str]:
+    """The table a query plan line scans in full, if any. SQLite before 3.36 writes "SCAN TABLE x", later "SCAN x"."""
+    words = detail.split(" ")
+    if words[0] != "SCAN" or len(words) < 2:
+        return None
+    if words[1] == "TABLE" and len(words) > 2:
+        return words[2]
+    return words[1]
+
+def check_query_plans(conn: Connection, hot_queries=HOT_QUERIES):
+    """Raise if any hot query no longer searches through its index, e.g. after a schema or query change."""
+    cursor = conn.cursor()
+    for name, (query, params, index, tables) in hot_queries.items():
+        cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+        plan = [row[3] for row in cursor.fetchall()]
+        scans = [detail for detail in plan if scanned_table(detail) in tables]
+        if scans or not any(index in detail for detail in plan):
+            cursor.close()
+            raise Exception(f"Query {name} does not use index {index}: {plan}")
+    cursor.close()
+
+# The writes of ingestion, without commit, so SqliteManager and SqliteWriter share them. Each returns the rows written.
+
+def write_staked_sui_v2(cursor, items: List[Union[StakedSuiRef, DeletedObjectRef]]) -> int:
+    data = []
+    for item in items:
+        if isinstance(item, StakedSuiRef):
+            data.append((item.object_id, item.version, item.at_epoch, item.owner, item.pool_id, item.principal, item.stake_activation_epoch, False))
+        else:
+            data.append((item.object_id, item.version, item.at_epoch, item.owner, None, None, None, True))
+    cursor.executemany("""
+        INSERT OR REPLACE INTO staked_sui_v2 (object_id, version, at_epoch, owner, pool_id, principal, stake_activation_epoch, deleted)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, data)
+    return len(data)
+
+def write_sui_coin_v2(cursor, items: List[Union[SuiCoinRef, DeletedObjectRef]]) -> int:
+    data = []
+    for item in items:
+        if isinstance(item, SuiCoinRef):
+            data.append((item.object_id, item.version, item.at_epoch, item.owner, item.balance, False))
+        else:
+            data.append((item.object_id, item.version, item.at_epoch, item.owner, None, True))
+    cursor.executemany("""
+        INSERT OR REPLACE INTO sui_coins_v2 (object_id, version, at_epoch, owner, balance, deleted)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, data)
+    return len(data)
+
+def write_ingest_cursors(cursor, address, cursors: Dict[str, Optional[str]]) -> int:
+    data = [(address, filter_type, next_cursor) for filter_type, next_cursor in cursors.items() if next_cursor is not None]
+    cursor.executemany("""
+        INSERT OR REPLACE INTO ingest_cursors (address, filter_type, next_cursor)
+        VALUES (?, ?, ?)
+    """, data)
+    return len(data)
+
+def write_liquid_balance_deltas(cursor, owner, deltas: Dict[int, int], cursors: Dict[str, Optional[str]]) -> int:
+    """
+    Add per-epoch balance changes for owner, recompute the running balance from the earliest epoch touched, and
+    move the cursors past them: deltas are not idempotent, so they must never commit without the cursors.
+    """
+    cursor.executemany("""
+        INSERT INTO liquid_balances (owner, epoch, delta, balance) VALUES (?, ?, ?, 0)
+        ON CONFLICT (owner, epoch) DO UPDATE SET delta = delta + excluded.delta
+    """, [(owner, epoch, delta) for epoch, delta in deltas.items()])
+    if deltas:
+        cursor.execute("""
+            UPDATE liquid_balances
+            SET balance = (SELECT SUM(earlier.delta) FROM liquid_balances earlier
+                           WHERE earlier.owner = liquid_balances.owner AND earlier.epoch <= liquid_balances.epoch)
+            WHERE owner = ? AND epoch >= ?
+        """, (owner, min(deltas)))
+    return len(deltas) + write_ingest_cursors(cursor, owner, cursors)
+
+def write_checkpoint_watermark(cursor, checkpoint: int, scan="objects") -> int:
+    cursor.execute("INSERT OR REPLACE INTO checkpoint_watermarks (scan, checkpoint) VALUES (?, ?)", (scan, checkpoint))
+    return 1
+
+class SqliteWriter:
+    """
+    Takes the writes of an ingest run off the threads fetching data: every write method queues its rows and returns,
+    and one thread with its own connection commits whatever has queued up, from any number of addresses, as a
+    single transaction of up to batch_rows rows. Writes commit in the order they were queued, each in the same
+    transaction as the ones queued after it or an earlier one, so cursors never get ahead of their rows. A failed
+    transaction is rolled back, nothing more is written, and the error is raised by the next call.
+    """
+    def __init__(self, db_path, batch_rows=50000, max_queued=256):
+        self.db_path = db_path
+        self.batch_rows = batch_rows
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self.error: Optional[BaseException] = None
+        self.rows = 0
+        self.transactions = 0
+        self.seconds = 0.0
+        self.thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def _run(self):
+        conn = None
+        try:
+            conn = connect(self.db_path)
+        except Exception as e:
+            # keep draining the queue so flush() and close() still return, and raise this
+            self.error = e
+        try:
+            stop = False
+            while not stop:
+                batch, rows, flushed = [], 0, []
+                item = self.queue.get()
+                while True:
+                    if item is None:
+                        stop = True
+                    elif isinstance(item, threading.Event):
+                        flushed.append(item)
+                    else:
+                        batch.append(item)
+                        rows += item[2]
+                    if stop or rows >= self.batch_rows:
+                        break
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if batch and self.error is None:
+                    self._commit(conn, batch)
+                for event in flushed:
+                    event.set()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _commit(self, conn: Connection, batch):
+        started = time.perf_counter()
+        cursor = conn.cursor()
+        try:
+            with METRICS.stage("write.writer_transaction", table="sqlite"):
+                rows = sum(write(cursor, *args) for write, args, _ in batch)
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            log.error(f"Rolled back a transaction of {len(batch)} writes: {e}")
+            self.error = e
+            return
+        finally:
+            cursor.close()
+        self.rows += rows
+        self.transactions += 1
+        self.seconds += time.perf_counter() - started
+        METRICS.count("rows_written", rows)
+
+    def insert_batch_staked_sui_v2(self, items: List[Union[StakedSuiRef, DeletedObjectRef]]):
+        self._put((write_staked_sui_v2, (items,), len(items)))
+
+    def insert_batch_sui_coin_v2(self, items: List[Union[SuiCoinRef, DeletedObjectRef]]):
+        self._put((write_sui_coin_v2, (items,), len(items)))
+
+    def set_ingest_cursors(self, address, cursors: Dict[str, Optional[str]]):
+        self._put((write_ingest_cursors, (address, cursors), len(cursors)))
+
+    def apply_liquid_balance_deltas(self, owner, deltas: Dict[int, int], cursors: Dict[str, Optional[str]]):
+        self._put((write_liquid_balance_deltas, (owner, deltas, cursors), len(deltas) + len(cursors)))
+
+    def set_checkpoint_watermark(self, checkpoint: int, scan="objects"):
+        self._put((write_checkpoint_watermark, (checkpoint, scan), 1))
+
+    def flush(self):
+        """Wait until everything queued so far is committed."""
+        event = threading.Event()
+        self._put(event)
+        event.wait()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Commit everything queued and stop the thread."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.transactions:
+            log.info(f"Wrote {self.rows} rows in {self.transactions} transactions, {self.rows / self.seconds if self.seconds else 0.0:.0f} rows/s")
+        if self.error is not None:
+            raise self.error
+
+class SqliteManager:
+    def __init__(self, version="v1", purge=True, db_path="sui_data.db"):
+        self.db_path = db_path
+        if version == "v1":
+            self.init_v1(purge)
+        else:
+            self.init_v2(purge)
+
+    def init_v2(self, purge=True):
+        # validator epoch events are chain-wide rather than per address, so a purge keeps them
+        self.conn = connect(self.db_path)
+        cursor = self.conn.cursor()
+
+        if purge:
+            cursor.execute("DROP TABLE IF EXISTS staked_sui_v2")
+            cursor.execute("DROP TABLE IF EXISTS sui_coins_v2")
+            cursor.execute("DROP TABLE IF EXISTS ingest_cursors")
+            cursor.execute("DROP TABLE IF EXISTS liquid_balances")
+            cursor.execute("DROP TABLE IF EXISTS epoch_report")
+            cursor.execute("DROP TABLE IF EXISTS checkpoint_watermarks")
+            cursor.execute("DROP TABLE IF EXISTS schema_version")
         self.conn.commit()
         cursor.close()
 
+        migrate(self.conn)
+        check_query_plans(self.conn)
+
     def init_v1(self, purge=True):
-        self.conn = sqlite3.connect("sui_data.db", check_same_thread=False)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
         cursor = self.conn.cursor()
 
         if purge:
@@ -87,37 +440,211 @@ class SqliteManager:
         self.conn.commit()
         cursor.close()
 
-    def insert_batch_staked_sui_v2(self, items: List[Union[StakedSuiRef, DeletedObjectRef]]):
+    @timed_sqlite("read.get_ingest_cursors")
+    def get_ingest_cursors(self, address) -> Dict[str, Optional[str]]:
         cursor = self.conn.cursor()
-        data = []
-        for item in items:
-            if isinstance(item, StakedSuiRef):
-                data.append((item.object_id, item.version, item.at_epoch, item.owner, item.pool_id, item.principal, item.stake_activation_epoch, False))
-            else:
-                data.append((item.object_id, item.version, item.at_epoch, item.owner, None, None, None, True))        
+        cursor.execute("SELECT filter_type, next_cursor FROM ingest_cursors WHERE address = ?", (address,))
+        cursors = {filter_type: next_cursor for filter_type, next_cursor in cursor.fetchall()}
+        cursor.close()
+        return cursors
 
-        cursor.executemany("""
-            INSERT OR REPLACE INTO staked_sui_v2 (object_id, version, at_epoch, owner, pool_id, principal, stake_activation_epoch, deleted)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, data)
+    @timed_sqlite("write.set_ingest_cursors")
+    def set_ingest_cursors(self, address, cursors: Dict[str, Optional[str]]):
+        cursor = self.conn.cursor()
+        write_ingest_cursors(cursor, address, cursors)
+        self.conn.commit()
+        cursor.close()
+
+    @timed_sqlite("read.get_object_ids_for_owner")
+    def get_object_ids_for_owner(self, table, owner) -> Set[str]:
+        """Object ids already recorded for owner in staked_sui_v2 or sui_coins_v2."""
+        if table not in ("staked_sui_v2", "sui_coins_v2"):
+            raise Exception(f"Unknown table {table}")
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT DISTINCT object_id FROM {table} WHERE owner = ?", (owner,))
+        object_ids = {row[0] for row in cursor.fetchall()}
+        cursor.close()
+        return object_ids
+
+    @timed_sqlite("write.apply_liquid_balance_deltas")
+    def apply_liquid_balance_deltas(self, owner, deltas: Dict[int, int], cursors: Dict[str, Optional[str]]):
+        """write_liquid_balance_deltas in a transaction of its own."""
+        cursor = self.conn.cursor()
+        try:
+            write_liquid_balance_deltas(cursor, owner, deltas, cursors)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    @timed_sqlite("read.get_liquid_balances")
+    def get_liquid_balances(self, owner) -> Dict[int, int]:
+        """epoch -> liquid SUI at the end of the epoch, for the epochs in which it changed."""
+        cursor = self.conn.cursor()
+        cursor.execute(LIQUID_BALANCE_HISTORY_QUERY, (owner,))
+        balances = dict(cursor.fetchall())
+        cursor.close()
+        return balances
 
+    @timed_sqlite("read.get_epoch_report")
+    def get_epoch_report(self, address) -> Dict[int, Tuple[float, float, float]]:
+        """epoch -> (liquid SUI, staked SUI, estimated reward) for the epochs already reported for address."""
+        cursor = self.conn.cursor()
+        cursor.execute(EPOCH_REPORT_QUERY, (address,))
+        report = {epoch: (liquid, staked, reward) for epoch, liquid, staked, reward in cursor.fetchall()}
+        cursor.close()
+        return report
+
+    @timed_sqlite("write.insert_epoch_report")
+    def insert_epoch_report(self, address, data: Dict[int, Tuple[float, float, float]]):
+        cursor = self.conn.cursor()
+        try:
+            cursor.executemany("""
+                INSERT OR REPLACE INTO epoch_report (address, epoch, liquid, staked, reward)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(address, epoch, liquid, staked, reward) for epoch, (liquid, staked, reward) in data.items()])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    @timed_sqlite("read.get_checkpoint_watermark")
+    def get_checkpoint_watermark(self, scan="objects") -> Optional[int]:
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT checkpoint FROM checkpoint_watermarks WHERE scan = ?", (scan,))
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0] if row else None
+
+    @timed_sqlite("write.set_checkpoint_watermark")
+    def set_checkpoint_watermark(self, checkpoint: int, scan="objects"):
+        cursor = self.conn.cursor()
+        write_checkpoint_watermark(cursor, checkpoint, scan)
         self.conn.commit()
         cursor.close()
 
-    def insert_batch_sui_coin_v2(self, items: List[Union[SuiCoinRef, DeletedObjectRef]]):
+    @timed_sqlite("read.get_event_cursor")
+    def get_event_cursor(self, event_type=VALIDATOR_EPOCH_INFO_EVENT_TYPE) -> Optional[dict]:
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT next_cursor FROM event_cursors WHERE event_type = ?", (event_type,))
+        row = cursor.fetchone()
+        cursor.close()
+        return json.loads(row[0]) if row else None
+
+    @timed_sqlite("read.get_max_event_epoch")
+    def get_max_event_epoch(self) -> Optional[int]:
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT MAX(epoch) FROM validator_epoch_events")
+        epoch = cursor.fetchone()[0]
+        cursor.close()
+        return epoch
+
+    @timed_sqlite("write.insert_validator_epoch_events")
+    def insert_validator_epoch_events(self, events: List[dict], pool_ids: Dict[str, str], next_cursor: Optional[dict]):
+        """Insert a page of events and move the event cursor past it in the same transaction."""
         cursor = self.conn.cursor()
         data = []
-        for item in items:
-            if isinstance(item, SuiCoinRef):
-                data.append((item.object_id, item.version, item.at_epoch, item.owner, item.balance, False))
-            else:
-                data.append((item.object_id, item.version, item.at_epoch, item.owner, None, True))
+        for event in events:
+            parsed_json = event['parsedJson']
+            exchange_rate = parsed_json['pool_token_exchange_rate']
+            data.append((
+                int(parsed_json['epoch']),
+                parsed_json['validator_address'],
+                pool_ids.get(parsed_json['validator_address']),
+                str(exchange_rate['pool_token_amount']),
+                str(exchange_rate['sui_amount']),
+                event['id']['txDigest'],
+                str(event['id']['eventSeq']),
+                json.dumps(parsed_json, sort_keys=True),
+            ))
+        try:
+            cursor.executemany("""
+                INSERT OR REPLACE INTO validator_epoch_events (epoch, validator_address, pool_id, pool_token_amount, sui_amount, tx_digest, event_seq, parsed_json)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, data)
+            if next_cursor is not None:
+                cursor.execute("INSERT OR REPLACE INTO event_cursors (event_type, next_cursor) VALUES (?, ?)",
+                               (VALIDATOR_EPOCH_INFO_EVENT_TYPE, json.dumps(next_cursor, sort_keys=True)))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
 
-        cursor.executemany("""
-            INSERT OR REPLACE INTO sui_coins_v2 (object_id, version, at_epoch, owner, balance, deleted)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, data)
+    def sync_validator_epoch_events(self, sui_client: SuiClient) -> int:
+        """Fetch and store the events emitted since the stored cursor, one page per transaction. Returns how many were new."""
+        active = {validator['suiAddress']: validator['stakingPoolId'] for validator in sui_client.get_sui_system_state()['activeValidators']}
+        count = 0
+        for events, next_cursor in sui_client.iter_validator_epoch_info_event_pages(self.get_event_cursor()):
+            self.insert_validator_epoch_events(events, active, next_cursor)
+            count += len(events)
+        return count
 
+    @timed_sqlite("read.get_pool_validators")
+    def get_pool_validators(self) -> Dict[str, str]:
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT pool_id, validator_address FROM pool_validators")
+        pool_validators = dict(cursor.fetchall())
+        cursor.close()
+        return pool_validators
+
+    def sync_pool_validators(self, sui_client: SuiClient) -> int:
+        """
+        Add every active or inactive pool missing from pool_validators, and fill in the pool id of stored
+        validator epoch events that lacked one. Returns how many pools were new.
+        """
+        new_pools = get_new_pool_validators(sui_client, set(self.get_pool_validators()))
+        cursor = self.conn.cursor()
+        try:
+            cursor.executemany("INSERT OR REPLACE INTO pool_validators (pool_id, validator_address) VALUES (?, ?)", list(new_pools.items()))
+            cursor.execute("""
+                UPDATE validator_epoch_events
+                SET pool_id = (SELECT pool_id FROM pool_validators WHERE pool_validators.validator_address = validator_epoch_events.validator_address)
+                WHERE pool_id IS NULL
+            """)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return len(new_pools)
+
+    @timed_sqlite("read.get_validator_epoch_events")
+    def get_validator_epoch_events(self, start_epoch, end_epoch) -> Dict[Tuple[str, str], dict]:
+        """
+        Events for start_epoch..end_epoch in the {(str(epoch), validator_address): event} shape the trackers use.
+        Only the exchange rate is filled in under parsedJson.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(VALIDATOR_EPOCH_EVENTS_QUERY, (start_epoch, end_epoch))
+        events = {
+            (str(epoch), validator_address): {"parsedJson": {
+                "epoch": str(epoch),
+                "validator_address": validator_address,
+                "pool_token_exchange_rate": {"pool_token_amount": pool_token_amount, "sui_amount": sui_amount},
+            }}
+            for epoch, validator_address, pool_token_amount, sui_amount in cursor.fetchall()
+        }
+        cursor.close()
+        return events
+
+    @timed_sqlite("write.insert_batch_staked_sui_v2")
+    def insert_batch_staked_sui_v2(self, items: List[Union[StakedSuiRef, DeletedObjectRef]]):
+        cursor = self.conn.cursor()
+        write_staked_sui_v2(cursor, items)
+        self.conn.commit()
+        cursor.close()
+
+    @timed_sqlite("write.insert_batch_sui_coin_v2")
+    def insert_batch_sui_coin_v2(self, items: List[Union[SuiCoinRef, DeletedObjectRef]]):
+        cursor = self.conn.cursor()
+        write_sui_coin_v2(cursor, items)
         self.conn.commit()
         cursor.close()
 
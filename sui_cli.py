@@ -0,0 +1,190 @@
+import argparse
+import logging
+from typing import List, Optional
+
+import metrics
+
+# Every step of the pipeline in one process: `run` ingests and reports with one client, one db connection and
+# one set of caches, where run_me.py used to start v3.py and sui_tracker_v2.py as separate interpreters.
+# Subcommands import what they need when they run, so `lookup` starts without pydantic, requests or numpy.
+
+log = logging.getLogger(__name__)
+
+
+class Pipeline:
+    """State shared by the steps of one invocation, each part built on first use."""
+    def __init__(self, args):
+        self.args = args
+        self.rpc_cache = None
+        self._sui_client = None
+        self._db = None
+
+    @property
+    def sui_client(self):
+        if self._sui_client is None:
+            from track_historical_staked_sui import SuiClient
+            from rate_limiter import AdaptiveRateLimiter
+            from rpc_cache import RpcCache
+            args = self.args
+            concurrency = max(1, getattr(args, "concurrency", 1))
+            self.rpc_cache = RpcCache(args.rpc_cache, max_disk_bytes=args.rpc_cache_max_mb * 2**20) if args.rpc_cache else None
+            self._sui_client = SuiClient(url=args.rpc_url, pool_size=max(10, concurrency), rate_limiter=AdaptiveRateLimiter(max_rate=args.max_rps, concurrency=concurrency),
+                                         record_path=args.record_rpc, cache=self.rpc_cache, request_timeout=args.request_timeout)
+        return self._sui_client
+
+    @property
+    def db(self):
+        if self._db is None:
+            from sqlite_manager import SqliteManager
+            self._db = SqliteManager(version="v2", purge=getattr(self.args, "purge", False), db_path=self.args.db_path)
+        return self._db
+
+    def input_data(self):
+        from v3 import read_csv
+        return read_csv(self.args.input_filename)[self.args.start_from:]
+
+    def close(self):
+        if self._db is not None:
+            self._db.conn.close()
+        if self.rpc_cache:
+            log.info(f"RPC cache: {self.rpc_cache.stats()}")
+        metrics.finish(self.args, {"rpc_cache": self.rpc_cache.stats()} if self.rpc_cache else None)
+        if self.rpc_cache:
+            self.rpc_cache.close()
+
+
+def ingest(pipeline: Pipeline, args):
+    from v3 import ingest, ingest_checkpoints
+    if args.ingest_mode == "checkpoints":
+        if args.liquid_mode != "objects":
+            raise Exception("--ingest-mode checkpoints only supports --liquid-mode objects")
+        ingest_checkpoints(pipeline.sui_client, pipeline.db, pipeline.input_data(), args.from_checkpoint, args.end_checkpoint, args.checkpoint_budget)
+    else:
+        ingest(pipeline.sui_client, pipeline.db, pipeline.input_data(), args.concurrency, args.address_budget, args.liquid_mode, args.liquid_check_rate, args.dedup_group_size)
+
+
+def report(pipeline: Pipeline, args):
+    from sui_tracker_v2 import load_rates, write_report
+    rates = load_rates(pipeline.sui_client, pipeline.db, args.start_epoch, args.end_epoch)
+    write_report(pipeline.sui_client, pipeline.db, pipeline.input_data(), args.output_filename, list(range(args.start_epoch, args.end_epoch + 1)), rates,
+                 args.start_epoch, args.use_previous_epoch, args.cumulative, args.append, args.workers)
+
+
+def run(pipeline: Pipeline, args):
+    ingest(pipeline, args)
+    report(pipeline, args)
+
+
+def cumulative(pipeline: Pipeline, args):
+    from determine_cumulative import write_cumulative
+    write_cumulative(args.input_filename, args.output_filename, args.block_rows)
+
+
+def lookup(pipeline: Pipeline, args):
+    """Liquid and staked SUI of one address at one epoch, straight from the db."""
+    import pathlib
+    import sqlite3
+    from queries import LIQUID_AT_EPOCH_QUERY, STAKED_AT_EPOCH_QUERY, LIQUID_BALANCE_HISTORY_QUERY, EPOCH_REPORT_QUERY
+    conn = sqlite3.connect(pathlib.Path(args.db_path).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        balances = conn.execute(LIQUID_BALANCE_HISTORY_QUERY, (args.address,)).fetchall()
+        if balances:
+            # balance-changes mode: the running balance of the last epoch with a change at or before this one
+            liquid = ([balance for epoch, balance in balances if epoch <= args.epoch] or [0])[-1]
+        else:
+            liquid = sum(row[4] for row in conn.execute(LIQUID_AT_EPOCH_QUERY, (args.address, args.epoch, args.epoch)))
+        stakes = conn.execute(STAKED_AT_EPOCH_QUERY, (args.address, args.epoch, args.epoch)).fetchall()
+        line = f"{args.address} at epoch {args.epoch}: {round(liquid / 1e9, 2)} liquid SUI, {round(sum(row[5] for row in stakes) / 1e9, 2)} staked SUI in {len(stakes)} stakes"
+        try:
+            reported = {row[0]: row[1:] for row in conn.execute(EPOCH_REPORT_QUERY, (args.address,))}
+        except sqlite3.OperationalError:
+            # a db from before watch.py has no epoch_report table
+            reported = {}
+        if args.epoch in reported:
+            line += f", {reported[args.epoch][2]} estimated reward"
+        log.info(line)
+    finally:
+        conn.close()
+
+
+def add_rpc_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--rpc-url", type=str, help="RPC URL to use", default="https://fullnode.mainnet.sui.io:443")
+    parser.add_argument("--db-path", type=str, help="Path to the sqlite db", default="sui_data.db")
+    parser.add_argument("--input-filename", default="test.csv")
+    parser.add_argument("--start-from", type=int, help="Start from a specific row in the CSV file", default=0)
+    parser.add_argument("--record-rpc", type=str, help="Append every RPC call and result to this file, for replay with local_fullnode.py", default=None)
+    parser.add_argument("--request-timeout", type=float, help="Seconds to wait for a single RPC request", default=30)
+    parser.add_argument("--max-rps", type=float, help="Upper bound for the adaptive requests-per-second limit", default=200.0)
+    parser.add_argument("--rpc-cache", type=str, help="Cache immutable RPC results (past objects, full history pages) in this sqlite file across runs", default=None)
+    parser.add_argument("--rpc-cache-max-mb", type=int, help="Size limit of the --rpc-cache file", default=1024)
+
+
+def add_ingest_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--purge", action="store_true", help="Drop all stored objects and cursors and refetch every address from scratch", default=False)
+    parser.add_argument("--concurrency", type=int, help="Number of addresses to fetch at once", default=1)
+    parser.add_argument("--address-budget", type=float, help="Seconds to spend on each address; a slow one stores its progress and continues on the next run", default=60)
+    parser.add_argument("--dedup-group-size", type=int, help="Addresses whose object versions are fetched together, each distinct version once", default=100)
+    parser.add_argument("--liquid-mode", choices=["objects", "balance-changes"], default="objects",
+                        help="Track liquid SUI from Coin<SUI> object versions, or from per-transaction balance changes without fetching coins")
+    parser.add_argument("--liquid-check-rate", type=float, default=0.0,
+                        help="With --liquid-mode balance-changes, fraction of addresses to cross-check against the coin object path")
+    parser.add_argument("--ingest-mode", choices=["addresses", "checkpoints"], default="addresses",
+                        help="Query the transactions of each address, or walk all transactions by checkpoint once for very large address lists")
+    parser.add_argument("--from-checkpoint", type=int, help="With --ingest-mode checkpoints, where the first scan starts; later runs continue from the stored watermark", default=0)
+    parser.add_argument("--end-checkpoint", type=int, help="With --ingest-mode checkpoints, the last checkpoint to scan this run", default=None)
+    parser.add_argument("--checkpoint-budget", type=float, help="With --ingest-mode checkpoints, seconds to scan before storing progress and stopping", default=None)
+
+
+def add_report_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--output-filename", default="output.csv")
+    parser.add_argument("--start-epoch", type=int, help="Epoch to start at", default=0)
+    parser.add_argument("--end-epoch", type=int, help="Epoch to end at", default=130)
+    parser.add_argument("--append", action="store_true", help="Append to the output file instead of overwriting it")
+    parser.add_argument("--use-previous-epoch", action="store_true", help="Use previous epoch for estimated rewards", default=False)
+    parser.add_argument("--cumulative", action="store_true", help="Also write 'Estimated Reward for Epoch' and 'Cumulative to Epoch' rows (use with --use-previous-epoch)", default=False)
+    parser.add_argument("--workers", type=int, help="Number of processes computing addresses in parallel", default=1)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Track liquid SUI, staked SUI and estimated staking rewards for a list of addresses")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    for name, command, help, argument_groups in (
+        ("ingest", ingest, "Fetch new transactions into the db, like v3.py", (add_rpc_arguments, add_ingest_arguments)),
+        ("report", report, "Write the per-epoch CSV from the db, like sui_tracker_v2.py", (add_rpc_arguments, add_report_arguments)),
+        ("run", run, "ingest, then report, in one process", (add_rpc_arguments, add_ingest_arguments, add_report_arguments)),
+    ):
+        subparser = subparsers.add_parser(name, help=help)
+        for add_arguments in argument_groups:
+            add_arguments(subparser)
+        metrics.add_arguments(subparser)
+        subparser.set_defaults(command=command)
+
+    subparser = subparsers.add_parser("cumulative", help="Add per-epoch and cumulative reward rows to a report, like determine_cumulative.py")
+    subparser.add_argument("--input-filename", default="a.csv")
+    subparser.add_argument("--output-filename", default="by_epoch_output.csv")
+    subparser.add_argument("--block-rows", type=int, help="Rows summed per vectorized block", default=1024)
+    metrics.add_arguments(subparser)
+    subparser.set_defaults(command=cumulative)
+
+    subparser = subparsers.add_parser("lookup", help="Print the liquid and staked SUI of one address at one epoch from the db")
+    subparser.add_argument("address")
+    subparser.add_argument("epoch", type=int)
+    subparser.add_argument("--db-path", type=str, help="Path to the sqlite db", default="sui_data.db")
+    metrics.add_arguments(subparser)
+    subparser.set_defaults(command=lookup)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    args = build_parser().parse_args(argv)
+    metrics.setup(args)
+    pipeline = Pipeline(args)
+    try:
+        args.command(pipeline, args)
+    finally:
+        pipeline.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,18 @@
 import requests
 import json
 import argparse
+import logging
 from datetime import datetime
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any, Iterator
 import csv
-from timeout_decorator import timeout, timeout_decorator
-from track_historical_staked_sui import get_all_sui_objs_at_epoch, calculate_rewards_for_address
+from track_historical_staked_sui import SuiClient, get_all_sui_objs_at_epoch, calculate_rewards_for_address
+from rpc_cache import RpcCache
+from deadline import Deadline, DeadlineExceeded
+import metrics
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
 
 class Stake(BaseModel):
     stakedSuiId: str
@@ -41,34 +47,14 @@ class CsvInput(BaseModel):
     category: Optional[str] = Field(..., alias="Category")
 
 
-def get_balance(url, owner, coin_type="0x2::sui::SUI"):
+def get_balance(sui_client: SuiClient, owner, coin_type="0x2::sui::SUI"):
     """Get balance of liquid SUI from an address"""
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S%f')
-    payload = {
-        "jsonrpc": "2.0",
-        "id": timestamp,
-        "method": "suix_getBalance",
-        "params": [owner, coin_type]        
-    }
-
-    headers = {'content-type': 'application/json'}
-    response = requests.post(url, data=json.dumps(payload), headers=headers).json()
-    data = response['result']
+    data = sui_client.get_balance(owner, coin_type)
     return GetBalanceResult(**data)
 
-def get_stakes(url, owner):
-    """Get stakes"""    
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S%f')
-    payload = {
-        "jsonrpc": "2.0",
-        "id": timestamp,
-        "method": "suix_getStakes",
-        "params": [owner]
-    }
-
-    headers = {'content-type': 'application/json'}
-    response = requests.post(url, data=json.dumps(payload), headers=headers).json()
-    data = response['result']    
+def get_stakes(sui_client: SuiClient, owner):
+    """Get stakes"""
+    data = sui_client.get_stakes(owner)
     return GetStakesResult(__root__=[Validator(**v) for v in data])
 
 def calculate_stake_and_reward(get_stakes_result: GetStakesResult) -> StakeAndReward:
@@ -99,18 +85,18 @@ def read_csv(filename: str) -> List[CsvInput]:
         reader = csv.DictReader(f)
         return [CsvInput.parse_obj(row) for row in reader]        
 
-@timeout(60)
-def process_row(args, row: CsvInput, epoch: int = None):
-    print(f"Processing {row.address}")
+def process_row(sui_client: SuiClient, row: CsvInput, epoch: int = None, budget=60):
+    log.info(f"Processing {row.address}")
+    deadline = Deadline(budget)
     if epoch:
-        (staked_sui_objs, sui_coin_objs) = get_all_sui_objs_at_epoch(args.rpc_url, row.address, epoch)        
-        print(staked_sui_objs)
-        print(sui_coin_objs)
-        (liquid_balance, total_principal, estimated_rewards) = calculate_rewards_for_address(args.rpc_url, epoch, staked_sui_objs, sui_coin_objs)        
+        (staked_sui_objs, sui_coin_objs) = get_all_sui_objs_at_epoch(sui_client, row.address, epoch, deadline=deadline)        
+        log.debug(staked_sui_objs)
+        log.debug(sui_coin_objs)
+        (liquid_balance, total_principal, estimated_rewards) = calculate_rewards_for_address(sui_client, epoch, staked_sui_objs, sui_coin_objs)        
         result = StakeAndReward(total_principal=total_principal, total_estimated_reward=estimated_rewards)
     else:
-        liquid_balance = get_balance(args.rpc_url, row.address).totalBalance
-        stakes = get_stakes(args.rpc_url, row.address)
+        liquid_balance = get_balance(sui_client, row.address).totalBalance
+        stakes = get_stakes(sui_client, row.address)
         result = calculate_stake_and_reward(stakes)
     
     rows = build_rows(row.address, row.category, liquid_balance, result.total_principal, result.total_estimated_reward)
@@ -124,7 +110,16 @@ def main():
     parser.add_argument("--append", action="store_true", help="Append to output.csv instead of overwriting it")
     parser.add_argument("--start-from", type=int, help="Start from a specific row in the CSV file", default=0)
     parser.add_argument("--cumulative", action="store_true", help="Calculate cumulative staked SUI", default=False)
+    parser.add_argument("--record-rpc", type=str, help="Append every RPC call and result to this file, for replay with local_fullnode.py", default=None)
+    parser.add_argument("--rpc-cache", type=str, help="Cache immutable RPC results (past objects, full history pages) in this sqlite file across runs", default=None)
+    parser.add_argument("--rpc-cache-max-mb", type=int, help="Size limit of the --rpc-cache file", default=1024)
+    parser.add_argument("--pool-size", type=int, help="Number of keep-alive connections to keep open to the RPC", default=10)
+    metrics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.setup(args)
+
+    rpc_cache = RpcCache(args.rpc_cache, max_disk_bytes=args.rpc_cache_max_mb * 2**20) if args.rpc_cache else None
+    sui_client = SuiClient(args.rpc_url, pool_size=args.pool_size, record_path=args.record_rpc, cache=rpc_cache)
 
     input_data = read_csv(args.filename)
     input_data = input_data[args.start_from:]
@@ -138,17 +133,24 @@ def main():
         for row in input_data:
             epochs = [args.epoch] if not args.cumulative else list(range(0, args.epoch + 1))            
             for epoch in epochs:  
-                print(epoch)              
+                log.debug("Epoch %s", epoch)
                 try:
-                    rows = process_row(args, row, epoch)
-                except timeout_decorator.TimeoutError:
-                    print(f"Timeout processing {row.address}")
+                    with METRICS.stage("process_row"):
+                        rows = process_row(sui_client, row, epoch)
+                except DeadlineExceeded:
+                    log.error(f"Timeout processing {row.address}")
                     rows = build_rows(row.address, row.category, -1, -1, -1)
             
                 # Write rows to the CSV file immediately after processing
                 for r in rows:
                     writer.writerow(r)
 
+    if rpc_cache:
+        log.info(f"RPC cache: {rpc_cache.stats()}")
+    metrics.finish(args, {"rpc_cache": rpc_cache.stats()} if rpc_cache else None)
+    if rpc_cache:
+        rpc_cache.close()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
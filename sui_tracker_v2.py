@@ -1,47 +1,28 @@
-import sqlite3
 import argparse
 import csv
 import os
+import sys
 import json
+import multiprocessing
+import logging
 from pydantic import BaseModel, Field
-from typing import List, Optional
-from track_historical_staked_sui import SuiClient, StakedSuiRef, SuiCoinRef, calculate_rewards_for_address
+from typing import List, Optional, Dict, Tuple, Iterator
+from track_historical_staked_sui import SuiClient, StakedSuiRef, SuiCoinRef
+from exchange_rates import ExchangeRateMatrix, rewards_by_epoch
+from determine_cumulative import cumulative_sums
+from rpc_cache import RpcCache
+import metrics
+from metrics import METRICS, timed_sqlite
+from sqlite_manager import SqliteManager, reader_connection
+from queries import LIQUID_BALANCE_HISTORY_QUERY, LIQUID_AT_EPOCH_QUERY, STAKED_AT_EPOCH_QUERY, LIQUID_HISTORY_QUERY, STAKED_HISTORY_QUERY
 
-def get_liquid_for_address_at_epoch(address, query_epoch, db_path="sui_data.db") -> List[SuiCoinRef]:
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    query = """
-    WITH LatestVersion AS (
-        SELECT
-            object_id,
-            MAX(version) AS max_version
-        FROM
-            sui_coins_v2
-        WHERE
-            owner = ?
-            AND at_epoch <= ?
-        GROUP BY
-            object_id
-    )
-
-    SELECT
-        scv2.*
-    FROM
-        sui_coins_v2 scv2
-    JOIN
-        LatestVersion lv ON scv2.object_id = lv.object_id AND scv2.version = lv.max_version
-    WHERE
-        NOT scv2.deleted
-    ORDER BY
-        ABS(scv2.at_epoch - ?);
-    """
+log = logging.getLogger(__name__)
 
-    cursor.execute(query, (address, query_epoch, query_epoch))
+def get_liquid_for_address_at_epoch(address, query_epoch, db_path="sui_data.db") -> List[SuiCoinRef]:
+    cursor = reader_connection(db_path).cursor()
+    cursor.execute(LIQUID_AT_EPOCH_QUERY, (address, query_epoch, query_epoch))
     results = cursor.fetchall()
-
     cursor.close()
-    conn.close()
 
     objects = []
     for row in results:
@@ -56,40 +37,10 @@ def get_liquid_for_address_at_epoch(address, query_epoch, db_path="sui_data.db")
     return objects
 
 def get_staked_for_address_at_epoch(address, query_epoch, db_path="sui_data.db") -> List[StakedSuiRef]:
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    query = """
-    WITH LatestVersion AS (
-        SELECT
-            object_id,
-            MAX(version) AS max_version
-        FROM
-            staked_sui_v2
-        WHERE
-            owner = ?
-            AND at_epoch <= ?
-        GROUP BY
-            object_id
-    )
-
-    SELECT
-        ssv2.*
-    FROM
-        staked_sui_v2 ssv2
-    JOIN
-        LatestVersion lv ON ssv2.object_id = lv.object_id AND ssv2.version = lv.max_version
-    WHERE
-        NOT ssv2.deleted
-    ORDER BY
-        ABS(ssv2.at_epoch - ?);
-    """
-
-    cursor.execute(query, (address, query_epoch, query_epoch))
+    cursor = reader_connection(db_path).cursor()
+    cursor.execute(STAKED_AT_EPOCH_QUERY, (address, query_epoch, query_epoch))
     results = cursor.fetchall()
-
     cursor.close()
-    conn.close()
 
     objects = []
     for row in results:
@@ -105,6 +56,156 @@ def get_staked_for_address_at_epoch(address, query_epoch, db_path="sui_data.db")
 
     return objects
 
+@timed_sqlite("read.load_liquid_history")
+def load_liquid_history(conn, address) -> List[Tuple[str, int, int, Optional[int]]]:
+    """Every sui_coins_v2 row for an address as (object_id, version, at_epoch, balance), oldest first.
+    balance is None for deleted rows."""
+    cursor = conn.cursor()
+    cursor.execute(LIQUID_HISTORY_QUERY, (address,))
+    rows = [(object_id, version, at_epoch, None if deleted else balance)
+            for object_id, version, at_epoch, balance, deleted in cursor.fetchall()]
+    cursor.close()
+    return rows
+
+@timed_sqlite("read.load_staked_history")
+def load_staked_history(conn, address) -> List[Tuple[str, int, int, Optional[StakedSuiRef]]]:
+    """Every staked_sui_v2 row for an address as (object_id, version, at_epoch, ref), oldest first.
+    ref is None for deleted rows."""
+    cursor = conn.cursor()
+    cursor.execute(STAKED_HISTORY_QUERY, (address,))
+    rows = []
+    for row in cursor.fetchall():
+        ref = None
+        if not row[7]:
+            ref = StakedSuiRef(
+                object_id=row[0],
+                version=row[1],
+                at_epoch=row[2],
+                owner=row[3],
+                pool_id=row[4],
+                principal=row[5],
+                stake_activation_epoch=row[6],
+                deleted=row[7])
+        rows.append((row[0], row[1], row[2], ref))
+    cursor.close()
+    return rows
+
+@timed_sqlite("read.load_liquid_balances")
+def load_liquid_balances(conn, address) -> List[Tuple[int, int]]:
+    """(epoch, balance) rows written by v3.py --liquid-mode balance-changes, oldest first. Empty in object mode."""
+    cursor = conn.cursor()
+    cursor.execute(LIQUID_BALANCE_HISTORY_QUERY, (address,))
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def sweep_epochs(liquid_history, staked_history, epochs: List[int]) -> Iterator[Tuple[int, int, List[StakedSuiRef]]]:
+    """
+    Walk both histories forward once and yield (epoch, liquid_balance, staked_sui_objs) for every epoch
+    in ascending order. An object's state at an epoch is its highest version recorded at or before that
+    epoch, which is what get_liquid_for_address_at_epoch and get_staked_for_address_at_epoch return.
+    """
+    live_coins: Dict[str, Tuple[int, Optional[int]]] = {}
+    live_stakes: Dict[str, Tuple[int, Optional[StakedSuiRef]]] = {}
+    liquid_balance = 0
+    coin_idx = 0
+    stake_idx = 0
+
+    for epoch in sorted(epochs):
+        while coin_idx < len(liquid_history) and liquid_history[coin_idx][2] <= epoch:
+            object_id, version, _, balance = liquid_history[coin_idx]
+            coin_idx += 1
+            current = live_coins.get(object_id)
+            if current is not None:
+                if version <= current[0]:
+                    continue
+                liquid_balance -= current[1] or 0
+            live_coins[object_id] = (version, balance)
+            liquid_balance += balance or 0
+
+        while stake_idx < len(staked_history) and staked_history[stake_idx][2] <= epoch:
+            object_id, version, _, ref = staked_history[stake_idx]
+            stake_idx += 1
+            current = live_stakes.get(object_id)
+            if current is None or version > current[0]:
+                live_stakes[object_id] = (version, ref)
+
+        staked_sui_objs = [ref for _, ref in live_stakes.values() if ref is not None]
+        yield (epoch, liquid_balance, staked_sui_objs)
+
+def compute_epoch_series(sui_client: SuiClient, conn, address, epochs: List[int], rates: ExchangeRateMatrix, start_epoch, use_previous_epoch=False) -> Dict[int, Tuple[float, float, float]]:
+    """Liquid SUI, staked SUI and estimated rewards for an address at every epoch, from a single pass over its history."""
+    liquid_balances = load_liquid_balances(conn, address)
+    liquid_history = [] if liquid_balances else load_liquid_history(conn, address)
+    staked_history = load_staked_history(conn, address)
+
+    liquid_by_epoch = {}
+    stakes_by_epoch = []
+    balance_idx = 0
+    balance = 0
+    for epoch, liquid_balance, staked_sui_objs in sweep_epochs(liquid_history, staked_history, epochs):
+        if liquid_balances:
+            # balance-changes mode: the running balance of the last epoch with a change at or before this one
+            while balance_idx < len(liquid_balances) and liquid_balances[balance_idx][0] <= epoch:
+                balance = liquid_balances[balance_idx][1]
+                balance_idx += 1
+            liquid_balance = balance
+        liquid_by_epoch[epoch] = liquid_balance
+        stakes_by_epoch.append((epoch, staked_sui_objs))
+    # calculate the cumulative rewards earned up to each epoch, for every epoch at once
+    with METRICS.stage("rewards_by_epoch"):
+        stake_results = rewards_by_epoch(sui_client, rates, stakes_by_epoch, start_epoch, use_previous_epoch)
+
+    data = {}
+    for epoch, liquid_balance in liquid_by_epoch.items():
+        staked_sui, rewards = stake_results[epoch]
+        if use_previous_epoch:
+            estimated_rewards = rewards / 1e9
+        else:
+            estimated_rewards = round( (int(rewards) / 1e9), 2)
+        data[epoch] = (
+            round( (int(liquid_balance) / 1e9), 2),
+            round( (int(staked_sui) / 1e9), 2),
+            estimated_rewards
+        )
+    return data
+
+def report_rows(sui_client: SuiClient, conn, row: "CsvInput", epochs: List[int], rates: ExchangeRateMatrix, start_epoch, use_previous_epoch=False, cumulative=False) -> List[list]:
+    """The output CSV rows for one input row."""
+    log.info(f"Processing {row.address}")
+    with METRICS.stage("compute_epoch_series"):
+        data_to_write = compute_epoch_series(sui_client, conn, row.address, epochs, rates, start_epoch, use_previous_epoch)
+    METRICS.count("addresses")
+
+    name = row.category if row.category else ""
+    prefix = [row.address, name]
+    rows = []
+    for i, type in enumerate(["Liquid SUI", "Staked SUI", "Estimated Reward"]):
+        rows.append(prefix + [type] + [item[i] for item in data_to_write.values()])
+    if cumulative:
+        rewards = [item[2] for item in data_to_write.values()]
+        rows.append(prefix + ["Estimated Reward for Epoch"] + rewards)
+        rows.append(prefix + ["Cumulative to Epoch"] + cumulative_sums(rewards))
+    return rows
+
+# per-process state for --workers, set up once by _init_worker
+_worker = {}
+
+def _init_worker(db_path, rpc_url, record_rpc, rpc_cache_path, rpc_cache_max_bytes, profile, log_level, epochs, rates, start_epoch, use_previous_epoch, cumulative):
+    logging.basicConfig(level=log_level, format="%(message)s", stream=sys.stdout)
+    METRICS.reset()
+    METRICS.enabled = profile
+    _worker["conn"] = reader_connection(db_path)
+    # one recording per process so concurrent appends never interleave
+    rpc_cache = RpcCache(rpc_cache_path, max_disk_bytes=rpc_cache_max_bytes) if rpc_cache_path else None
+    _worker["sui_client"] = SuiClient(rpc_url, record_path=f"{record_rpc}.{os.getpid()}" if record_rpc else None, cache=rpc_cache)
+    _worker["args"] = (epochs, rates, start_epoch, use_previous_epoch, cumulative)
+
+def _worker_report_rows(row: "CsvInput") -> Tuple[List[list], Optional[dict]]:
+    rows = report_rows(_worker["sui_client"], _worker["conn"], row, *_worker["args"])
+    # the parent merges each worker's metrics into its own report
+    return rows, METRICS.drain() if METRICS.enabled else None
+
 class CsvInput(BaseModel):
     address: str = Field(..., alias="Wallet Address")
     category: Optional[str] = Field(..., alias="Category")
@@ -114,6 +215,50 @@ def read_csv(filename: str) -> List[CsvInput]:
         reader = csv.DictReader(f)
         return [CsvInput.parse_obj(row) for row in reader]
 
+def load_rates(sui_client: SuiClient, db: SqliteManager, start_epoch, end_epoch) -> ExchangeRateMatrix:
+    """Top up the stored epoch events and pool -> validator map as needed, and index the rates around start_epoch..end_epoch."""
+    if db.get_event_cursor() is None and os.path.exists('events.json'):
+        log.info("Importing EpochInfoV2 events from events.json")
+        with open('events.json', 'r') as f:
+            epoch_events = json.load(f)
+        db.insert_validator_epoch_events(epoch_events, {}, epoch_events[-1]['id'] if epoch_events else None)
+    max_event_epoch = db.get_max_event_epoch()
+    if max_event_epoch is None or max_event_epoch < end_epoch:
+        log.info("Fetching new EpochInfoV2 events")
+        log.info(f"Stored {db.sync_validator_epoch_events(sui_client)} new events")
+    # a stake live at an epoch can activate at the next one, so load one epoch either side of the range
+    epoch_validator_event_dict = db.get_validator_epoch_events(start_epoch - 1, end_epoch + 1)
+    new_pools = db.sync_pool_validators(sui_client)
+    if new_pools:
+        log.info(f"Stored {new_pools} new pool -> validator mappings")
+    return ExchangeRateMatrix.from_events(epoch_validator_event_dict, db.get_pool_validators())
+
+def write_report(sui_client: SuiClient, db: SqliteManager, input_data: List["CsvInput"], output_filename, epochs: List[int], rates: ExchangeRateMatrix,
+                 start_epoch, use_previous_epoch=False, cumulative=False, append=False, workers=1):
+    """Write the wide CSV for input_data. With workers > 1, processes set up like sui_client compute the addresses."""
+    mode = "a" if append else "w"
+    with open(output_filename, mode) as f:
+        writer = csv.writer(f)
+        if not append:
+            header = ["Address", "Name", "Type"]
+            header.extend(epochs)
+            writer.writerow(header)
+
+        if workers > 1:
+            # each worker gets a read-only connection and its own copy of the rates; imap keeps input order
+            rpc_cache = sui_client.cache
+            initargs = (db.db_path, sui_client.url, sui_client.record_path, rpc_cache.path if rpc_cache else None, rpc_cache.max_disk_bytes if rpc_cache else None,
+                        METRICS.enabled, logging.getLogger().level, epochs, rates, start_epoch, use_previous_epoch, cumulative)
+            with multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+                for rows, worker_metrics in pool.imap(_worker_report_rows, input_data, chunksize=max(1, min(16, len(input_data) // (workers * 4)))):
+                    writer.writerows(rows)
+                    if worker_metrics:
+                        METRICS.merge(worker_metrics)
+        else:
+            # iterate through each address
+            for row in input_data:
+                writer.writerows(report_rows(sui_client, db.conn, row, epochs, rates, start_epoch, use_previous_epoch, cumulative))
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--rpc-url", type=str, help="RPC URL to use", default="https://fullnode.mainnet.sui.io:443")
@@ -127,70 +272,36 @@ def main():
     parser.add_argument("--staked-sui", action="store_true", help="Calculate staked SUI", default=True)
     parser.add_argument("--estimated-rewards", action="store_true", help="Calculate estimated rewards", default=False)
     parser.add_argument("--use-previous-epoch", action="store_true", help="Use previous epoch for estimated rewards", default=False)
+    parser.add_argument("--record-rpc", type=str, help="Append every RPC call and result to this file, for replay with local_fullnode.py", default=None)
+    parser.add_argument("--db-path", type=str, help="Path to the sqlite db written by v3.py", default="sui_data.db")
+    parser.add_argument("--cumulative", action="store_true", help="Also write 'Estimated Reward for Epoch' and 'Cumulative to Epoch' rows, as determine_cumulative.py does (use with --use-previous-epoch)", default=False)
+    parser.add_argument("--rpc-cache", type=str, help="Cache immutable RPC results (past objects, full history pages) in this sqlite file across runs", default=None)
+    parser.add_argument("--rpc-cache-max-mb", type=int, help="Size limit of the --rpc-cache file", default=1024)
+    parser.add_argument("--workers", type=int, help="Number of processes computing addresses in parallel", default=1)
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
+    metrics.setup(args)
 
     if args.estimated_rewards and not args.staked_sui:
         raise Exception("Cannot calculate estimated rewards without staked SUI")
 
-    sui_client = SuiClient(args.rpc_url)
+    rpc_cache = RpcCache(args.rpc_cache, max_disk_bytes=args.rpc_cache_max_mb * 2**20) if args.rpc_cache else None
+    sui_client = SuiClient(args.rpc_url, record_path=args.record_rpc, cache=rpc_cache)
 
     input_data = read_csv(args.input_filename)
     input_data = input_data[args.start_from:]
 
-    if not os.path.exists('events.json'):
-        print("Need to make initial fetch for EpochInfoV2 events")
-        epoch_events = sui_client.query_validator_epoch_info_events()
-        with open('events.json', 'w') as f:
-            json.dump(epoch_events, f, indent=4, sort_keys=True)
-    else:
-        with open('events.json', 'r') as f:
-            epoch_events = json.load(f)
-        if int(epoch_events[-1]['parsedJson']['epoch']) < int(args.end_epoch):
-            print("Need to make additional fetch for EpochInfoV2 events")
-            new_epoch_events = sui_client.query_validator_epoch_info_events(epoch_events[-1]['id'])
-            epoch_events.extend(new_epoch_events)
-            with open('events.json', 'w') as f:
-                json.dump(epoch_events, f, indent=4, sort_keys=True)
-    epoch_validator_event_dict = {(str(event['parsedJson']['epoch']), event['parsedJson']['validator_address']): event
-    for event in epoch_events}
-
-
-    mode = "a" if args.append else "w"
-    epochs = list(range(args.start_epoch, args.end_epoch + 1))
-    with open(args.output_filename, mode) as f:
-        writer = csv.writer(f)
-        if not args.append:
-            header = ["Address", "Name", "Type"]
-            header.extend(epochs)
-            writer.writerow(header)
-
-        # iterate through each address
-        for row in input_data:
-            print(f"Processing {row.address}")
-            data_to_write = {}
-            for epoch in epochs:
-                sui_coin_objs = get_liquid_for_address_at_epoch(row.address, epoch)
-                liquid_balance = 0
-                for sui_coin_obj in sui_coin_objs:
-                    liquid_balance += sui_coin_obj.balance
-                staked_sui_objs = get_staked_for_address_at_epoch(row.address, epoch)
-                # calculate the cumulative rewards earned up to the 'epoch'
-                stake_results = calculate_rewards_for_address(sui_client, epoch_validator_event_dict, args.start_epoch, epoch, staked_sui_objs, args.use_previous_epoch)
-                if args.use_previous_epoch:
-                    estimated_rewards = stake_results[1] / 1e9
-                else:
-                    estimated_rewards = round( (int(stake_results[1]) / 1e9), 2)
-                data_to_write[epoch] = (
-                    round( (int(liquid_balance) / 1e9), 2),
-                    round( (int(stake_results[0]) / 1e9), 2),
-                    estimated_rewards
-                )
-
-            name = row.category if row.category else ""
-            prefix = [row.address, name]
-            for i, type in enumerate(["Liquid SUI", "Staked SUI", "Estimated Reward"]):
-                writer.writerow(prefix + [type] + [item[i] for item in data_to_write.values()])
+    db = SqliteManager(version="v2", purge=False, db_path=args.db_path)
+    rates = load_rates(sui_client, db, args.start_epoch, args.end_epoch)
+    write_report(sui_client, db, input_data, args.output_filename, list(range(args.start_epoch, args.end_epoch + 1)), rates, args.start_epoch,
+                 args.use_previous_epoch, args.cumulative, args.append, args.workers)
+    db.conn.close()
+    if rpc_cache:
+        log.info(f"RPC cache: {rpc_cache.stats()}")
+    metrics.finish(args, {"rpc_cache": rpc_cache.stats()} if rpc_cache else None)
+    if rpc_cache:
+        rpc_cache.close()
 
 
 if __name__ == "__main__":
@@ -1,30 +1,272 @@
 import requests
 import json
 import argparse
+import logging
 from functools import lru_cache
-from typing import List, Optional, Tuple, Dict, Union, Any
+from typing import List, Optional, Tuple, Dict, Union, Any, Set, Callable
 from pydantic import BaseModel, Field
 from datetime import datetime
 import os
+import asyncio
+import queue
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import requests
 import json
 from typing import List
 from functools import lru_cache
-from timeout_decorator import timeout
+from deadline import Deadline, DeadlineExceeded
+from rate_limiter import AdaptiveRateLimiter, RpcError, backoff_delay, parse_retry_after
+from rpc_cache import RpcCache, PAST_OBJECT
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+def create_session(pool_size=10) -> requests.Session:
+    """A keep-alive session whose connection pool holds up to pool_size connections to the fullnode."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        'content-type': 'application/json',
+        'accept-encoding': 'gzip, deflate',
+        'connection': 'keep-alive',
+    })
+    return session
+
+VALIDATOR_EPOCH_INFO_EVENT_TYPE = "0x3::validator_set::ValidatorEpochInfoEventV2"
+
+# object history only needs effects (epoch, deletions) and object changes
+HISTORY_TRANSACTION_OPTIONS = {
+    "showInput": False,
+    "showRawInput": False,
+    "showEffects": True,
+    "showEvents": False,
+    "showObjectChanges": True,
+    "showBalanceChanges": False
+}
+
+# the liquid SUI fast path reads the owner's balance changes, and the sender to tell sent from received
+BALANCE_TRANSACTION_OPTIONS = {
+    "showInput": True,
+    "showRawInput": False,
+    "showEffects": True,
+    "showEvents": False,
+    "showObjectChanges": False,
+    "showBalanceChanges": True
+}
+
+# a checkpoint scan has no address filter, so it needs the sender to tell which tracked address sent a transaction
+CHECKPOINT_TRANSACTION_OPTIONS = {**HISTORY_TRANSACTION_OPTIONS, "showInput": True}
+
+HISTORY_AND_BALANCE_TRANSACTION_OPTIONS = {
+    key: HISTORY_TRANSACTION_OPTIONS[key] or BALANCE_TRANSACTION_OPTIONS[key] for key in HISTORY_TRANSACTION_OPTIONS
+}
+
+OBJECT_DATA_OPTIONS = {
+    "showType": True,
+    "showOwner": True,
+    "showPreviousTransaction": True,
+    "showDisplay": False,
+    "showContent": True,
+    "showBcs": False,
+    "showStorageRebate": True
+}
+
+def rpc_method_name(payload) -> str:
+    return f"batch:{payload[0]['method']}" if isinstance(payload, list) else payload['method']
 
 class SuiClient:
-    def __init__(self, url='https://fullnode.mainnet.sui.io:443'):
+    def __init__(self, url='https://fullnode.mainnet.sui.io:443', pool_size=10, batch_size=20,
+                 rate_limiter: Optional[AdaptiveRateLimiter] = None, max_retries=5, request_timeout=30,
+                 record_path=None, cache: Optional[RpcCache] = None):
         self.url = url
         self.headers = {'content-type': 'application/json'}
+        self.session = create_session(pool_size)
+        # calls per JSON-RPC batch; switched off for good the first time the server rejects a batch
+        self.batch_size = batch_size
+        self.supports_batch = batch_size > 1
+        # pass the same limiter to several clients to share one budget for an endpoint
+        self.rate_limiter = rate_limiter if rate_limiter is not None else AdaptiveRateLimiter(concurrency=pool_size)
+        self.max_retries = max_retries
+        self.request_timeout = request_timeout
+        # when set, every successful call is appended to this file in the fixture format local_fullnode.py serves
+        self.record_path = record_path
+        self._record_lock = threading.Lock()
+        # immutable results (and mutable ones for a TTL) are served from here; while recording, only written to,
+        # so the recording still holds every call
+        self.cache = cache
+        # inactive pool id -> validator address; a pool's validator never changes once it is inactive
+        self.inactive_pool_validators: Dict[str, str] = {}
+
+    def _cache_lookups(self) -> bool:
+        return self.cache is not None and not self.record_path
+
+    def _post(self, payload, use_cache=True, deadline: Optional[Deadline] = None):
+        """
+        POST a JSON-RPC payload through the shared rate limiter. 429s, 5xx, connection errors and unparseable
+        bodies are retried with jittered exponential backoff (honouring Retry-After); anything else raises RpcError.
+        With a deadline, each attempt's timeout is cut to the time left and DeadlineExceeded is raised once it is gone.
+        """
+        cacheable = use_cache and self.cache is not None and isinstance(payload, dict) and self.cache.handles(payload['method'])
+        if cacheable and self._cache_lookups():
+            cached = self.cache.get(payload['method'], payload['params'])
+            if cached is not None:
+                return {"jsonrpc": "2.0", "id": payload['id'], "result": cached}
+        for attempt in range(self.max_retries + 1):
+            result = self._try_post(payload, deadline)
+            if not isinstance(result, RpcError):
+                if self.record_path:
+                    self._record(payload, result)
+                if cacheable:
+                    self.cache.put(payload['method'], payload['params'], result['result'])
+                return result
+            if not result.retryable or attempt == self.max_retries:
+                raise result
+            delay = backoff_delay(attempt, retry_after=result.retry_after)
+            time_left = deadline.time_left() if deadline is not None else None
+            if time_left is not None and delay >= time_left:
+                raise DeadlineExceeded(f"No time left to retry {self.url}: {result}")
+            log.warning(f"Retrying {self.url} in {delay:.2f}s: {result}")
+            time.sleep(delay)
+
+    def _try_post(self, payload, deadline: Optional[Deadline] = None):
+        request_timeout = deadline.request_timeout(self.request_timeout) if deadline is not None else self.request_timeout
+        self.rate_limiter.acquire()
+        start = time.monotonic()
+        try:
+            http_response = self.session.post(self.url, data=json.dumps(payload), headers=self.headers, timeout=request_timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self.rate_limiter.release(time.monotonic() - start, throttled=True)
+            if METRICS.enabled:
+                METRICS.record_rpc(rpc_method_name(payload), time.monotonic() - start, error=True)
+            return RpcError(f"Request failed: {e}", retryable=True)
+        latency = time.monotonic() - start
+
+        status = http_response.status_code
+        if METRICS.enabled:
+            METRICS.record_rpc(rpc_method_name(payload), latency, len(http_response.content), error=status >= 400)
+        if status == 429 or status >= 500:
+            retry_after = parse_retry_after(http_response.headers.get('Retry-After'))
+            self.rate_limiter.release(latency, throttled=True, retry_after=retry_after)
+            return RpcError(f"HTTP {status}", retryable=True, status_code=status, retry_after=retry_after)
+        self.rate_limiter.release(latency)
+        if status >= 400:
+            return RpcError(f"HTTP {status}: {http_response.text[:200]}", status_code=status)
+
+        try:
+            body = http_response.json()
+        except ValueError:
+            return RpcError("Malformed JSON response", retryable=True, status_code=status)
+        if isinstance(payload, list):
+            return body
+        if not isinstance(body, dict):
+            return RpcError(f"Malformed JSON-RPC response: {str(body)[:200]}", retryable=True, status_code=status)
+        if 'error' in body:
+            return RpcError(f"{payload.get('method')} failed: {body['error']}", status_code=status)
+        if 'result' not in body:
+            return RpcError(f"Malformed JSON-RPC response: {str(body)[:200]}", retryable=True, status_code=status)
+        return body
+
+    def _record(self, payload, body):
+        if isinstance(payload, list):
+            if not isinstance(body, list):
+                return
+            by_id = {item.get('id'): item for item in body if isinstance(item, dict)}
+            pairs = [(call, by_id.get(call['id'])) for call in payload]
+        else:
+            pairs = [(payload, body)]
+        lines = [
+            json.dumps({"method": call['method'], "params": call['params'], "result": response['result']})
+            for call, response in pairs if response is not None and 'result' in response
+        ]
+        with self._record_lock:
+            with open(self.record_path, "a") as f:
+                for line in lines:
+                    f.write(line + "\n")
+
+    def _batch_post(self, calls: List[Tuple[str, list]], deadline: Optional[Deadline] = None) -> List[Any]:
+        """Results of the (method, params) calls, in order, sent batch_size at a time as JSON-RPC batch arrays."""
+        cached = [None] * len(calls)
+        if self._cache_lookups():
+            cached = self.cache.get_many(calls)
+        misses = [call for call, result in zip(calls, cached) if result is None]
+
+        fetched = []
+        for group in self.chunked_requests(misses, self.batch_size):
+            fetched.extend(self._post_batch_group(group, deadline))
+        if self.cache is not None:
+            self.cache.put_many((method, params, result) for (method, params), result in zip(misses, fetched))
+
+        fetched_iter = iter(fetched)
+        return [result if result is not None else next(fetched_iter) for result in cached]
+
+    def _post_batch_group(self, calls: List[Tuple[str, list]], deadline: Optional[Deadline] = None) -> List[Any]:
+        if len(calls) == 1 or not self.supports_batch:
+            return [self._post({"jsonrpc": "2.0", "id": 1, "method": method, "params": params}, use_cache=False, deadline=deadline)['result'] for method, params in calls]
+
+        payload = [{"jsonrpc": "2.0", "id": idx, "method": method, "params": params} for idx, (method, params) in enumerate(calls)]
+        try:
+            response = self._post(payload, deadline=deadline)
+        except RpcError as e:
+            if e.retryable or isinstance(e, DeadlineExceeded):
+                raise
+            response = None
+        if not isinstance(response, list):
+            log.warning(f"{self.url} rejected a batch request, falling back to single requests")
+            self.supports_batch = False
+            return self._post_batch_group(calls, deadline)
+
+        by_id = {item.get('id'): item for item in response if isinstance(item, dict)}
+        results = []
+        for idx, (method, params) in enumerate(calls):
+            item = by_id.get(idx)
+            if item is None or 'result' not in item:
+                # a missing or failed entry is retried on its own, which raises if it fails again
+                item = self._post({"jsonrpc": "2.0", "id": idx, "method": method, "params": params}, use_cache=False, deadline=deadline)
+            results.append(item['result'])
+        return results
+
+    def connection_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Connections opened and requests sent per host, i.e. how often a pooled connection was reused."""
+        stats = {}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = f"{pool.scheme}://{pool.host}:{pool.port}"
+                reused = max(0, pool.num_requests - pool.num_connections)
+                stats[host] = {
+                    "connections": pool.num_connections,
+                    "requests": pool.num_requests,
+                    "reused": reused,
+                    "reuse_ratio": reused / pool.num_requests if pool.num_requests else 0.0,
+                }
+        return stats
+
+    def close(self):
+        self.session.close()
 
     def query_validator_epoch_info_events(self, cursor=None):
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S%f')
         events = []
+        for data, _ in self.iter_validator_epoch_info_event_pages(cursor):
+            events.extend(data)
+        return events
+
+    def iter_validator_epoch_info_event_pages(self, cursor=None, limit=1000):
+        """Yield (events, next_cursor) for every page of ValidatorEpochInfoEventV2 events after cursor."""
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S%f')
         query = {
-            "MoveEventType": "0x3::validator_set::ValidatorEpochInfoEventV2"
+            "MoveEventType": VALIDATOR_EPOCH_INFO_EVENT_TYPE
         }
-        limit = 1000
 
         payload = {
             "jsonrpc": "2.0",
@@ -33,20 +275,21 @@ class SuiClient:
             "params": [query, cursor, limit, False]
         }
 
-        headers = {'content-type': 'application/json'}
-        response = requests.post(self.url, data=json.dumps(payload), headers=headers).json()
-        while response:
+        while True:
+            try:
+                response = self._post(payload)
+            except RpcError as e:
+                e.cursor = cursor
+                raise
             data = response['result']['data']
-            events.extend(data)
             cursor = response['result']['nextCursor']
             has_next_page = response['result']['hasNextPage']
+            yield data, cursor
             if has_next_page:
                 params = [query, cursor, limit]
                 payload['params'] = params
-                response = requests.post(self.url, data=json.dumps(payload), headers=headers).json()
             else:
                 break
-        return events
 
     @lru_cache(maxsize=128)
     def get_sui_system_state(self):
@@ -56,19 +299,53 @@ class SuiClient:
             "method": "suix_getLatestSuiSystemState",
             "params": []
         }
-        response = requests.post(self.url, data=json.dumps(payload), headers=self.headers).json()
+        response = self._post(payload)
         return response['result']
 
+    def get_balance(self, owner, coin_type="0x2::sui::SUI"):
+        payload = {
+            "jsonrpc": "2.0",
+            "id": datetime.now().strftime('%Y%m%d%H%M%S%f'),
+            "method": "suix_getBalance",
+            "params": [owner, coin_type]
+        }
+        return self._post(payload)['result']
+
+    def get_stakes(self, owner):
+        payload = {
+            "jsonrpc": "2.0",
+            "id": datetime.now().strftime('%Y%m%d%H%M%S%f'),
+            "method": "suix_getStakes",
+            "params": [owner]
+        }
+        return self._post(payload)['result']
+
     @lru_cache(maxsize=128)
     def get_dynamic_fields(self, parent_object_id):
+        fields = []
+        for data, _ in self.iter_dynamic_field_pages(parent_object_id):
+            fields.extend(data)
+        return fields
+
+    def iter_dynamic_field_pages(self, parent_object_id, cursor=None):
+        """Yield (fields, next_cursor) for every page of suix_getDynamicFields after cursor."""
         payload = {
             "jsonrpc": "2.0",
             "id": 1,
             "method": "suix_getDynamicFields",
-            "params": [parent_object_id]
+            "params": [parent_object_id, cursor]
         }
-        response = requests.post(self.url, data=json.dumps(payload), headers=self.headers).json()
-        return response['result']['data']
+        while True:
+            try:
+                response = self._post(payload)
+            except RpcError as e:
+                e.cursor = cursor
+                raise
+            cursor = response['result']['nextCursor']
+            yield response['result']['data'], cursor
+            if not response['result']['hasNextPage']:
+                break
+            payload['params'] = [parent_object_id, cursor]
 
     @lru_cache(maxsize=128)
     def get_object(self, object_id):
@@ -86,7 +363,7 @@ class SuiClient:
                         "showStorageRebate": True
                 }]
         }
-        response = requests.post(self.url, data=json.dumps(payload), headers=self.headers).json()
+        response = self._post(payload)
         return response['result']['data']
 
     def multi_get_objects(self, request: List):
@@ -106,40 +383,44 @@ class SuiClient:
                 }
             ]
         }
-        response = requests.post(self.url, data=json.dumps(payload), headers=self.headers).json()
+        response = self._post(payload)
         return response
 
-    def try_multi_get_past_objects(self, request: List):
-        final_result = []
-        for chunk in self.chunked_requests(request):
-            payload = {
-                "jsonrpc": "2.0",
-                "id": 1,
-                "method": "sui_tryMultiGetPastObjects",
-                "params": [
-                    [{"objectId": r.object_id, "version": str(r.version)} for r in chunk],
-                    {
-                        "showType": True,
-                        "showOwner": True,
-                        "showPreviousTransaction": True,
-                        "showDisplay": False,
-                        "showContent": True,
-                        "showBcs": False,
-                        "showStorageRebate": True
-                    }
-                ]
-            }
-            response = requests.post(self.url, data=json.dumps(payload), headers=self.headers).json()
-            final_result.extend(response['result'])
-        return final_result
-
-    @lru_cache(maxsize=128)
-    def query_transaction_blocks(self, filter_type, address, cursor=None, limit=1000, descending_order=False):
+    def try_multi_get_past_objects(self, request: List, deadline: Optional[Deadline] = None):
+        METRICS.count("objects", len(request))
+        with METRICS.stage("fetch_past_objects"):
+            past_objects = [{"objectId": r.object_id, "version": str(r.version)} for r in request]
+            # past versions never change, so each one is cached on its own
+            cached = [None] * len(past_objects)
+            if self._cache_lookups():
+                cached = self.cache.get_many([(PAST_OBJECT, [past_object, OBJECT_DATA_OPTIONS]) for past_object in past_objects])
+            misses = [past_object for past_object, result in zip(past_objects, cached) if result is None]
+
+            calls = [("sui_tryMultiGetPastObjects", [chunk, OBJECT_DATA_OPTIONS]) for chunk in self.chunked_requests(misses)]
+            fetched = [item for result in self._batch_post(calls, deadline) for item in result]
+            if self.cache is not None:
+                self.cache.put_many((PAST_OBJECT, [past_object, OBJECT_DATA_OPTIONS], result) for past_object, result in zip(misses, fetched))
+
+            fetched_iter = iter(fetched)
+            return [result if result is not None else next(fetched_iter) for result in cached]
+
+    def get_objects(self, object_ids: List[str]) -> List[dict]:
+        """sui_getObject for every id, batched into as few HTTP requests as possible."""
+        results = self._batch_post([("sui_getObject", [object_id, OBJECT_DATA_OPTIONS]) for object_id in object_ids])
+        return [result.get('data') for result in results]
+
+    def get_dynamic_fields_batch(self, parent_object_ids: List[str]) -> List[List[dict]]:
+        """First page of suix_getDynamicFields for every parent, batched."""
+        results = self._batch_post([("suix_getDynamicFields", [parent_object_id]) for parent_object_id in parent_object_ids])
+        return [result['data'] for result in results]
+
+    def iter_transaction_block_pages(self, filter_type, address, cursor=None, limit=1000, descending_order=False, options=None, deadline: Optional[Deadline] = None):
+        """Yield (transactions, next_cursor) for every page of the query, starting after cursor."""
         query = {
             "filter": {
                 filter_type: address,
             },
-            "options": {
+            "options": options if options is not None else {
                 "showInput": True,
                 "showRawInput": False,
                 "showEffects": True,
@@ -155,25 +436,136 @@ class SuiClient:
             "method": "suix_queryTransactionBlocks",
             "params": [query, cursor, limit, descending_order]
         }
-        transactions = []
 
         while True:
-            response = requests.post(self.url, data=json.dumps(payload), headers=self.headers).json()
+            try:
+                response = self._post(payload, deadline=deadline)
+            except RpcError as e:
+                # each page is retried on its own, so a failure here can resume from this cursor
+                e.cursor = cursor
+                raise
             data = response['result']['data']
-            transactions.extend(data)
             cursor = response['result']['nextCursor']
             has_next_page = response['result']['hasNextPage']
+            yield data, cursor
             if not has_next_page:
                 break
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded("Cancelled" if deadline.cancelled else "Deadline exceeded", cursor=cursor)
             payload["params"] = [query, cursor, limit, descending_order]
 
+    def query_transaction_blocks(self, filter_type, address, cursor=None, limit=1000, descending_order=False, deadline: Optional[Deadline] = None):
+        transactions = []
+        for data, _ in self.iter_transaction_block_pages(filter_type, address, cursor, limit, descending_order, deadline=deadline):
+            transactions.extend(data)
         return transactions
 
+    def query_transaction_blocks_since(self, filter_type, address, cursor=None, limit=1000):
+        """All transactions after cursor, oldest first, and the cursor to resume from on the next call."""
+        transactions = []
+        for data, next_cursor in self.iter_transaction_block_pages(filter_type, address, cursor, limit):
+            transactions.extend(data)
+            if next_cursor is not None:
+                cursor = next_cursor
+        return transactions, cursor
+
+    def get_latest_checkpoint_sequence_number(self) -> int:
+        payload = {
+            "jsonrpc": "2.0",
+            "id": 1,
+            "method": "sui_getLatestCheckpointSequenceNumber",
+            "params": []
+        }
+        return int(self._post(payload)['result'])
+
+    def iter_checkpoint_pages(self, cursor=None, limit=100, deadline: Optional[Deadline] = None):
+        """Yield (checkpoints, next_cursor) for every page of checkpoints after cursor, a sequence number string, oldest first."""
+        payload = {
+            "jsonrpc": "2.0",
+            "id": 1,
+            "method": "sui_getCheckpoints",
+            "params": [cursor, limit, False]
+        }
+
+        while True:
+            try:
+                response = self._post(payload, deadline=deadline)
+            except RpcError as e:
+                e.cursor = cursor
+                raise
+            data = response['result']['data']
+            cursor = response['result']['nextCursor']
+            has_next_page = response['result']['hasNextPage']
+            yield data, cursor
+            if not has_next_page:
+                break
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded("Cancelled" if deadline.cancelled else "Deadline exceeded", cursor=cursor)
+            payload["params"] = [cursor, limit, False]
+
+    def multi_get_transaction_blocks(self, digests: List[str], options=CHECKPOINT_TRANSACTION_OPTIONS, deadline: Optional[Deadline] = None) -> List[dict]:
+        """The transactions with the given digests, in order, 50 per call as the fullnode allows."""
+        calls = [("sui_multiGetTransactionBlocks", [chunk, options]) for chunk in self.chunked_requests(digests)]
+        return [transaction for result in self._batch_post(calls, deadline) for transaction in result]
+
     def chunked_requests(self, request: List, chunk_size=50):
         for i in range(0, len(request), chunk_size):
             yield request[i:i + chunk_size]
 
 
+class AsyncSuiClient:
+    """
+    asyncio front end with the same methods as SuiClient. Each call runs the wrapped SuiClient on a thread
+    pool, with at most max_concurrency requests in flight, so both clients share one transport and its caches.
+    """
+    def __init__(self, sui_client: SuiClient, max_concurrency=8):
+        self.sui_client = sui_client
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="sui-rpc")
+        self._semaphore = None
+
+    async def _call(self, fn, *args, **kwargs):
+        # created lazily so the semaphore belongs to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+    async def query_validator_epoch_info_events(self, cursor=None):
+        return await self._call(self.sui_client.query_validator_epoch_info_events, cursor)
+
+    async def get_sui_system_state(self):
+        return await self._call(self.sui_client.get_sui_system_state)
+
+    async def get_dynamic_fields(self, parent_object_id):
+        return await self._call(self.sui_client.get_dynamic_fields, parent_object_id)
+
+    async def get_object(self, object_id):
+        return await self._call(self.sui_client.get_object, object_id)
+
+    async def get_objects(self, object_ids: List[str]):
+        return await self._call(self.sui_client.get_objects, object_ids)
+
+    async def try_multi_get_past_objects(self, request: List, deadline: Optional[Deadline] = None):
+        # one call per JSON-RPC batch so a large request is spread over the pool
+        chunks = list(self.sui_client.chunked_requests(request, 50 * self.sui_client.batch_size))
+        results = await asyncio.gather(*[self._call(self.sui_client.try_multi_get_past_objects, chunk, deadline) for chunk in chunks])
+        return [item for result in results for item in result]
+
+    async def query_transaction_blocks(self, filter_type, address, cursor=None, limit=1000, descending_order=False):
+        return await self._call(self.sui_client.query_transaction_blocks, filter_type, address, cursor, limit, descending_order)
+
+    async def query_transaction_blocks_since(self, filter_type, address, cursor=None, limit=1000):
+        return await self._call(self.sui_client.query_transaction_blocks_since, filter_type, address, cursor, limit)
+
+    async def fold_transaction_pages(self, filter_type, address, cursor, builders, options=HISTORY_TRANSACTION_OPTIONS, deadline: Optional[Deadline] = None):
+        return await self._call(fold_transaction_pages, self.sui_client, filter_type, address, cursor, builders, None, options, deadline)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
 class DeletedObject(BaseModel):
     digest: str
     object_id: str = Field(..., alias="objectId")
@@ -194,11 +586,24 @@ class ObjectChange(BaseModel):
     version: str
     owner: Union[AddressOwner, dict]
 
+class BalanceChange(BaseModel):
+    owner: Union[AddressOwner, dict, str]
+    coin_type: str = Field(..., alias="coinType")
+    amount: str
+
+class TransactionData(BaseModel):
+    sender: str
+
+class TransactionBlock(BaseModel):
+    data: TransactionData
+
 class Transaction(BaseModel):
     checkpoint: str = None
     tx_digest: str = Field(..., alias="digest")
     effects: Effects
-    object_changes: List[Union[ObjectChange, dict]] = Field(..., alias="objectChanges")
+    object_changes: List[Union[ObjectChange, dict]] = Field([], alias="objectChanges")
+    balance_changes: Optional[List[BalanceChange]] = Field(None, alias="balanceChanges")
+    transaction: Optional[TransactionBlock] = None
     timestampMs: str = None
 
 class ObjectByEpoch(BaseModel):
@@ -207,21 +612,75 @@ class ObjectByEpoch(BaseModel):
     version: str
     status: str
 
-class OrganizedByObjectIdOptional(BaseModel):
-    digest: str
-    object_id: str
-    version: int
-    created: Optional[str] # epoch
-    deleted: Optional[str] # epoch
-    mutated: Optional[List[Tuple[str, str]]] = [] # epoch, version
-
-class OrganizedByObjectId(BaseModel):
-    digest: str
-    object_id: str
-    version: int
-    created: Optional[int]
-    deleted: Optional[int] # epoch
-    mutated: Optional[List[Tuple[int, int]]] = [] # epoch, version
+class ObjectHistory:
+    """
+    The changes to one object: version is the first one seen, created and deleted are epochs, and its mutations
+    are parallel arrays of epochs and versions kept sorted by epoch. version_at(epoch) is a bisect over them
+    plus a running maximum of the versions, which is built on the first lookup after a change.
+    """
+    __slots__ = ("digest", "object_id", "version", "created", "deleted", "mutated_epochs", "mutated_versions", "_max_versions")
+
+    def __init__(self, digest, object_id, version: int):
+        self.digest = digest
+        self.object_id = object_id
+        self.version = version
+        self.created: Optional[int] = None
+        self.deleted: Optional[int] = None
+        self.mutated_epochs = array("q")
+        self.mutated_versions = array("q")
+        self._max_versions: Optional[array] = None
+
+    def add(self, epoch: int, version: int, status):
+        if status == "created":
+            self.created = epoch
+        elif status == "mutated":
+            if not self.mutated_epochs or self.mutated_epochs[-1] <= epoch:
+                self.mutated_epochs.append(epoch)
+                self.mutated_versions.append(version)
+            else:
+                # changes arrive grouped by epoch in the order the epochs were first seen, which ToAddress
+                # followed by FromAddress transactions can leave out of order
+                idx = bisect_right(self.mutated_epochs, epoch)
+                self.mutated_epochs.insert(idx, epoch)
+                self.mutated_versions.insert(idx, version)
+            self._max_versions = None
+        elif status == "deleted":
+            self.deleted = epoch
+        else:
+            raise Exception(f"Unknown status {status}")
+
+    @property
+    def mutated(self) -> List[Tuple[int, int]]:
+        return list(zip(self.mutated_epochs, self.mutated_versions))
+
+    def version_at(self, epoch) -> Optional[int]:
+        """The highest version created or mutated by the end of epoch, None if there is none or it was deleted by then."""
+        if self.deleted is not None and self.deleted <= epoch:
+            return None
+        version = self.version if self.created is not None and self.created <= epoch else None
+        idx = bisect_right(self.mutated_epochs, epoch)
+        if idx:
+            if self._max_versions is None:
+                self._max_versions = self._running_max(self.mutated_versions)
+            mutation_version = self._max_versions[idx - 1]
+            if version is None or mutation_version > version:
+                version = mutation_version
+        return version
+
+    @staticmethod
+    def _running_max(versions: array) -> array:
+        # versions only grow along the chain, so this is nearly always the array itself
+        if all(versions[i - 1] <= versions[i] for i in range(1, len(versions))):
+            return versions
+        max_versions = array("q", versions)
+        for i in range(1, len(max_versions)):
+            if max_versions[i] < max_versions[i - 1]:
+                max_versions[i] = max_versions[i - 1]
+        return max_versions
+
+    def dict(self) -> Dict[str, Any]:
+        return {"digest": self.digest, "object_id": self.object_id, "version": self.version, "created": self.created,
+                "deleted": self.deleted, "mutated": self.mutated}
 
 class ObjectAtEpoch(BaseModel):
     object_id: str
@@ -263,26 +722,11 @@ class DeletedObjectRef(BaseModel):
     owner: str
     deleted: bool
 
-def get_existing_objects_at_epoch(objs_by_obj_id: Dict[str, OrganizedByObjectId], epoch) -> List[ObjectAtEpoch]:
+def get_existing_objects_at_epoch(objs_by_obj_id: Dict[str, ObjectHistory], epoch) -> List[ObjectAtEpoch]:
     existing_objects = []
     for object_id, obj in objs_by_obj_id.items():
-
-        # expect obj to have at least one of created or mutated
-        if obj.created is None and obj.mutated is None:
-            continue
-        # filter out objects that were deleted before or in the epoch
-        if obj.deleted is not None and obj.deleted <= epoch:
-            continue
-
-        version = None
-        if obj.created is not None and obj.created <= epoch:
-            version = obj.version
-        # In the case of a transferred object, we may not have information on when the object was created
-        if obj.mutated is not None:
-            for mutation_epoch, mutation_version in obj.mutated:
-                if mutation_epoch <= epoch:
-                    if version is None or mutation_version > version:
-                        version = mutation_version
+        # a transferred object may have no created epoch, only mutations; deleted objects have no version
+        version = obj.version_at(epoch)
         if version is not None:
             existing_objects.append(ObjectAtEpoch(object_id=object_id, version=version))
     return existing_objects
@@ -299,27 +743,63 @@ def find_closest(numbers, target):
             closest = num
     return closest
 
-def get_validator_id_for_inactive_pool(sui_client: SuiClient, pool_id, sui_system_state):
+def get_validator_ids_for_inactive_pools(sui_client: SuiClient, pool_ids: List[str], sui_system_state) -> Dict[str, str]:
+    """
+    Resolve several inactive pools to validator addresses. Each step of the wrapper -> inner fields -> validator
+    lookup is one batched request for all of the pools instead of a chain of single calls per pool. Resolved pools
+    are remembered on the client, so each pool is looked up once.
+    """
+    known = sui_client.inactive_pool_validators
+    missing = [pool_id for pool_id in pool_ids if pool_id not in known]
+    if not missing:
+        return {pool_id: known[pool_id] for pool_id in pool_ids}
+
     inactive_pools = sui_client.get_dynamic_fields(sui_system_state['inactivePoolsId'])
-    print(inactive_pools)
-    validator_wrapper = None
+    wrappers = {}
     for item in inactive_pools:
-        if item['name']['value'] == pool_id:
-            validator_wrapper = item['objectId']
-            break
-
-    if validator_wrapper is None:
-        raise Exception(f"Could not find validator wrapper for pool {pool_id}")
-
-    validator_wrapper_object = sui_client.get_object(validator_wrapper)
-    validator_dynamic_fields_id = validator_wrapper_object['content']['fields']['value']['fields']['inner']['fields']['id']['id']
-
-    validator_object = sui_client.get_dynamic_fields(validator_dynamic_fields_id)
-    validator_object_id = validator_object[0]['objectId']
+        if item['name']['value'] in missing:
+            wrappers[item['name']['value']] = item['objectId']
+    for pool_id in missing:
+        if pool_id not in wrappers:
+            raise Exception(f"Could not find validator wrapper for pool {pool_id}")
+    known.update(get_validator_ids_for_wrappers(sui_client, wrappers))
+    return {pool_id: known[pool_id] for pool_id in pool_ids}
+
+def get_validator_ids_for_wrappers(sui_client: SuiClient, wrappers: Dict[str, str]) -> Dict[str, str]:
+    """pool_id -> validator address, given pool_id -> object id of the pool's entry in the inactive pools table."""
+    if not wrappers:
+        return {}
+    pools = list(wrappers.keys())
+    wrapper_objects = sui_client.get_objects([wrappers[pool_id] for pool_id in pools])
+    dynamic_fields_ids = [obj['content']['fields']['value']['fields']['inner']['fields']['id']['id'] for obj in wrapper_objects]
+    validator_fields = sui_client.get_dynamic_fields_batch(dynamic_fields_ids)
+    validator_objects = sui_client.get_objects([fields[0]['objectId'] for fields in validator_fields])
+
+    return {
+        pool_id: validator_object['content']['fields']['value']['fields']['metadata']['fields']['sui_address']
+        for pool_id, validator_object in zip(pools, validator_objects)
+    }
+
+def get_new_pool_validators(sui_client: SuiClient, known_pool_ids: Set[str]) -> Dict[str, str]:
+    """
+    pool_id -> validator address for every pool not in known_pool_ids. Active pools come from the system state;
+    every page of the inactive pools table is read, and only the wrappers of unknown pools are fetched.
+    """
+    sui_system_state = sui_client.get_sui_system_state()
+    pools = {
+        validator['stakingPoolId']: validator['suiAddress']
+        for validator in sui_system_state['activeValidators'] if validator['stakingPoolId'] not in known_pool_ids
+    }
+    wrappers = {}
+    for fields, _ in sui_client.iter_dynamic_field_pages(sui_system_state['inactivePoolsId']):
+        for item in fields:
+            if item['name']['value'] not in known_pool_ids:
+                wrappers[item['name']['value']] = item['objectId']
+    pools.update(get_validator_ids_for_wrappers(sui_client, wrappers))
+    return pools
 
-    validator_object = sui_client.get_object(validator_object_id)
-    validator_address = validator_object['content']['fields']['value']['fields']['metadata']['fields']['sui_address']
-    return validator_address
+def get_validator_id_for_inactive_pool(sui_client: SuiClient, pool_id, sui_system_state):
+    return get_validator_ids_for_inactive_pools(sui_client, [pool_id], sui_system_state)[pool_id]
 
 def calculate_rewards(
         sui_client,
@@ -329,13 +809,16 @@ def calculate_rewards(
         pool_id,
         activation_epoch,
         target_epoch=105,
+        pool_validators=None,
         ):
 
-    validator_id = None
-    for validator in sui_system_state['activeValidators']:
-        if validator['stakingPoolId'] == pool_id:
-            validator_id = validator['suiAddress']
-            break
+    # pool_validators is the persisted pool_id -> validator map; the lookups below only run for pools it lacks
+    validator_id = pool_validators.get(pool_id) if pool_validators else None
+    if not validator_id:
+        for validator in sui_system_state['activeValidators']:
+            if validator['stakingPoolId'] == pool_id:
+                validator_id = validator['suiAddress']
+                break
     if not validator_id:
         validator_id = get_validator_id_for_inactive_pool(sui_client, pool_id, sui_system_state)
         # raise Exception(f"Could not find validator for pool {pool_id} at activation epoch {activation_epoch}, target epoch {target_epoch}")
@@ -360,15 +843,24 @@ def calculate_rewards(
     rate_at_target_epoch = 1 if rate_at_target_epoch is None else rate_at_target_epoch
     estimated_reward = max(0, ((rate_at_activation_epoch / rate_at_target_epoch) - 1.0) * principal)
 
-    print(activation_epoch, target_epoch, rate_at_activation_epoch, rate_at_target_epoch, principal, estimated_reward, validator_id)
+    log.debug("%s %s %s %s %s %s %s", activation_epoch, target_epoch, rate_at_activation_epoch, rate_at_target_epoch, principal, estimated_reward, validator_id)
 
     return rate_at_activation_epoch, rate_at_target_epoch, estimated_reward, validator_id
 
-def filter_transactions_for_object_type(address, transactions, object_type="0x3::staking_pool::StakedSui") -> List[Transaction]:
+def filter_transactions_for_object_type(address, transactions, object_type="0x3::staking_pool::StakedSui", known_object_ids=None) -> List[Transaction]:
+    """
+    Keep the object changes owned by address for object_type, plus deletions of those objects.
+    known_object_ids seeds the objects already attributed to the address, so deletions of objects seen in
+    an earlier ingestion run are not dropped.
+    """
+    object_id_set = set(known_object_ids) if known_object_ids else set()
+    return _filter_transactions(address, transactions, object_type, object_id_set)
+
+def _filter_transactions(address, transactions, object_type, object_id_set: set) -> List[Transaction]:
+    # object_id_set is updated in place so it can carry over from one page of transactions to the next
     transformed_transactions = [
         Transaction(**transaction) if not isinstance(transaction, Transaction) else transaction for transaction in transactions
     ]
-    object_id_set = set()
     filtered_transactions = []
     for transaction in transformed_transactions:
         keep_object_changes = []
@@ -395,7 +887,7 @@ def filter_transactions_for_object_type(address, transactions, object_type="0x3:
             filtered_transactions.append(transaction)
     return filtered_transactions
 
-def build_object_history(address, filtered_transactions: List[Transaction], record: bool = False) -> Tuple[Dict[str, List[ObjectByEpoch]], Dict[str, OrganizedByObjectId]]:
+def build_object_history(address, filtered_transactions: List[Transaction], record: bool = False) -> Tuple[Dict[str, List[ObjectByEpoch]], Dict[str, ObjectHistory]]:
     objs_by_epoch: Dict[str, List[ObjectByEpoch]] = {}
     for transaction in filtered_transactions:
         epoch = transaction.effects.executed_epoch
@@ -430,55 +922,33 @@ def build_object_history(address, filtered_transactions: List[Transaction], reco
             objs_by_epoch_dict = {k: [o.dict() for o in v] for k, v in objs_by_epoch.items()}
             json.dump(objs_by_epoch_dict, fout, indent=4, sort_keys=True)
 
-    objs_by_obj_id = {}
+    objs_by_obj_id: Dict[str, ObjectHistory] = {}
     for epoch, epoch_objs in objs_by_epoch.items():
+        epoch = int(epoch)
         for epoch_obj in epoch_objs:
-            if epoch_obj.object_id not in objs_by_obj_id:
-                objs_by_obj_id[epoch_obj.object_id] = OrganizedByObjectIdOptional(
-                    digest = epoch_obj.digest,
-                    object_id = epoch_obj.object_id,
-                    version = epoch_obj.version,
-                    created = None,
-                    deleted = None,
-                )
-            if epoch_obj.status == "created":
-                objs_by_obj_id[epoch_obj.object_id] = objs_by_obj_id[epoch_obj.object_id].copy(update={
-                    "created": epoch
-                })
-            elif epoch_obj.status == "mutated":
-                mutated = objs_by_obj_id[epoch_obj.object_id].mutated
-                mutated.append((epoch, epoch_obj.version))
-                objs_by_obj_id[epoch_obj.object_id] = objs_by_obj_id[epoch_obj.object_id].copy(update={
-                    "mutated": mutated
-                })
-            elif epoch_obj.status == "deleted":
-                objs_by_obj_id[epoch_obj.object_id] = objs_by_obj_id[epoch_obj.object_id].copy(update={
-                    "deleted": epoch # int(epoch)
-                })
-            else:
-                raise Exception(f"Unknown status {epoch_obj.status}")
+            history = objs_by_obj_id.get(epoch_obj.object_id)
+            if history is None:
+                history = objs_by_obj_id[epoch_obj.object_id] = ObjectHistory(epoch_obj.digest, epoch_obj.object_id, int(epoch_obj.version))
+            history.add(epoch, int(epoch_obj.version), epoch_obj.status)
 
-    objs_dict = {k: v.dict() for k, v in objs_by_obj_id.items()}
     if record:
         with open(f"{address}_by_object_id.json", "w") as fout:
-            json.dump(objs_dict, fout, indent=4, sort_keys=True)
-
-    objs_by_obj_id: Dict[str, OrganizedByObjectId] = {k: OrganizedByObjectId.parse_obj(v) for k, v in objs_dict.items()}
+            json.dump({k: v.dict() for k, v in objs_by_obj_id.items()}, fout, indent=4, sort_keys=True)
 
     return (objs_by_epoch, objs_by_obj_id)
 
-@timeout(60)
-def get_all_sui_objs_at_epoch(sui_client: SuiClient, address, epoch, record=False) -> Tuple[List[StakedSuiRef], List[SuiCoinRef]]:
-    print("Load EpochInfoV2 events")
+def get_all_sui_objs_at_epoch(sui_client: SuiClient, address, epoch, record=False, deadline: Optional[Deadline] = None) -> Tuple[List[StakedSuiRef], List[SuiCoinRef]]:
+    """Needs the full history, so unlike the incremental builders this raises DeadlineExceeded if the deadline runs out."""
+    log.debug("Loading object history for %s", address)
     query_epoch = int(epoch)
-    transactions = sui_client.query_transaction_blocks("ToAddress", address)
+    transactions = sui_client.query_transaction_blocks("ToAddress", address, deadline=deadline)
     if record:
         with open(f"{address}_transactions.json", "w") as f:
             json.dump(transactions, f, indent=4, sort_keys=True)
     filtered_transactions = filter_transactions_for_object_type(address, transactions)
     objs_by_epoch, objs_by_obj_id = build_object_history(address, filtered_transactions, record)
     existing_objects = get_existing_objects_at_epoch(objs_by_obj_id, query_epoch)
-    past_objs = sui_client.try_multi_get_past_objects(existing_objects)
+    past_objs = sui_client.try_multi_get_past_objects(existing_objects, deadline)
 
     staked_sui_objs = []
     for past_obj in past_objs:
@@ -498,14 +968,14 @@ def get_all_sui_objs_at_epoch(sui_client: SuiClient, address, epoch, record=Fals
         )
         staked_sui_objs.append(staked_sui_ref)
 
-    transactions.extend(sui_client.query_transaction_blocks("FromAddress", address))
+    transactions.extend(sui_client.query_transaction_blocks("FromAddress", address, deadline=deadline))
     if record:
         with open(f"{address}_transactions.json", "w") as f:
             json.dump(transactions, f, indent=4, sort_keys=True)
     filtered_transactions = filter_transactions_for_object_type(address, transactions, "0x2::coin::Coin<0x2::sui::SUI>")
     objs_by_epoch, objs_by_obj_id = build_object_history(address, filtered_transactions, record)
     existing_objects = get_existing_objects_at_epoch(objs_by_obj_id, query_epoch)
-    past_objs = sui_client.try_multi_get_past_objects(existing_objects)
+    past_objs = sui_client.try_multi_get_past_objects(existing_objects, deadline)
 
     sui_coin_objs = []
     for past_obj in past_objs:
@@ -520,20 +990,116 @@ def get_all_sui_objs_at_epoch(sui_client: SuiClient, address, epoch, record=Fals
 
     return (staked_sui_objs, sui_coin_objs)
 
-@timeout(60)
 def build_object_history_for_address(sui_client: SuiClient, address, record=False) -> Tuple[List[Union[StakedSuiRef, DeletedObjectRef]], List[Union[SuiCoinRef, DeletedObjectRef]]]:
-    print("Load EpochInfoV2 events")
-    transactions = sui_client.query_transaction_blocks("ToAddress", address)
-    if record:
-        with open(f"{address}_transactions.json", "w") as f:
-            json.dump(transactions, f, indent=4, sort_keys=True)
-    filtered_transactions = filter_transactions_for_object_type(address, transactions)
-    objs_by_epoch, objs_by_obj_id = build_object_history(address, filtered_transactions, record)
-    flattened = [(key, obj) for key, obj_list in objs_by_epoch.items() for obj in obj_list]
-
-    at_epochs = [item[0] for item in flattened]
-    past_objs = sui_client.try_multi_get_past_objects([item[1] for item in flattened])
+    staked_sui_objs, sui_coin_objs, _ = build_new_object_history_for_address(sui_client, address, {}, record=record)
+    return (staked_sui_objs, sui_coin_objs)
 
+STAKED_SUI_TYPE = "0x3::staking_pool::StakedSui"
+SUI_COIN_TYPE = "0x2::coin::Coin<0x2::sui::SUI>"
+SUI_BALANCE_TYPE = "0x2::sui::SUI"
+
+class ObjectHistoryBuilder:
+    """
+    Folds pages of transactions, as they arrive, into the history of one object type owned by address.
+    Only the matching changes are kept, so memory grows with the wallet's objects rather than its transactions.
+    """
+    def __init__(self, address, object_type, known_object_ids=None):
+        self.address = address
+        self.object_type = object_type
+        self.object_id_set = set(known_object_ids) if known_object_ids else set()
+        self.filtered_transactions: List[Transaction] = []
+
+    def add_page(self, transactions: List[Transaction]):
+        self.filtered_transactions.extend(_filter_transactions(self.address, transactions, self.object_type, self.object_id_set))
+
+    def flatten(self, record=False) -> List[Tuple[str, ObjectByEpoch]]:
+        """(epoch, object version) for every change, grouped by epoch."""
+        with METRICS.stage("build_object_history"):
+            objs_by_epoch, objs_by_obj_id = build_object_history(self.address, self.filtered_transactions, record)
+        return [(key, obj) for key, obj_list in objs_by_epoch.items() for obj in obj_list]
+
+class BalanceHistoryBuilder:
+    """
+    Folds the owner's SUI balanceChanges into net change per epoch. A transaction the owner sent shows up under
+    both ToAddress and FromAddress, so the ToAddress stream is folded with skip_sent=True to count it only once.
+    """
+    def __init__(self, address, deltas: Dict[int, int], skip_sent=False, coin_type=SUI_BALANCE_TYPE):
+        self.address = address
+        self.deltas = deltas
+        self.skip_sent = skip_sent
+        self.coin_type = coin_type
+
+    def add_page(self, transactions: List[Transaction]):
+        for transaction in transactions:
+            if self.skip_sent and transaction.transaction.data.sender == self.address:
+                continue
+            for balance_change in transaction.balance_changes or []:
+                if isinstance(balance_change.owner, AddressOwner) and balance_change.owner.address_owner == self.address \
+                        and balance_change.coin_type == self.coin_type:
+                    epoch = int(transaction.effects.executed_epoch)
+                    self.deltas[epoch] = self.deltas.get(epoch, 0) + int(balance_change.amount)
+
+def prefetch(iterable, depth=1):
+    """Iterate over iterable on a background thread, keeping up to depth items ready ahead of the consumer."""
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            items.put((done, None))
+        except BaseException as e:
+            items.put((done, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+def fold_transaction_pages(sui_client: SuiClient, filter_type, address, cursor, builders: List[Union[ObjectHistoryBuilder, BalanceHistoryBuilder]], record_to: Optional[list] = None, options=HISTORY_TRANSACTION_OPTIONS, deadline: Optional[Deadline] = None) -> Optional[str]:
+    """
+    Stream every page after cursor into builders, fetching the next page while the current one is processed.
+    Returns the cursor reached, which falls short of the end if the deadline expires: the builders then hold
+    exactly the pages before it and deadline.incomplete is set, so the rest can be picked up from there later.
+    """
+    if deadline is not None and deadline.expired():
+        deadline.incomplete = True
+        return cursor
+    pages = sui_client.iter_transaction_block_pages(filter_type, address, cursor, options=options, deadline=deadline)
+    try:
+        with METRICS.stage("scan_transactions"):
+            for data, next_cursor in prefetch(pages):
+                METRICS.count_page(address)
+                with METRICS.stage("parse_and_filter_pages"):
+                    if record_to is not None:
+                        record_to.extend(data)
+                    transactions = [Transaction(**transaction) for transaction in data]
+                    for builder in builders:
+                        builder.add_page(transactions)
+                if next_cursor is not None:
+                    cursor = next_cursor
+    except DeadlineExceeded:
+        deadline.incomplete = True
+    return cursor
+
+def staked_sui_refs_from_past_objects(address, flattened: List[Tuple[str, ObjectByEpoch]], past_objs) -> List[Union[StakedSuiRef, DeletedObjectRef]]:
     staked_sui_objs = []
     for idx, past_obj in enumerate(past_objs):
         try:
@@ -549,30 +1115,21 @@ def build_object_history_for_address(sui_client: SuiClient, address, record=Fals
                 pool_id=pool_id,
                 principal=principal,
                 stake_activation_epoch=stake_activation_epoch,
-                at_epoch=at_epochs[idx],
+                at_epoch=flattened[idx][0],
                 deleted=False
             )
         except:
             staked_sui_ref = DeletedObjectRef(
                 object_id=flattened[idx][1].object_id,
                 version=flattened[idx][1].version,
-                at_epoch=at_epochs[idx],
+                at_epoch=flattened[idx][0],
                 owner=address,
                 deleted=True
             )
         staked_sui_objs.append(staked_sui_ref)
+    return staked_sui_objs
 
-    transactions.extend(sui_client.query_transaction_blocks("FromAddress", address))
-    if record:
-        with open(f"{address}_transactions.json", "w") as f:
-            json.dump(transactions, f, indent=4, sort_keys=True)
-    filtered_transactions = filter_transactions_for_object_type(address, transactions, "0x2::coin::Coin<0x2::sui::SUI>")
-    objs_by_epoch, objs_by_obj_id = build_object_history(address, filtered_transactions, record)
-    flattened = [(key, obj) for key, obj_list in objs_by_epoch.items() for obj in obj_list]
-
-    at_epochs = [item[0] for item in flattened]
-    past_objs = sui_client.try_multi_get_past_objects([item[1] for item in flattened])
-
+def sui_coin_refs_from_past_objects(address, flattened: List[Tuple[str, ObjectByEpoch]], past_objs) -> List[Union[SuiCoinRef, DeletedObjectRef]]:
     sui_coin_objs = []
     for idx, past_obj in enumerate(past_objs):
         try:
@@ -582,21 +1139,298 @@ def build_object_history_for_address(sui_client: SuiClient, address, record=Fals
                 type=past_obj['details']['type'],
                 owner=past_obj['details']['owner']['AddressOwner'],
                 balance=int(past_obj['details']['content']['fields']['balance']),
-                at_epoch=at_epochs[idx],
+                at_epoch=flattened[idx][0],
                 deleted=False
             ))
         except:
             sui_coin_objs.append(DeletedObjectRef(
                 object_id=flattened[idx][1].object_id,
                 version=flattened[idx][1].version,
-                at_epoch=at_epochs[idx],
+                at_epoch=flattened[idx][0],
                 owner=address,
                 deleted=True
             ))
-
-    return (staked_sui_objs, sui_coin_objs)
-
-def calculate_rewards_for_address(sui_client: SuiClient, epoch_validator_event_dict, start_epoch, end_epoch, staked_sui_objs: List[StakedSuiRef], use_previous_epoch=False) -> Tuple[int, int]:
+    return sui_coin_objs
+
+FlattenedHistory = List[Tuple[str, ObjectByEpoch]]
+
+def past_object_key(obj: ObjectByEpoch) -> Tuple[str, int]:
+    return (obj.object_id, int(obj.version))
+
+def unique_past_object_requests(flattened_histories: List[FlattenedHistory]) -> List[ObjectByEpoch]:
+    """One request per distinct (object_id, version) in the histories, however many of them touched it."""
+    unique = {}
+    for flattened in flattened_histories:
+        for _, obj in flattened:
+            unique.setdefault(past_object_key(obj), obj)
+    METRICS.count("objects_deduplicated", sum(len(flattened) for flattened in flattened_histories) - len(unique))
+    return list(unique.values())
+
+def fetch_unique_past_objects(sui_client: SuiClient, flattened_histories: List[FlattenedHistory], deadline: Optional[Deadline] = None) -> Dict[Tuple[str, int], dict]:
+    """Fetch every object version in the histories once, keyed by past_object_key, for fan_out_past_objects to hand back."""
+    requests = unique_past_object_requests(flattened_histories)
+    return dict(zip(map(past_object_key, requests), sui_client.try_multi_get_past_objects(requests, deadline)))
+
+async def fetch_unique_past_objects_async(async_client: "AsyncSuiClient", flattened_histories: List[FlattenedHistory], deadline: Optional[Deadline] = None) -> Dict[Tuple[str, int], dict]:
+    requests = unique_past_object_requests(flattened_histories)
+    return dict(zip(map(past_object_key, requests), await async_client.try_multi_get_past_objects(requests, deadline)))
+
+def fan_out_past_objects(flattened: FlattenedHistory, past_objects: Dict[Tuple[str, int], dict]) -> List[dict]:
+    """The fetched result for every entry of one history, in order, as the *_refs_from_past_objects functions expect."""
+    return [past_objects[past_object_key(obj)] for _, obj in flattened]
+
+def scan_new_object_history_for_address(
+        sui_client: SuiClient,
+        address,
+        cursors: Dict[str, Optional[str]],
+        known_staked_ids=None,
+        known_coin_ids=None,
+        record=False,
+        deadline: Optional[Deadline] = None,
+        ) -> Tuple[FlattenedHistory, FlattenedHistory, Dict[str, Optional[str]]]:
+    """
+    The transaction half of build_new_object_history_for_address: the StakedSui and Coin<SUI> versions changed after
+    the cursors, and the cursors to store, without fetching any object. Ingesting many addresses, the versions of
+    all of them go through fetch_unique_past_objects together, so objects passed between them are fetched once.
+    """
+    log.debug("Loading object history for %s", address)
+    staked_history = ObjectHistoryBuilder(address, STAKED_SUI_TYPE, known_staked_ids)
+    coin_history = ObjectHistoryBuilder(address, SUI_COIN_TYPE, known_coin_ids)
+    transactions = [] if record else None
+    to_cursor = fold_transaction_pages(sui_client, "ToAddress", address, cursors.get("ToAddress"), [staked_history, coin_history], transactions, deadline=deadline)
+    from_cursor = fold_transaction_pages(sui_client, "FromAddress", address, cursors.get("FromAddress"), [coin_history], transactions, deadline=deadline)
+    if record:
+        with open(f"{address}_transactions.json", "w") as f:
+            json.dump(transactions, f, indent=4, sort_keys=True)
+    return (staked_history.flatten(record), coin_history.flatten(record), {"ToAddress": to_cursor, "FromAddress": from_cursor})
+
+async def scan_new_object_history_for_address_async(
+        async_client: "AsyncSuiClient",
+        address,
+        cursors: Dict[str, Optional[str]],
+        known_staked_ids=None,
+        known_coin_ids=None,
+        deadline: Optional[Deadline] = None,
+        ) -> Tuple[FlattenedHistory, FlattenedHistory, Dict[str, Optional[str]]]:
+    """asyncio version of scan_new_object_history_for_address."""
+    staked_history = ObjectHistoryBuilder(address, STAKED_SUI_TYPE, known_staked_ids)
+    coin_history = ObjectHistoryBuilder(address, SUI_COIN_TYPE, known_coin_ids)
+    to_cursor = await async_client.fold_transaction_pages("ToAddress", address, cursors.get("ToAddress"), [staked_history, coin_history], deadline=deadline)
+    from_cursor = await async_client.fold_transaction_pages("FromAddress", address, cursors.get("FromAddress"), [coin_history], deadline=deadline)
+    return (staked_history.flatten(), coin_history.flatten(), {"ToAddress": to_cursor, "FromAddress": from_cursor})
+
+def object_history_from_past_objects(address, staked_flattened: FlattenedHistory, coin_flattened: FlattenedHistory, past_objects: Dict[Tuple[str, int], dict]) \
+        -> Tuple[List[Union[StakedSuiRef, DeletedObjectRef]], List[Union[SuiCoinRef, DeletedObjectRef]]]:
+    return (
+        staked_sui_refs_from_past_objects(address, staked_flattened, fan_out_past_objects(staked_flattened, past_objects)),
+        sui_coin_refs_from_past_objects(address, coin_flattened, fan_out_past_objects(coin_flattened, past_objects)),
+    )
+
+def build_new_object_history_for_address(
+        sui_client: SuiClient,
+        address,
+        cursors: Dict[str, Optional[str]],
+        known_staked_ids=None,
+        known_coin_ids=None,
+        record=False,
+        deadline: Optional[Deadline] = None,
+        ) -> Tuple[List[Union[StakedSuiRef, DeletedObjectRef]], List[Union[SuiCoinRef, DeletedObjectRef]], Dict[str, Optional[str]]]:
+    """
+    Like build_object_history_for_address, but only looks at transactions after the per-filter cursors
+    ("ToAddress"/"FromAddress") from a previous run. Returns the new object rows and the cursors to store.
+    If the deadline expires part way, the rows and cursors cover the pages read so far and deadline.incomplete is set.
+    """
+    staked_flattened, coin_flattened, cursors = scan_new_object_history_for_address(sui_client, address, cursors, known_staked_ids, known_coin_ids, record, deadline)
+    past_objects = fetch_unique_past_objects(sui_client, [staked_flattened, coin_flattened], deadline)
+    return (*object_history_from_past_objects(address, staked_flattened, coin_flattened, past_objects), cursors)
+
+async def build_new_object_history_for_address_async(
+        async_client: "AsyncSuiClient",
+        address,
+        cursors: Dict[str, Optional[str]],
+        known_staked_ids=None,
+        known_coin_ids=None,
+        deadline: Optional[Deadline] = None,
+        ) -> Tuple[List[Union[StakedSuiRef, DeletedObjectRef]], List[Union[SuiCoinRef, DeletedObjectRef]], Dict[str, Optional[str]]]:
+    """asyncio version of build_new_object_history_for_address. All past-object chunks are in flight at once."""
+    staked_flattened, coin_flattened, cursors = await scan_new_object_history_for_address_async(async_client, address, cursors, known_staked_ids, known_coin_ids, deadline)
+    past_objects = await fetch_unique_past_objects_async(async_client, [staked_flattened, coin_flattened], deadline)
+    return (*object_history_from_past_objects(address, staked_flattened, coin_flattened, past_objects), cursors)
+
+def _balance_streams(cursors: Dict[str, Optional[str]]) -> bool:
+    # the staked and balance passes share one ToAddress stream while their cursors agree, which they do after
+    # the first run in balance mode; an address switched over from object mode replays its balances from the start
+    return cursors.get("ToAddress") == cursors.get("BalanceToAddress")
+
+def scan_new_balance_history_for_address(
+        sui_client: SuiClient,
+        address,
+        cursors: Dict[str, Optional[str]],
+        known_staked_ids=None,
+        deadline: Optional[Deadline] = None,
+        ) -> Tuple[FlattenedHistory, Dict[int, int], Dict[str, Optional[str]]]:
+    """The transaction half of build_new_balance_history_for_address, as scan_new_object_history_for_address is for objects."""
+    staked_history = ObjectHistoryBuilder(address, STAKED_SUI_TYPE, known_staked_ids)
+    deltas: Dict[int, int] = {}
+    received = BalanceHistoryBuilder(address, deltas, skip_sent=True)
+    sent = BalanceHistoryBuilder(address, deltas)
+    if _balance_streams(cursors):
+        to_cursor = balance_to_cursor = fold_transaction_pages(
+            sui_client, "ToAddress", address, cursors.get("ToAddress"), [staked_history, received],
+            options=HISTORY_AND_BALANCE_TRANSACTION_OPTIONS, deadline=deadline)
+    else:
+        to_cursor = fold_transaction_pages(sui_client, "ToAddress", address, cursors.get("ToAddress"), [staked_history], deadline=deadline)
+        balance_to_cursor = fold_transaction_pages(sui_client, "ToAddress", address, cursors.get("BalanceToAddress"), [received], options=BALANCE_TRANSACTION_OPTIONS, deadline=deadline)
+    balance_from_cursor = fold_transaction_pages(sui_client, "FromAddress", address, cursors.get("BalanceFromAddress"), [sent], options=BALANCE_TRANSACTION_OPTIONS, deadline=deadline)
+    return (staked_history.flatten(), deltas, {"ToAddress": to_cursor, "BalanceToAddress": balance_to_cursor, "BalanceFromAddress": balance_from_cursor})
+
+async def scan_new_balance_history_for_address_async(
+        async_client: "AsyncSuiClient",
+        address,
+        cursors: Dict[str, Optional[str]],
+        known_staked_ids=None,
+        deadline: Optional[Deadline] = None,
+        ) -> Tuple[FlattenedHistory, Dict[int, int], Dict[str, Optional[str]]]:
+    """asyncio version of scan_new_balance_history_for_address."""
+    staked_history = ObjectHistoryBuilder(address, STAKED_SUI_TYPE, known_staked_ids)
+    deltas: Dict[int, int] = {}
+    received = BalanceHistoryBuilder(address, deltas, skip_sent=True)
+    sent = BalanceHistoryBuilder(address, deltas)
+    if _balance_streams(cursors):
+        to_cursor = balance_to_cursor = await async_client.fold_transaction_pages(
+            "ToAddress", address, cursors.get("ToAddress"), [staked_history, received],
+            HISTORY_AND_BALANCE_TRANSACTION_OPTIONS, deadline)
+    else:
+        to_cursor = await async_client.fold_transaction_pages("ToAddress", address, cursors.get("ToAddress"), [staked_history], deadline=deadline)
+        balance_to_cursor = await async_client.fold_transaction_pages("ToAddress", address, cursors.get("BalanceToAddress"), [received], BALANCE_TRANSACTION_OPTIONS, deadline)
+    balance_from_cursor = await async_client.fold_transaction_pages("FromAddress", address, cursors.get("BalanceFromAddress"), [sent], BALANCE_TRANSACTION_OPTIONS, deadline)
+    return (staked_history.flatten(), deltas, {"ToAddress": to_cursor, "BalanceToAddress": balance_to_cursor, "BalanceFromAddress": balance_from_cursor})
+
+def build_new_balance_history_for_address(
+        sui_client: SuiClient,
+        address,
+        cursors: Dict[str, Optional[str]],
+        known_staked_ids=None,
+        deadline: Optional[Deadline] = None,
+        ) -> Tuple[List[Union[StakedSuiRef, DeletedObjectRef]], Dict[int, int], Dict[str, Optional[str]]]:
+    """
+    Liquid SUI fast path: StakedSui rows as in build_new_object_history_for_address, but liquid SUI comes from the
+    owner's balance changes as net change per epoch, so no Coin<SUI> versions are fetched. Balance cursors are kept
+    under "BalanceToAddress"/"BalanceFromAddress". Stops early on an expired deadline, like build_new_object_history_for_address.
+    """
+    flattened, deltas, cursors = scan_new_balance_history_for_address(sui_client, address, cursors, known_staked_ids, deadline)
+    past_objects = fetch_unique_past_objects(sui_client, [flattened], deadline)
+    return (staked_sui_refs_from_past_objects(address, flattened, fan_out_past_objects(flattened, past_objects)), deltas, cursors)
+
+async def build_new_balance_history_for_address_async(
+        async_client: "AsyncSuiClient",
+        address,
+        cursors: Dict[str, Optional[str]],
+        known_staked_ids=None,
+        deadline: Optional[Deadline] = None,
+        ) -> Tuple[List[Union[StakedSuiRef, DeletedObjectRef]], Dict[int, int], Dict[str, Optional[str]]]:
+    """asyncio version of build_new_balance_history_for_address."""
+    flattened, deltas, cursors = await scan_new_balance_history_for_address_async(async_client, address, cursors, known_staked_ids, deadline)
+    past_objects = await fetch_unique_past_objects_async(async_client, [flattened], deadline)
+    return (staked_sui_refs_from_past_objects(address, flattened, fan_out_past_objects(flattened, past_objects)), deltas, cursors)
+
+class CheckpointHistoryBuilder:
+    """
+    Folds pages of transactions from a checkpoint scan into the object histories of every tracked address they
+    touch, checking each transaction's object owners and sender against one set of addresses. An address sees the
+    transactions its ToAddress and FromAddress queries would return: its StakedSui history those that change an
+    object it owns, its Coin<SUI> history those and the ones it sent.
+    """
+    def __init__(self, addresses, known_object_ids: Callable[[str, str], Set[str]]):
+        self.tracked = set(addresses)
+        # (address, object_type) -> object ids stored by earlier runs, looked up the first time the address shows up
+        self.known_object_ids = known_object_ids
+        self.histories: Dict[str, Tuple[ObjectHistoryBuilder, ObjectHistoryBuilder]] = {}
+        self.touched: Set[str] = set()
+
+    def _histories(self, address) -> Tuple[ObjectHistoryBuilder, ObjectHistoryBuilder]:
+        histories = self.histories.get(address)
+        if histories is None:
+            histories = self.histories[address] = (
+                ObjectHistoryBuilder(address, STAKED_SUI_TYPE, self.known_object_ids(address, STAKED_SUI_TYPE)),
+                ObjectHistoryBuilder(address, SUI_COIN_TYPE, self.known_object_ids(address, SUI_COIN_TYPE)),
+            )
+        self.touched.add(address)
+        return histories
+
+    def add_page(self, transactions: List[Transaction]):
+        staked_transactions: Dict[str, List[Transaction]] = {}
+        coin_transactions: Dict[str, List[Transaction]] = {}
+        for transaction in transactions:
+            recipients = {
+                object_change.owner.address_owner for object_change in transaction.object_changes
+                if isinstance(object_change, ObjectChange) and isinstance(object_change.owner, AddressOwner)
+            }
+            for address in recipients & self.tracked:
+                staked_transactions.setdefault(address, []).append(transaction)
+                coin_transactions.setdefault(address, []).append(transaction)
+            sender = transaction.transaction.data.sender if transaction.transaction is not None else None
+            if sender in self.tracked and sender not in recipients:
+                coin_transactions.setdefault(sender, []).append(transaction)
+        for address, address_transactions in staked_transactions.items():
+            self._histories(address)[0].add_page(address_transactions)
+        for address, address_transactions in coin_transactions.items():
+            self._histories(address)[1].add_page(address_transactions)
+
+    def flush(self) -> Dict[str, Tuple[FlattenedHistory, FlattenedHistory]]:
+        """(staked, coin) flattened histories of every address touched since the last flush, which starts them afresh."""
+        flushed = {}
+        for address in self.touched:
+            staked_history, coin_history = self.histories[address]
+            flushed[address] = (staked_history.flatten(), coin_history.flatten())
+            staked_history.filtered_transactions = []
+            coin_history.filtered_transactions = []
+        self.touched = set()
+        return flushed
+
+def iter_checkpoint_transaction_pages(sui_client: SuiClient, cursor=None, end_checkpoint=None, limit=100, deadline: Optional[Deadline] = None):
+    """
+    Yield (transactions, checkpoint) for every page of checkpoints after cursor, up to end_checkpoint if given:
+    all the transactions in the page in execution order, and the last checkpoint they cover.
+    """
+    for checkpoints, _ in sui_client.iter_checkpoint_pages(cursor, limit, deadline):
+        if end_checkpoint is not None:
+            checkpoints = [checkpoint for checkpoint in checkpoints if int(checkpoint['sequenceNumber']) <= end_checkpoint]
+        if not checkpoints:
+            return
+        digests = [digest for checkpoint in checkpoints for digest in checkpoint['transactions']]
+        last_checkpoint = int(checkpoints[-1]['sequenceNumber'])
+        yield sui_client.multi_get_transaction_blocks(digests, deadline=deadline), last_checkpoint
+        if end_checkpoint is not None and last_checkpoint >= end_checkpoint:
+            return
+
+def check_liquid_balances(sui_client: SuiClient, address, balances: Dict[int, int]) -> List[str]:
+    """
+    Cross-check balances (epoch -> liquid SUI at the end of that epoch, from the balance-change path) against the
+    object path, which rebuilds the full Coin<SUI> history of the address. Returns one line per mismatch.
+    """
+    coin_history = ObjectHistoryBuilder(address, SUI_COIN_TYPE)
+    fold_transaction_pages(sui_client, "ToAddress", address, None, [coin_history])
+    fold_transaction_pages(sui_client, "FromAddress", address, None, [coin_history])
+    flattened = coin_history.flatten()
+    past_objs = sui_client.try_multi_get_past_objects([item[1] for item in flattened])
+    coin_refs = sorted(sui_coin_refs_from_past_objects(address, flattened, past_objs), key=lambda ref: (ref.at_epoch, ref.version))
+
+    mismatches = []
+    live: Dict[str, Tuple[int, int]] = {}
+    idx = 0
+    for epoch in sorted(balances):
+        while idx < len(coin_refs) and coin_refs[idx].at_epoch <= epoch:
+            ref = coin_refs[idx]
+            idx += 1
+            if ref.object_id not in live or ref.version > live[ref.object_id][0]:
+                live[ref.object_id] = (ref.version, 0 if ref.deleted else ref.balance)
+        expected = sum(balance for _, balance in live.values())
+        if expected != balances[epoch]:
+            mismatches.append(f"{address} epoch {epoch}: balance changes give {balances[epoch]}, coin objects give {expected}")
+    return mismatches
+
+def calculate_rewards_for_address(sui_client: SuiClient, epoch_validator_event_dict, start_epoch, end_epoch, staked_sui_objs: List[StakedSuiRef], use_previous_epoch=False, pool_validators=None) -> Tuple[int, int]:
     staked_sui = 0
     estimated_rewards = 0
     sui_system_state = sui_client.get_sui_system_state()
@@ -611,7 +1445,8 @@ def calculate_rewards_for_address(sui_client: SuiClient, epoch_validator_event_d
                                    staked_sui_obj.principal,
                                    staked_sui_obj.pool_id,
                                    activation_epoch,
-                                   end_epoch)
+                                   end_epoch,
+                                   pool_validators)
         gather.append(RewardsForStakedSui(
             objectId=staked_sui_obj.object_id,
             version=staked_sui_obj.version,
@@ -623,9 +1458,8 @@ def calculate_rewards_for_address(sui_client: SuiClient, epoch_validator_event_d
             validator_id=result[3],
             pool_id=staked_sui_obj.pool_id,
         ))
-        print(result[2], "outside")
         estimated_rewards += result[2]
-        print(estimated_rewards)
+        log.debug("%s outside, %s in total", result[2], estimated_rewards)
         staked_sui += staked_sui_obj.principal
 
     return (staked_sui, estimated_rewards)
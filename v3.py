@@ -1,13 +1,26 @@
 import requests
 import json
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import logging
 from datetime import datetime
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any, Iterator
+from typing import List, Optional, Dict, Any, Iterator, AsyncIterator, Tuple
 import csv
-from timeout_decorator import timeout, timeout_decorator
-from track_historical_staked_sui import SuiClient, build_object_history_for_address, calculate_rewards_for_address
-from sqlite_manager import SqliteManager
+from track_historical_staked_sui import SuiClient, AsyncSuiClient, scan_new_object_history_for_address, scan_new_object_history_for_address_async, \
+    scan_new_balance_history_for_address, scan_new_balance_history_for_address_async, fetch_unique_past_objects, fetch_unique_past_objects_async, \
+    fan_out_past_objects, staked_sui_refs_from_past_objects, sui_coin_refs_from_past_objects, check_liquid_balances, calculate_rewards_for_address, \
+    CheckpointHistoryBuilder, iter_checkpoint_transaction_pages, object_history_from_past_objects, prefetch, Transaction, STAKED_SUI_TYPE, SUI_COIN_TYPE
+from sqlite_manager import SqliteManager, SqliteWriter
+from rate_limiter import AdaptiveRateLimiter, RpcError
+from deadline import Deadline, DeadlineExceeded
+import metrics
+from metrics import METRICS
+from rpc_cache import RpcCache
+
+log = logging.getLogger(__name__)
 
 class CsvInput(BaseModel):
     address: str = Field(..., alias="Wallet Address")
@@ -18,30 +31,306 @@ def read_csv(filename: str) -> List[CsvInput]:
         reader = csv.DictReader(f)
         return [CsvInput.parse_obj(row) for row in reader]
 
+def cross_check_liquid(sui_client: SuiClient, address, balances: Dict[int, int]):
+    log.info(f"Cross-checking liquid SUI for {address} against coin objects")
+    mismatches = check_liquid_balances(sui_client, address, balances)
+    for mismatch in mismatches:
+        log.warning(f"MISMATCH {mismatch}")
+    return mismatches
+
+def address_deadline(run_deadline: Deadline, address_budget, grace) -> Deadline:
+    return Deadline(address_budget, grace=grace, parent=run_deadline)
+
+def report_partial(address, deadline: Deadline, cursors):
+    if deadline.incomplete:
+        log.warning(f"Out of time for {address}, stored progress up to cursors {cursors}; the next run continues from there")
+
+def store_address(writer: SqliteWriter, address, liquid_mode, staked_flattened, liquid, cursors, past_objects):
+    """Fan the fetched object versions out to address's rows and queue them, with its cursors after them."""
+    writer.insert_batch_staked_sui_v2(staked_sui_refs_from_past_objects(address, staked_flattened, fan_out_past_objects(staked_flattened, past_objects)))
+    if liquid_mode == "balance-changes":
+        writer.apply_liquid_balance_deltas(address, liquid, cursors)
+    else:
+        writer.insert_batch_sui_coin_v2(sui_coin_refs_from_past_objects(address, liquid, fan_out_past_objects(liquid, past_objects)))
+        writer.set_ingest_cursors(address, cursors)
+
+def object_histories(scanned, liquid_mode):
+    """Every flattened history of the scanned addresses that needs past objects fetched."""
+    histories = [staked_flattened for _, _, staked_flattened, _, _ in scanned]
+    if liquid_mode != "balance-changes":
+        histories.extend(liquid for _, _, _, liquid, _ in scanned)
+    return histories
+
+def resolve_group(sui_client: SuiClient, scanned, liquid_mode) -> Iterator[Tuple[list, Dict[Tuple[str, int], dict]]]:
+    """
+    Yield (scanned addresses, past objects) to store. The versions of the whole group are fetched together; if that
+    fails, each address is fetched on its own, so an RPC error only holds back the addresses whose versions hit it.
+    """
+    try:
+        past_objects = fetch_unique_past_objects(sui_client, object_histories(scanned, liquid_mode))
+    except RpcError as e:
+        if len(scanned) == 1:
+            log.error(f"RPC error fetching objects for {scanned[0][0]}, which continues from its stored cursors next run: {e}")
+            return
+        log.warning(f"RPC error fetching objects for {len(scanned)} addresses, fetching them one address at a time: {e}")
+    else:
+        yield scanned, past_objects
+        return
+    for item in scanned:
+        yield from resolve_group(sui_client, [item], liquid_mode)
+
+async def resolve_group_async(async_client: AsyncSuiClient, scanned, liquid_mode, deadline: Deadline) -> AsyncIterator[Tuple[list, Dict[Tuple[str, int], dict]]]:
+    try:
+        past_objects = await fetch_unique_past_objects_async(async_client, object_histories(scanned, liquid_mode), deadline)
+    except RpcError as e:
+        if len(scanned) == 1:
+            log.error(f"RPC error fetching objects for {scanned[0][0]}, which continues from its stored cursors next run: {e}")
+            return
+        log.warning(f"RPC error fetching objects for {len(scanned)} addresses, fetching them one address at a time: {e}")
+    else:
+        yield scanned, past_objects
+        return
+    for item in scanned:
+        async for resolved in resolve_group_async(async_client, [item], liquid_mode, deadline):
+            yield resolved
+
+async def ingest_addresses_async(sui_client: SuiClient, db: SqliteManager, addresses: List[str], concurrency=8, address_budget=60, liquid_mode="objects", liquid_check_rate=0.0, group_size=100) -> List[str]:
+    """
+    Build the object history for up to `concurrency` addresses at once. The transactions of group_size addresses
+    are scanned first, then the object versions they need are fetched once however many of them touched each,
+    while the next group is scanned. Reads go through one thread, so the connection is never used concurrently,
+    and rows are handed to a SqliteWriter as each group resolves. Each address gets address_budget seconds of scanning; one that runs
+    out stores what it has fetched so far. Returns the addresses whose history is now stored up to the latest transaction.
+    """
+    async_client = AsyncSuiClient(sui_client, max_concurrency=concurrency)
+    db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-reader")
+    sqlite_writer = SqliteWriter(db.db_path)
+    loop = asyncio.get_running_loop()
+    address_semaphore = asyncio.Semaphore(concurrency)
+    write_queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    # cancelled when the run stops, so fetches still running on the client's threads give up too
+    run_deadline = Deadline()
+    complete = []
+
+    def read_state(address):
+        return (db.get_ingest_cursors(address),
+                db.get_object_ids_for_owner("staked_sui_v2", address),
+                db.get_object_ids_for_owner("sui_coins_v2", address))
+
+    write_error: Optional[BaseException] = None
+    # addresses sampled for --liquid-check-rate, cross-checked once ingestion is done so the writer only writes
+    check_addresses: List[str] = []
+
+    async def writer():
+        # after a failed write nothing more is stored, but the queue keeps draining so no producer blocks on it
+        nonlocal write_error
+        while True:
+            item = await write_queue.get()
+            if item is None:
+                break
+            if write_error is not None:
+                continue
+            try:
+                await loop.run_in_executor(db_executor, store_address, sqlite_writer, item[0], liquid_mode, *item[1:])
+            except Exception as e:
+                log.error(f"Error storing {item[0]}, the remaining addresses are not stored this run: {e}")
+                write_error = e
+                continue
+            METRICS.count("addresses")
+            log.info(f"Done {item[0]}")
+            if liquid_mode == "balance-changes" and random.random() < liquid_check_rate:
+                check_addresses.append(item[0])
+
+    async def scan(address):
+        async with address_semaphore:
+            log.info(f"Processing {address}")
+            cursors, known_staked_ids, known_coin_ids = await loop.run_in_executor(db_executor, read_state, address)
+            deadline = address_deadline(run_deadline, address_budget, sui_client.request_timeout)
+            try:
+                if liquid_mode == "balance-changes":
+                    result = await scan_new_balance_history_for_address_async(async_client, address, cursors, known_staked_ids, deadline)
+                else:
+                    result = await scan_new_object_history_for_address_async(async_client, address, cursors, known_staked_ids, known_coin_ids, deadline)
+            except RpcError as e:
+                log.error(f"RPC error processing {address} (resume from cursor {e.cursor}): {e}")
+                return None
+            report_partial(address, deadline, result[-1])
+            return (address, deadline, *result)
+
+    async def resolve(scanned):
+        async for resolved, past_objects in resolve_group_async(async_client, scanned, liquid_mode, run_deadline):
+            for address, deadline, staked_flattened, liquid, cursors in resolved:
+                await write_queue.put((address, staked_flattened, liquid, cursors, past_objects))
+                if not deadline.incomplete:
+                    complete.append(address)
+
+    writer_task = asyncio.create_task(writer())
+    resolving = []
+    try:
+        for start in range(0, len(addresses), group_size):
+            scanned = await asyncio.gather(*[scan(address) for address in addresses[start:start + group_size]])
+            resolving.append(asyncio.create_task(resolve([item for item in scanned if item is not None])))
+        await asyncio.gather(*resolving)
+    finally:
+        run_deadline.cancel()
+        for task in resolving:
+            task.cancel()
+        if not writer_task.done():
+            await write_queue.put(None)
+        await writer_task
+        async_client.close()
+        db_executor.shutdown(wait=True)
+        sqlite_writer.close()
+    if write_error is not None:
+        raise write_error
+
+    for address in check_addresses:
+        await loop.run_in_executor(None, cross_check_liquid, sui_client, address, db.get_liquid_balances(address))
+
+    return complete
+
+def ingest_addresses(sui_client: SuiClient, db: SqliteManager, input_data: List[CsvInput], address_budget=60, liquid_mode="objects", liquid_check_rate=0.0, group_size=100) -> List[str]:
+    """
+    One address at a time, in groups of group_size whose object versions are fetched together once, as in
+    ingest_addresses_async. Returns the addresses whose history is now stored up to the latest transaction.
+    """
+    run_deadline = Deadline()
+    complete = []
+    writer = SqliteWriter(db.db_path)
+    # an address listed twice would otherwise be scanned twice from the same cursors within one group
+    addresses = list(dict.fromkeys(row.address for row in input_data))
+    try:
+        for start in range(0, len(addresses), group_size):
+            scanned = []
+            for address in addresses[start:start + group_size]:
+                log.info(f"Processing {address}")
+                deadline = address_deadline(run_deadline, address_budget, sui_client.request_timeout)
+                try:
+                    cursors = db.get_ingest_cursors(address)
+                    known_staked_ids = db.get_object_ids_for_owner("staked_sui_v2", address)
+                    if liquid_mode == "balance-changes":
+                        result = scan_new_balance_history_for_address(sui_client, address, cursors, known_staked_ids, deadline)
+                    else:
+                        known_coin_ids = db.get_object_ids_for_owner("sui_coins_v2", address)
+                        result = scan_new_object_history_for_address(sui_client, address, cursors, known_staked_ids, known_coin_ids, deadline=deadline)
+                except RpcError as e:
+                    log.error(f"RPC error processing {address} (resume from cursor {e.cursor}): {e}")
+                    continue
+                scanned.append((address, deadline, *result))
+
+            for resolved, past_objects in resolve_group(sui_client, scanned, liquid_mode):
+                for address, deadline, staked_flattened, liquid, cursors in resolved:
+                    store_address(writer, address, liquid_mode, staked_flattened, liquid, cursors, past_objects)
+                    if liquid_mode == "balance-changes" and random.random() < liquid_check_rate:
+                        writer.flush()
+                        cross_check_liquid(sui_client, address, db.get_liquid_balances(address))
+                    report_partial(address, deadline, cursors)
+                    if not deadline.incomplete:
+                        complete.append(address)
+                    METRICS.count("addresses")
+                    log.info("Done")
+    finally:
+        writer.close()
+    return complete
+
+def ingest(sui_client: SuiClient, db: SqliteManager, input_data: List[CsvInput], concurrency=1, address_budget=60, liquid_mode="objects", liquid_check_rate=0.0, group_size=100) -> List[str]:
+    """ingest_addresses, or ingest_addresses_async when fetching more than one address at once."""
+    if concurrency > 1:
+        return asyncio.run(ingest_addresses_async(sui_client, db, list(dict.fromkeys(row.address for row in input_data)), concurrency, address_budget,
+                                                  liquid_mode=liquid_mode, liquid_check_rate=liquid_check_rate, group_size=group_size))
+    return ingest_addresses(sui_client, db, input_data, address_budget, liquid_mode, liquid_check_rate, group_size)
+
+def ingest_checkpoints(sui_client: SuiClient, db: SqliteManager, input_data: List[CsvInput], from_checkpoint=0, end_checkpoint=None, budget=None, limit=100) -> Optional[int]:
+    """
+    Walk every transaction once, in checkpoint order, and update the history of each listed address it touches,
+    instead of querying the transactions of every address separately. Pays off once the addresses outnumber the
+    transactions per address by far. Each page of checkpoints is stored before the watermark moves past it, so an
+    interrupted scan resumes from the last stored page. Coin objects only: the balance-changes liquid mode needs
+    the per-address queries. Returns the last checkpoint stored.
+    """
+    watermark = db.get_checkpoint_watermark()
+    if watermark is None:
+        watermark = from_checkpoint - 1
+    tables = {STAKED_SUI_TYPE: "staked_sui_v2", SUI_COIN_TYPE: "sui_coins_v2"}
+    builder = CheckpointHistoryBuilder((row.address for row in input_data), lambda address, object_type: db.get_object_ids_for_owner(tables[object_type], address))
+    target = end_checkpoint if end_checkpoint is not None else sui_client.get_latest_checkpoint_sequence_number()
+    log.info(f"Scanning checkpoints {watermark + 1} to {target} for {len(builder.tracked)} addresses")
+
+    pages = iter_checkpoint_transaction_pages(sui_client, str(watermark) if watermark >= 0 else None, end_checkpoint, limit, Deadline(budget))
+    writer = SqliteWriter(db.db_path)
+    try:
+        with METRICS.stage("scan_checkpoints"):
+            for data, checkpoint in prefetch(pages):
+                with METRICS.stage("parse_and_filter_pages"):
+                    builder.add_page([Transaction(**transaction) for transaction in data])
+                histories = builder.flush()
+                past_objects = fetch_unique_past_objects(sui_client, [history for pair in histories.values() for history in pair])
+                for address, (staked_flattened, coin_flattened) in histories.items():
+                    staked_refs, coin_refs = object_history_from_past_objects(address, staked_flattened, coin_flattened, past_objects)
+                    writer.insert_batch_staked_sui_v2(staked_refs)
+                    writer.insert_batch_sui_coin_v2(coin_refs)
+                writer.set_checkpoint_watermark(checkpoint)
+                watermark = checkpoint
+                METRICS.count("checkpoint_transactions", len(data))
+                log.info(f"Stored checkpoints up to {checkpoint}: {len(data)} transactions, {len(histories)} addresses touched")
+    except DeadlineExceeded:
+        log.warning(f"Out of time after checkpoint {watermark}; the next run continues from there")
+    except RpcError as e:
+        log.error(f"RPC error after checkpoint {watermark}, the next run continues from there: {e}")
+    finally:
+        writer.close()
+    return watermark
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--rpc-url", type=str, help="RPC URL to use", default="https://fullnode.mainnet.sui.io:443")
     parser.add_argument("--input-filename", default="test.csv")
     parser.add_argument("--start-from", type=int, help="Start from a specific row in the CSV file", default=0)
+    parser.add_argument("--purge", action="store_true", help="Drop all stored objects and cursors and refetch every address from scratch", default=False)
+    parser.add_argument("--concurrency", type=int, help="Number of addresses to fetch at once", default=1)
+    parser.add_argument("--record-rpc", type=str, help="Append every RPC call and result to this file, for replay with local_fullnode.py", default=None)
+    parser.add_argument("--address-budget", type=float, help="Seconds to spend on each address; a slow one stores its progress and continues on the next run", default=60)
+    parser.add_argument("--dedup-group-size", type=int, help="Addresses whose object versions are fetched together, each distinct version once", default=100)
+    parser.add_argument("--request-timeout", type=float, help="Seconds to wait for a single RPC request", default=30)
+    parser.add_argument("--max-rps", type=float, help="Upper bound for the adaptive requests-per-second limit", default=200.0)
+    parser.add_argument("--rpc-cache", type=str, help="Cache immutable RPC results (past objects, full history pages) in this sqlite file across runs", default=None)
+    parser.add_argument("--rpc-cache-max-mb", type=int, help="Size limit of the --rpc-cache file", default=1024)
+    parser.add_argument("--liquid-mode", choices=["objects", "balance-changes"], default="objects",
+                        help="Track liquid SUI from Coin<SUI> object versions, or from per-transaction balance changes without fetching coins")
+    parser.add_argument("--liquid-check-rate", type=float, default=0.0,
+                        help="With --liquid-mode balance-changes, fraction of addresses to cross-check against the coin object path")
+    parser.add_argument("--ingest-mode", choices=["addresses", "checkpoints"], default="addresses",
+                        help="Query the transactions of each address, or walk all transactions by checkpoint once for very large address lists")
+    parser.add_argument("--from-checkpoint", type=int, help="With --ingest-mode checkpoints, where the first scan starts; later runs continue from the stored watermark", default=0)
+    parser.add_argument("--end-checkpoint", type=int, help="With --ingest-mode checkpoints, the last checkpoint to scan this run", default=None)
+    parser.add_argument("--checkpoint-budget", type=float, help="With --ingest-mode checkpoints, seconds to scan before storing progress and stopping", default=None)
+    metrics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.setup(args)
 
     input_data = read_csv(args.input_filename)
     input_data = input_data[args.start_from:]
 
-    db = SqliteManager(version="v2")
-    sui_client = SuiClient(url=args.rpc_url)
+    db = SqliteManager(version="v2", purge=args.purge)
+    rate_limiter = AdaptiveRateLimiter(max_rate=args.max_rps, concurrency=max(1, args.concurrency))
+    rpc_cache = RpcCache(args.rpc_cache, max_disk_bytes=args.rpc_cache_max_mb * 2**20) if args.rpc_cache else None
+    sui_client = SuiClient(url=args.rpc_url, pool_size=max(10, args.concurrency), rate_limiter=rate_limiter, record_path=args.record_rpc, cache=rpc_cache,
+                           request_timeout=args.request_timeout)
 
+    if args.ingest_mode == "checkpoints":
+        if args.liquid_mode != "objects":
+            raise Exception("--ingest-mode checkpoints only supports --liquid-mode objects")
+        ingest_checkpoints(sui_client, db, input_data, args.from_checkpoint, args.end_checkpoint, args.checkpoint_budget)
+    else:
+        ingest(sui_client, db, input_data, args.concurrency, args.address_budget, args.liquid_mode, args.liquid_check_rate, args.dedup_group_size)
+    # closing the last connection checkpoints the WAL into the db file and removes it
+    db.conn.close()
 
-    for row in input_data:
-        print(f"Processing {row.address}")
-        try:
-            (staked_sui_objs, sui_coin_objs) = build_object_history_for_address(sui_client, row.address)
-            db.insert_batch_staked_sui_v2(staked_sui_objs)
-            db.insert_batch_sui_coin_v2(sui_coin_objs)
-        except timeout_decorator.TimeoutError:
-            print(f"Timeout processing {row.address}")
-            continue
-        print("Done")
+    if rpc_cache:
+        log.info(f"RPC cache: {rpc_cache.stats()}")
+    metrics.finish(args, {"rpc_cache": rpc_cache.stats()} if rpc_cache else None)
+    if rpc_cache:
+        rpc_cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+import argparse
+import csv
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from track_historical_staked_sui import SuiClient
+from exchange_rates import ExchangeRateMatrix
+from determine_cumulative import cumulative_sums
+from sqlite_manager import SqliteManager
+from rate_limiter import AdaptiveRateLimiter
+from rpc_cache import RpcCache
+from sui_tracker_v2 import compute_epoch_series
+from v3 import CsvInput, read_csv, ingest
+import metrics
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+
+class EpochWatcher:
+    """
+    Follows new epochs for a fixed set of addresses. The client, its caches and the db connection live for the
+    whole run: noticing that nothing happened costs one event query from the stored cursor, and a closed epoch
+    costs the new transactions of each address plus one pass over its stored history. Values for an
+    (address, epoch) are computed once and kept in the epoch_report table.
+    """
+    def __init__(self, sui_client: SuiClient, db: SqliteManager, input_data: List[CsvInput], output_filename, start_epoch=0,
+                 use_previous_epoch=False, cumulative=False, concurrency=1, address_budget=60, liquid_mode="objects"):
+        self.sui_client = sui_client
+        self.db = db
+        self.input_data = input_data
+        self.output_filename = output_filename
+        self.start_epoch = start_epoch
+        self.use_previous_epoch = use_previous_epoch
+        self.cumulative = cumulative
+        self.concurrency = concurrency
+        self.address_budget = address_budget
+        self.liquid_mode = liquid_mode
+        self.closed_epoch: Optional[int] = None
+        # addresses whose history may be missing transactions of a closed epoch; all of them until the first pass
+        self.pending = set(row.address for row in input_data)
+
+    def poll(self) -> Optional[int]:
+        """Store the epoch events emitted since the last poll and return the latest closed epoch."""
+        with METRICS.stage("poll_epoch"):
+            self.db.sync_validator_epoch_events(self.sui_client)
+            return self.db.get_max_event_epoch()
+
+    def step(self) -> bool:
+        """Poll once, then catch up every pending address. Returns whether the report changed."""
+        closed_epoch = self.poll()
+        if closed_epoch is None or closed_epoch < self.start_epoch:
+            return False
+        if closed_epoch != self.closed_epoch:
+            if self.closed_epoch is not None:
+                log.info(f"Epoch {closed_epoch} closed")
+                # new validators can join at an epoch change
+                SuiClient.get_sui_system_state.cache_clear()
+                self.pending = set(row.address for row in self.input_data)
+            new_pools = self.db.sync_pool_validators(self.sui_client)
+            if new_pools:
+                log.info(f"Stored {new_pools} new pool -> validator mappings")
+            self.closed_epoch = closed_epoch
+        if not self.pending:
+            return False
+
+        complete = self.ingest([row for row in self.input_data if row.address in self.pending])
+        # a stake live at an epoch can activate at the next one, so load one epoch either side of the range
+        rates = ExchangeRateMatrix.from_events(self.db.get_validator_epoch_events(self.start_epoch - 1, closed_epoch + 1), self.db.get_pool_validators())
+        for address in complete:
+            reported = self.db.get_epoch_report(address)
+            epochs = [epoch for epoch in range(self.start_epoch, closed_epoch + 1) if epoch not in reported]
+            if epochs:
+                with METRICS.stage("compute_epoch_series"):
+                    data = compute_epoch_series(self.sui_client, self.db.conn, address, epochs, rates, self.start_epoch, self.use_previous_epoch)
+                self.db.insert_epoch_report(address, data)
+            self.pending.discard(address)
+        if self.pending:
+            log.warning(f"{len(self.pending)} addresses are still catching up and will be retried at the next poll")
+        self.write_report()
+        return True
+
+    def ingest(self, rows: List[CsvInput]) -> List[str]:
+        with METRICS.stage("ingest"):
+            return ingest(self.sui_client, self.db, rows, self.concurrency, self.address_budget, self.liquid_mode)
+
+    def report_rows(self, row: CsvInput, epochs: List[int], reported: Dict[int, Tuple[float, float, float]]) -> List[list]:
+        """The same rows as sui_tracker_v2.report_rows, with blanks for epochs not reported yet."""
+        prefix = [row.address, row.category if row.category else ""]
+        rows = []
+        for i, type in enumerate(["Liquid SUI", "Staked SUI", "Estimated Reward"]):
+            rows.append(prefix + [type] + [reported[epoch][i] if epoch in reported else "" for epoch in epochs])
+        if self.cumulative:
+            rewards = [reported[epoch][2] if epoch in reported else "" for epoch in epochs]
+            totals = cumulative_sums([reward or 0 for reward in rewards])
+            rows.append(prefix + ["Estimated Reward for Epoch"] + rewards)
+            rows.append(prefix + ["Cumulative to Epoch"] + [total if reward != "" else "" for reward, total in zip(rewards, totals)])
+        return rows
+
+    def write_report(self):
+        """Rewrite the wide CSV from epoch_report, so readers never see a half-written file."""
+        epochs = list(range(self.start_epoch, self.closed_epoch + 1))
+        reports = {}
+        partial = f"{self.output_filename}.partial"
+        with open(partial, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Address", "Name", "Type"] + epochs)
+            for row in self.input_data:
+                if row.address not in reports:
+                    reports[row.address] = self.db.get_epoch_report(row.address)
+                writer.writerows(self.report_rows(row, epochs, reports[row.address]))
+        os.replace(partial, self.output_filename)
+        log.info(f"Wrote {self.output_filename} up to epoch {self.closed_epoch}")
+
+    def run(self, poll_interval=60, once=False):
+        while True:
+            started = time.monotonic()
+            self.step()
+            if once:
+                return
+            time.sleep(max(0.0, poll_interval - (time.monotonic() - started)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rpc-url", type=str, help="RPC URL to use", default="https://fullnode.mainnet.sui.io:443")
+    parser.add_argument("--input-filename", default="test.csv")
+    parser.add_argument("--output-filename", default="output.csv")
+    parser.add_argument("--db-path", type=str, help="Path to the sqlite db shared with v3.py and sui_tracker_v2.py", default="sui_data.db")
+    parser.add_argument("--start-epoch", type=int, help="First epoch of the report", default=0)
+    parser.add_argument("--poll-interval", type=float, help="Seconds between checks for a new epoch", default=60)
+    parser.add_argument("--once", action="store_true", help="Catch up to the latest closed epoch and exit instead of watching", default=False)
+    parser.add_argument("--use-previous-epoch", action="store_true", help="Use previous epoch for estimated rewards", default=False)
+    parser.add_argument("--cumulative", action="store_true", help="Also write 'Estimated Reward for Epoch' and 'Cumulative to Epoch' rows (use with --use-previous-epoch)", default=False)
+    parser.add_argument("--concurrency", type=int, help="Number of addresses to fetch at once", default=1)
+    parser.add_argument("--address-budget", type=float, help="Seconds to spend on each address per poll; a slow one continues at the next poll", default=60)
+    parser.add_argument("--request-timeout", type=float, help="Seconds to wait for a single RPC request", default=30)
+    parser.add_argument("--max-rps", type=float, help="Upper bound for the adaptive requests-per-second limit", default=200.0)
+    parser.add_argument("--rpc-cache", type=str, help="Cache immutable RPC results (past objects, full history pages) in this sqlite file across runs", default=None)
+    parser.add_argument("--rpc-cache-max-mb", type=int, help="Size limit of the --rpc-cache file", default=1024)
+    parser.add_argument("--liquid-mode", choices=["objects", "balance-changes"], default="objects",
+                        help="Track liquid SUI from Coin<SUI> object versions, or from per-transaction balance changes without fetching coins")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args)
+
+    db = SqliteManager(version="v2", purge=False, db_path=args.db_path)
+    rate_limiter = AdaptiveRateLimiter(max_rate=args.max_rps, concurrency=max(1, args.concurrency))
+    rpc_cache = RpcCache(args.rpc_cache, max_disk_bytes=args.rpc_cache_max_mb * 2**20) if args.rpc_cache else None
+    sui_client = SuiClient(url=args.rpc_url, pool_size=max(10, args.concurrency), rate_limiter=rate_limiter, cache=rpc_cache,
+                           request_timeout=args.request_timeout)
+
+    watcher = EpochWatcher(sui_client, db, read_csv(args.input_filename), args.output_filename, args.start_epoch,
+                           args.use_previous_epoch, args.cumulative, args.concurrency, args.address_budget, args.liquid_mode)
+    try:
+        watcher.run(args.poll_interval, args.once)
+    except KeyboardInterrupt:
+        log.info("Stopped")
+    finally:
+        db.conn.close()
+        if rpc_cache:
+            log.info(f"RPC cache: {rpc_cache.stats()}")
+        metrics.finish(args, {"rpc_cache": rpc_cache.stats()} if rpc_cache else None)
+        if rpc_cache:
+            rpc_cache.close()
+
+
+if __name__ == "__main__":
+    main()